@@ -0,0 +1,289 @@
+"""
+このファイルは、ローテーション済みのログ（logs/application.log.*）を集計し、回答までの時間・エラーの発生率・繰り返される質問を出力するコマンドです。
+
+ログは1行ずつ読み込んで集計するため、ファイルの数・大きさに関わらず、ファイル全体をメモリに載せることはありません。
+（数KBになる回答のレコードも、先頭だけで回答と判定し、内容は解析しません）
+
+集計する項目:
+    - latency: 質問のレコードから、同じセッションで最初に出力された回答のレコードまでの時間（秒）のパーセンタイル。
+      全体・お悩み種別・ジャンル・日付（質問の日付）ごとに集計し、回答のない質問は unanswered に数える
+    - errors: エラーの種類ごとの件数と、エラーが発生したセッションの割合（ログに出力された全セッションに対する割合）。
+      種類はメッセージの1行目の「:」より前（「音声認識エラー」など）で、APIのエラーコード（audio_too_short など）があれば付加する
+    - repeated: 正規化した質問（表記の揺れをそろえたもの）ごとの出現回数が2回以上の質問（多い順）。
+      キャッシュ・FAQの対象や、チューニングの対象を選ぶための目安
+    - unparsed_questions: 解析できなかった質問のレコードの件数（切り詰めに対応する前のログで、長い質問が切り詰められたもの）。
+      これらの質問と、その回答は集計に含まれない
+
+使い方:
+    python analyze_logs.py [--logs "logs/application.log.*"] [--include-current] [--top 20] [--output report.json]
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import json
+import argparse
+from collections import Counter, defaultdict
+import constants as ct
+import log_parser
+import metrics
+import singleflight
+
+
+############################################################
+# 変数定義
+############################################################
+# 集計するログレベル
+ERROR_LEVELS = ("ERROR", "CRITICAL")
+
+# エラーメッセージに含まれるAPIのエラーコード（'code': 'audio_too_short' など）
+ERROR_CODE_PATTERN = re.compile(r"""['"]code['"]: ['"](?P<code>[\w.-]+)['"]""")
+
+# 出力するパーセンタイル
+PERCENTILES = (50, 90, 95, 99)
+
+
+############################################################
+# クラス定義
+############################################################
+
+class LogStats:
+    """
+    ログのレコードを1件ずつ受け取って集計するクラス
+    """
+    def __init__(self):
+        self.files = 0
+        self.records = 0
+        self.sessions = set()
+        self.latencies = defaultdict(lambda: defaultdict(list))
+        self.unanswered = defaultdict(Counter)
+        self.errors = Counter()
+        self.error_sessions = defaultdict(set)
+        self.questions = Counter()
+        self.originals = {}
+        self.answered = Counter()
+        self.unparsed_questions = 0
+
+    def observe(self, records):
+        """
+        レコードを集計しながら、そのまま次の処理へ渡す（セッション数・エラーの集計）
+
+        Args:
+            records: レコードの辞書のイテラブル
+
+        Yields:
+            レコードの辞書
+        """
+        for record in records:
+            self.records += 1
+            if record["session_id"]:
+                self.sessions.add(record["session_id"])
+            if record["level"] in ERROR_LEVELS:
+                kind = error_type(record["message"])
+                self.errors[kind] += 1
+                self.error_sessions[kind].add(record["session_id"])
+            yield record
+
+    def add_consultation(self, consultation):
+        """
+        質問と回答の組を集計
+
+        Args:
+            consultation: log_parser.iter_consultationsで取得した相談の辞書
+        """
+        groups = {
+            "all": "all",
+            "mode": consultation["mode"] or "(未記録)",
+            "genre": consultation["genre"] or "(未記録)",
+            "day": consultation["timestamp"].date().isoformat(),
+        }
+        answered_at = consultation["answered_at"]
+        for dimension, value in groups.items():
+            if answered_at is None:
+                self.unanswered[dimension][value] += 1
+            else:
+                self.latencies[dimension][value].append((answered_at - consultation["timestamp"]).total_seconds())
+
+        question = consultation["question"].strip()
+        key = (consultation["genre"], singleflight.normalize(question))
+        self.questions[key] += 1
+        self.originals.setdefault(key, (consultation["mode"], question))
+        if answered_at is not None:
+            self.answered[key] += 1
+
+    def add_unparsed_question(self, record):
+        """
+        解析できなかった質問のレコードを集計
+
+        Args:
+            record: レコードの辞書
+        """
+        self.unparsed_questions += 1
+
+    def report(self, top):
+        """
+        集計結果を作成
+
+        Args:
+            top: 出力する繰り返される質問の件数
+
+        Returns:
+            集計結果の辞書
+        """
+        latency = {}
+        for dimension in ("all", "mode", "genre", "day"):
+            values = set(self.latencies[dimension]) | set(self.unanswered[dimension])
+            latency[dimension] = {
+                value: summarize_latencies(self.latencies[dimension][value], self.unanswered[dimension][value])
+                for value in sorted(values)
+            }
+
+        sessions = len(self.sessions)
+        errors = [
+            {
+                "type": kind,
+                "count": count,
+                "sessions": len(self.error_sessions[kind]),
+                "session_rate": round(len(self.error_sessions[kind]) / sessions, 4) if sessions else None,
+            }
+            for kind, count in self.errors.most_common()
+        ]
+
+        repeated = []
+        for key, count in self.questions.most_common():
+            if count < 2 or len(repeated) >= top:
+                break
+            mode, question = self.originals[key]
+            repeated.append({
+                "count": count,
+                "answered": self.answered[key],
+                "mode": mode,
+                "genre": key[0],
+                "question": question,
+            })
+
+        return {
+            "files": self.files,
+            "records": self.records,
+            "sessions": sessions,
+            "questions": sum(self.questions.values()),
+            "unparsed_questions": self.unparsed_questions,
+            "latency": latency,
+            "errors": errors,
+            "repeated": repeated,
+        }
+
+
+############################################################
+# 関数定義
+############################################################
+
+def error_type(message):
+    """
+    エラーメッセージから、エラーの種類を判定
+
+    Args:
+        message: レコードのメッセージ
+
+    Returns:
+        エラーの種類（「音声認識エラー:audio_too_short」「初期化処理に失敗しました。」など）
+    """
+    first_line = message.split("\n", 1)[0]
+    kind = first_line.split(":", 1)[0].strip() or "(メッセージなし)"
+    match = ERROR_CODE_PATTERN.search(message)
+    if match:
+        kind = f"{kind}:{match.group('code')}"
+    return kind
+
+
+def summarize_latencies(latencies, unanswered):
+    """
+    回答までの時間のパーセンタイルを算出
+
+    Args:
+        latencies: 回答までの時間（秒）のリスト
+        unanswered: 回答のない質問の件数
+
+    Returns:
+        件数・回答のない件数・パーセンタイル値・最大値の辞書
+    """
+    values = sorted(latencies)
+    summary = {"count": len(values), "unanswered": unanswered}
+    for pct in PERCENTILES:
+        summary[f"p{pct}_s"] = metrics.percentile(values, pct)
+    summary["max_s"] = round(values[-1], 2) if values else None
+    return summary
+
+
+def analyze(paths, top=20):
+    """
+    ログファイルを順に読み込んで集計
+
+    Args:
+        paths: ログファイルのパスのリスト（古い順）
+        top: 出力する繰り返される質問の件数
+
+    Returns:
+        集計結果の辞書
+    """
+    stats = LogStats()
+    stats.files = len(paths)
+    records = stats.observe(log_parser.iter_records(paths))
+    consultations = log_parser.iter_consultations(records, parse_answers=False, on_unparsed=stats.add_unparsed_question)
+    for consultation in consultations:
+        stats.add_consultation(consultation)
+    return stats.report(top)
+
+
+def print_report(report):
+    """
+    集計結果を表形式で表示
+    """
+    print(f"ファイル: {report['files']}件 / レコード: {report['records']}件 / "
+          f"セッション: {report['sessions']}件 / 質問: {report['questions']}件 / "
+          f"解析できない質問: {report['unparsed_questions']}件")
+
+    labels = {"all": "全体", "mode": "お悩み種別", "genre": "ジャンル", "day": "日付"}
+    for dimension, label in labels.items():
+        print(f"\n■ 回答までの時間（{label}ごと、秒）")
+        print(f"{'':<24} {'count':>6} {'no_ans':>6} " + " ".join(f"{'p' + str(pct):>7}" for pct in PERCENTILES) + f" {'max':>7}")
+        for value, summary in report["latency"][dimension].items():
+            cells = " ".join(f"{_cell(summary[f'p{pct}_s']):>7}" for pct in PERCENTILES)
+            print(f"{value[:24]:<24} {summary['count']:>6} {summary['unanswered']:>6} {cells} {_cell(summary['max_s']):>7}")
+
+    print("\n■ エラーの種類ごとの件数")
+    print(f"{'count':>6} {'sessions':>8} {'rate':>7}  type")
+    for error in report["errors"]:
+        print(f"{error['count']:>6} {error['sessions']:>8} {_cell(error['session_rate']):>7}  {error['type']}")
+
+    print("\n■ 繰り返される質問")
+    print(f"{'count':>6} {'answered':>8}  genre / question")
+    for item in report["repeated"]:
+        print(f"{item['count']:>6} {item['answered']:>8}  {item['genre'] or '(未記録)'} / {item['question'][:60]}")
+
+
+def _cell(value):
+    return "-" if value is None else value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ログを集計し、回答までの時間・エラーの発生率・繰り返される質問を出力します。")
+    parser.add_argument("--logs", default=None, help="対象のログファイルのglobパターン（既定はローテーション済みのログ）")
+    parser.add_argument("--include-current", action="store_true", help=f"出力中の {ct.LOG_FILE} も対象にする")
+    parser.add_argument("--top", type=int, default=20, help="出力する繰り返される質問の件数")
+    parser.add_argument("--output", help="集計結果をJSONで出力する場合の出力先")
+    args = parser.parse_args()
+
+    paths = log_parser.find_log_files(args.logs, include_current=args.include_current)
+    report = analyze(paths, args.top)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n集計結果を出力しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
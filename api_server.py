@@ -0,0 +1,172 @@
+"""
+このファイルは、相談エンジンを画面（Streamlit）から切り離して提供する非同期HTTP APIサーバーです。
+
+エンドポイント:
+    - POST /ask: 回答を一括で返す
+    - POST /ask/stream: 回答をNDJSON（1行1イベントのJSON）でストリーミングする
+    - GET /metrics: 処理時間・トークン数の集計結果
+    - GET /health: 稼働確認
+
+リクエストボディ（/ask, /ask/stream 共通）:
+    {"mode": お悩み種別, "mode_2": ジャンル, "history": 会話ログ, "message": ユーザー入力}
+
+使い方:
+    python api_server.py [--host 127.0.0.1] [--port 8503]
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import json
+import asyncio
+import logging
+import argparse
+from contextlib import aclosing
+from dotenv import load_dotenv
+from aiohttp import web
+import constants as ct
+import app_logging
+import metrics
+import engine
+
+
+############################################################
+# 設定関連
+############################################################
+# 「.env」ファイルで定義した環境変数の読み込み
+load_dotenv()
+
+
+############################################################
+# 関数定義
+############################################################
+
+async def _parse_request(request):
+    """
+    リクエストボディを読み込み、エンジンに渡す引数に変換
+
+    Args:
+        request: HTTPリクエスト
+
+    Returns:
+        engine.ask / engine.astream に渡すキーワード引数
+    """
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="リクエストボディがJSONではありません。")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="リクエストボディはJSONのオブジェクトで指定してください。")
+
+    message = body.get("message")
+    if not isinstance(message, str) or not message.strip():
+        raise web.HTTPBadRequest(text="「message」を指定してください。")
+
+    history = body.get("history") or []
+    if not isinstance(history, list):
+        raise web.HTTPBadRequest(text="「history」はリストで指定してください。")
+
+    # リクエストごとにログ用のセッションIDを設定（未指定の場合は「api」）
+    app_logging.set_session_id(body.get("session_id") or "api")
+
+    return {
+        "chat_message": message,
+        "mode": body.get("mode") or "",
+        "mode_2": body.get("mode_2") or body.get("genre") or "",
+        "messages": history,
+    }
+
+
+async def handle_ask(request):
+    """
+    POST /ask: 回答を一括で返す
+    """
+    params = await _parse_request(request)
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    logger.info({"message": params["chat_message"], "application_mode": params["mode"], "genre": params["mode_2"]})
+    try:
+        answer = await engine.aask(**params)
+    except Exception as e:
+        logger.error(f"{ct.GET_LLM_RESPONSE_ERROR_MESSAGE}\n{e}")
+        raise web.HTTPInternalServerError(text=ct.GET_LLM_RESPONSE_ERROR_MESSAGE)
+    return web.json_response({"answer": answer}, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+
+async def handle_ask_stream(request):
+    """
+    POST /ask/stream: 回答をNDJSONでストリーミングする
+    """
+    params = await _parse_request(request)
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    logger.info({"message": params["chat_message"], "application_mode": params["mode"], "genre": params["mode_2"]})
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson; charset=utf-8"})
+    await response.prepare(request)
+    try:
+        # 接続が切れた場合も、ストリーミングの購読をすぐに終了する（購読者が全員いなくなれば生成も取り消される）
+        async with aclosing(engine.astream(**params)) as events:
+            async for event in events:
+                await response.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+    except ConnectionResetError:
+        logging.getLogger(ct.LOGGER_NAME).info("クライアントとの接続が切れたため、回答生成を打ち切りました")
+        return response
+    except Exception as e:
+        logger.error(f"{ct.GET_LLM_RESPONSE_ERROR_MESSAGE}\n{e}")
+        error = {"event": "error", "message": ct.GET_LLM_RESPONSE_ERROR_MESSAGE}
+        await response.write((json.dumps(error, ensure_ascii=False) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def handle_metrics(request):
+    """
+    GET /metrics: 処理時間・トークン数の集計結果を返す
+    """
+    return web.json_response(metrics.snapshot(), dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+
+async def handle_health(request):
+    """
+    GET /health: 稼働確認
+    """
+    return web.json_response({"status": "ok"})
+
+
+async def _warm_up(app):
+    """
+    起動時に共有リソースを作成（最初のリクエストの待ち時間を減らすため）
+    """
+    await asyncio.get_running_loop().run_in_executor(None, engine.warm_up)
+
+
+def create_app():
+    """
+    APIサーバーのアプリケーションを作成
+
+    Returns:
+        aiohttpのアプリケーション
+    """
+    app_logging.setup_logger()
+    app_logging.setup_span_logger()
+
+    app = web.Application()
+    app.router.add_post("/ask", handle_ask)
+    app.router.add_post("/ask/stream", handle_ask_stream)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/health", handle_health)
+    app.on_startup.append(_warm_up)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="相談エンジンのHTTP APIサーバーを起動します。")
+    parser.add_argument("--host", default=ct.ENGINE_API_HOST)
+    parser.add_argument("--port", type=int, default=ct.ENGINE_API_PORT)
+    args = parser.parse_args()
+
+    # クライアントとの接続が切れた場合は、処理中のハンドラーを中断する（回答生成の取り消しにつながる）
+    web.run_app(create_app(), host=args.host, port=args.port, handler_cancellation=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+このファイルは、ログ出力の仕組み（キュー経由の非同期書き込み・セッションIDの付与・大きなペイロードの分離）が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import atexit
+import queue
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# 実行中のスクリプト（スレッド）ごとのセッションID
+# Streamlitはセッションごとに別スレッドでスクリプトを実行するため、ContextVarで保持すれば他セッションと混ざらない
+_session_id_var = contextvars.ContextVar("session_id", default="-")
+
+# バックグラウンドでファイル書き込みを行うリスナー（出力先のロガーごとに1つ）
+_listeners = []
+
+
+############################################################
+# クラス定義
+############################################################
+
+class SessionIdFilter(logging.Filter):
+    """
+    ログレコードに、出力した時点のセッションIDを付与するフィルター
+    """
+    def filter(self, record):
+        if not hasattr(record, "session_id"):
+            record.session_id = _session_id_var.get()
+        return True
+
+
+class LargePayloadFilter(logging.Filter):
+    """
+    上限文字数を超えるメッセージのみを通すフィルター（ペイロード用ログファイル向け）
+    """
+    def filter(self, record):
+        return len(record.getMessage()) > ct.LOG_MAX_MESSAGE_LENGTH
+
+
+class TruncateFilter(logging.Filter):
+    """
+    上限文字数を超えるメッセージを切り詰めるフィルター（通常のログファイル向け）
+
+    ユーザーの質問のレコード（{"message": 質問, ...}）は、ログの集計・FAQの抽出で解析するため切り詰めない
+    """
+    def filter(self, record):
+        if isinstance(record.msg, dict) and isinstance(record.msg.get("message"), str):
+            return True
+        message = record.getMessage()
+        if len(message) > ct.LOG_MAX_MESSAGE_LENGTH:
+            omitted = len(message) - ct.LOG_MAX_MESSAGE_LENGTH
+            record.msg = f"{message[:ct.LOG_MAX_MESSAGE_LENGTH]}...（{omitted}文字省略、全文は{ct.LOG_PAYLOAD_FILE}に出力）"
+            record.args = None
+        return True
+
+
+############################################################
+# 関数定義
+############################################################
+
+def set_session_id(session_id):
+    """
+    現在のスクリプト実行に紐づくセッションIDを設定
+
+    Args:
+        session_id: ログに出力するセッションID
+    """
+    _session_id_var.set(session_id)
+
+
+def get_session_id():
+    """
+    現在のスクリプト実行に紐づくセッションIDを取得
+
+    Returns:
+        セッションID（未設定の場合は「-」）
+    """
+    return _session_id_var.get()
+
+
+def stop_logger():
+    """
+    キューに残っているログを書き出し、バックグラウンドの書き込みスレッドを停止
+    """
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def _attach_queue_listener(logger, *handlers):
+    """
+    ロガーにキュー用のハンドラーを設定し、指定のハンドラーへの書き込みをバックグラウンドで行うリスナーを起動
+
+    Args:
+        logger: 設定対象のロガー
+        handlers: バックグラウンドで実行するハンドラー（指定順に処理される）
+
+    Returns:
+        ロガーに追加したキュー用のハンドラー
+    """
+    log_queue = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # プロセス終了時にキューに残ったログを書き出す
+    if not _listeners:
+        atexit.register(stop_logger)
+    _listeners.append(listener)
+
+    logger.addHandler(queue_handler)
+    return queue_handler
+
+
+def setup_logger():
+    """
+    アプリ用ロガーの設定（プロセス内で1回だけ実行される）
+
+    呼び出し元のスレッドではキューにレコードを積むだけとし、
+    ファイルへの書き込みはQueueListenerのバックグラウンドスレッドで行う
+
+    Returns:
+        アプリ用ロガー
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    # すでにキュー用のハンドラーが設定済みの場合、同じログ出力が複数回行われないよう処理を中断する
+    if any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+        return logger
+
+    # 指定のログフォルダが存在すれば読み込み、存在しなければ新規作成
+    os.makedirs(ct.LOG_DIR_PATH, exist_ok=True)
+
+    # セッションIDはフォーマット文字列に埋め込まず、レコードごとに付与された値を出力する
+    formatter = logging.Formatter(ct.LOG_FORMAT)
+
+    # 1日単位でログファイルの中身をリセットし、切り替える設定
+    log_handler = TimedRotatingFileHandler(
+        os.path.join(ct.LOG_DIR_PATH, ct.LOG_FILE),
+        when="D",
+        encoding="utf8"
+    )
+    log_handler.setFormatter(formatter)
+    log_handler.addFilter(TruncateFilter())
+
+    # 回答本文などの大きなペイロードは別ファイルに全文を出力
+    payload_handler = TimedRotatingFileHandler(
+        os.path.join(ct.LOG_DIR_PATH, ct.LOG_PAYLOAD_FILE),
+        when="D",
+        encoding="utf8"
+    )
+    payload_handler.setFormatter(formatter)
+    payload_handler.addFilter(LargePayloadFilter())
+
+    # ログレベルを「INFO」に設定
+    logger.setLevel(logging.INFO)
+
+    # 呼び出し元スレッドではセッションIDの付与とキューへの投入のみを行う
+    # TruncateFilterはレコードを書き換えるため、ペイロード用のハンドラーを先に処理させる
+    queue_handler = _attach_queue_listener(logger, payload_handler, log_handler)
+    queue_handler.addFilter(SessionIdFilter())
+
+    return logger
+
+
+def setup_span_logger():
+    """
+    計測結果（スパン）をJSONL形式で出力するロガーの設定（プロセス内で1回だけ実行される）
+
+    Returns:
+        スパン出力用ロガー
+    """
+    logger = logging.getLogger(ct.SPAN_LOGGER_NAME)
+
+    if any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+        return logger
+
+    os.makedirs(ct.LOG_DIR_PATH, exist_ok=True)
+
+    # 1行に1スパンのJSONのみを出力する
+    span_handler = TimedRotatingFileHandler(
+        os.path.join(ct.LOG_DIR_PATH, ct.SPAN_LOG_FILE),
+        when="D",
+        encoding="utf8"
+    )
+    span_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    logger.setLevel(logging.INFO)
+    # アプリ用のログに混ざらないよう、親ロガーには伝播させない
+    logger.propagate = False
+    _attach_queue_listener(logger, span_handler)
+
+    return logger
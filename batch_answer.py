@@ -0,0 +1,213 @@
+"""
+このファイルは、用意した質問を一括で回答させるバッチ処理のコマンドです。
+
+入力ファイル（JSONL）の1行ごとに {"mode": お悩み種別, "mode_2": ジャンル, "message": 質問} を記載します。
+任意で「id」（レコードの識別子）と「history」（会話ログ）も指定できます。
+画面からの質問と同じ処理（utils.get_llm_responseと同じ相談エンジン）で回答を生成し、
+回答・処理時間・トークン数（プロンプトキャッシュが効いた入力トークン数を含む）を1件ずつ出力ファイル（JSONL）に追記します。
+
+出力ファイルにすでに回答済みのレコードがある場合は、再実行時にスキップします。
+
+使い方:
+    python batch_answer.py questions.jsonl answers.jsonl --workers 4 --rpm 60
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+import constants as ct
+import app_logging
+import metrics
+import engine
+from rate_limiter import TokenBucket
+
+
+############################################################
+# 設定関連
+############################################################
+# 「.env」ファイルで定義した環境変数の読み込み
+load_dotenv()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def record_id(record):
+    """
+    レコードの識別子を取得（「id」が未指定の場合は、お悩み種別・ジャンル・質問から算出）
+
+    Args:
+        record: 入力レコード
+
+    Returns:
+        識別子の文字列
+    """
+    if record.get("id") is not None:
+        return str(record["id"])
+    key = json.dumps([record.get("mode", ""), record.get("mode_2", ""), record.get("message", "")], ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def load_records(input_path):
+    """
+    入力ファイルを1行ずつ読み込む
+
+    Args:
+        input_path: 入力ファイル（JSONL）のパス
+
+    Yields:
+        入力レコード
+    """
+    with open(input_path, encoding="utf8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if not record.get("message"):
+                raise ValueError(f"{input_path}:{line_no} に「message」がありません。")
+            yield record
+
+
+def load_done_ids(output_path):
+    """
+    出力ファイルから、回答済み（エラーなし）のレコードの識別子を読み込む
+
+    Args:
+        output_path: 出力ファイル（JSONL）のパス
+
+    Returns:
+        回答済みの識別子の集合
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # 前回の実行が書き込み途中で中断された行は無視する
+                continue
+            if not result.get("error"):
+                done.add(result["id"])
+    return done
+
+
+def answer_record(record, limiter):
+    """
+    1件の質問に回答し、結果を作成
+
+    Args:
+        record: 入力レコード
+        limiter: リクエスト数のレートリミッター（未使用の場合はNone）
+
+    Returns:
+        出力レコード
+    """
+    mode = record.get("mode") or ""
+    mode_2 = record.get("mode_2") or ""
+    result = {
+        "id": record_id(record),
+        "mode": mode,
+        "mode_2": mode_2,
+        "message": record["message"],
+    }
+    # ログ上でバッチ処理のリクエストと分かるよう、レコードの識別子をセッションIDとして設定
+    app_logging.set_session_id(f"batch-{result['id']}")
+
+    if limiter is not None:
+        limiter.acquire()
+
+    start = time.perf_counter()
+    with metrics.request_trace(mode, mode_2) as trace:
+        try:
+            result["answer"] = engine.ask(record["message"], mode=mode, mode_2=mode_2, messages=record.get("history"))
+            result["error"] = None
+        except Exception as e:
+            result["answer"] = None
+            result["error"] = f"{type(e).__name__}: {e}"
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    result["llm_calls"] = trace.llm_calls
+    result["prompt_tokens"] = trace.prompt_tokens
+    result["completion_tokens"] = trace.completion_tokens
+    result["cached_tokens"] = trace.cached_tokens
+    result["cost_usd"] = round(trace.cost_usd, 6)
+    result["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    return result
+
+
+def run_batch(input_path, output_path, workers, rpm):
+    """
+    入力ファイルの質問に一括で回答し、結果を出力ファイルに追記
+
+    Args:
+        input_path: 入力ファイル（JSONL）のパス
+        output_path: 出力ファイル（JSONL）のパス
+        workers: 同時に処理する件数
+        rpm: 1分あたりに開始する質問数の上限（0以下の場合は制限なし）
+
+    Returns:
+        (処理件数, エラー件数, スキップ件数)
+    """
+    done = load_done_ids(output_path)
+    pending = {}
+    skipped = 0
+    for record in load_records(input_path):
+        rid = record_id(record)
+        if rid in done or rid in pending:
+            skipped += 1
+            continue
+        pending[rid] = record
+
+    limiter = TokenBucket(rpm, capacity=max(1, min(workers, rpm))) if rpm > 0 else None
+    write_lock = threading.Lock()
+    processed = 0
+    errors = 0
+
+    # 回答生成前に共有リソースを作成しておく（各ワーカーで同時に作成しないように）
+    engine.warm_up()
+
+    with open(output_path, "a", encoding="utf8") as output, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(answer_record, record, limiter) for record in pending.values()]
+        for future in as_completed(futures):
+            result = future.result()
+            # 中断されても完了済みの結果が残るよう、1件ごとに書き込む
+            with write_lock:
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+            processed += 1
+            if result["error"]:
+                errors += 1
+            print(f"[{processed}/{len(pending)}] {result['id']} {result['latency_ms']:.0f}ms {'ERROR ' + result['error'] if result['error'] else 'OK'}")
+
+    return processed, errors, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONLファイルの質問に一括で回答します。")
+    parser.add_argument("input", help="質問を記載した入力ファイル（JSONL）")
+    parser.add_argument("output", help="回答を追記する出力ファイル（JSONL）")
+    parser.add_argument("--workers", type=int, default=ct.BATCH_DEFAULT_WORKERS, help="同時に処理する件数")
+    parser.add_argument("--rpm", type=int, default=ct.BATCH_DEFAULT_RPM, help="1分あたりに開始する質問数の上限（0で制限なし）")
+    args = parser.parse_args()
+
+    app_logging.setup_logger()
+    app_logging.setup_span_logger()
+
+    processed, errors, skipped = run_batch(args.input, args.output, max(1, args.workers), args.rpm)
+    print(f"完了: 処理 {processed}件（エラー {errors}件）、回答済みのためスキップ {skipped}件")
+
+
+if __name__ == "__main__":
+    main()
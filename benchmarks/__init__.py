@@ -0,0 +1,5 @@
+"""
+このパッケージは、外部API（OpenAI・SerpAPI・Wikipedia）を呼び出さずに性能を計測するためのベンチマーク類をまとめたものです。
+
+リポジトリのルートディレクトリから「python -m benchmarks.<モジュール名>」の形式で実行します。
+"""
@@ -0,0 +1,113 @@
+"""
+このファイルは、Agentの方式（ReAct形式・ツール呼び出し形式）ごとに、1ターンあたりのLLM呼び出し回数などを比較するスクリプトです。
+
+固定の質問セット（benchmarks/regression.py のシナリオ）を方式ごとに実行し、次の項目を表示・出力します。
+    - llm_calls: LLMの呼び出し回数（Agent・専門家AIの合計）
+    - agent_iterations: Agentの反復回数
+    - prompt_tokens: LLMに送信したトークン数
+
+ReAct形式で発生する書式エラーによる再試行は実際のモデルの出力でしか再現できないため、
+方式ごとに実際のAPIの応答をカセット（benchmarks/cassettes/<方式>/）に記録し、以降は記録を再生して比較します。
+
+使い方:
+    python -m benchmarks.agent_backends record
+    python -m benchmarks.agent_backends replay [--output 出力先]
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import argparse
+import tempfile
+from datetime import datetime
+from unittest import mock
+import constants as ct
+from benchmarks import regression
+from benchmarks.run_benchmarks import DEFAULT_RESULTS_DIR, git_commit
+
+
+############################################################
+# 変数定義
+############################################################
+BACKENDS = ["react", "tool_calling"]
+METRICS = ["llm_calls", "agent_iterations", "prompt_tokens"]
+
+
+############################################################
+# 関数定義
+############################################################
+
+def run_backend(backend, cassette_mode, cassette_dir):
+    """
+    1つの方式で全シナリオを実行
+
+    Args:
+        backend: Agentの方式
+        cassette_mode: 「record」または「replay」
+        cassette_dir: カセットの保存先（この下に方式ごとのディレクトリを作成）
+
+    Returns:
+        シナリオ名をキーとした計測結果の辞書
+    """
+    with mock.patch.object(ct, "AGENT_BACKEND", backend):
+        if cassette_mode == "record":
+            regression.prepare_vector_stores()
+        return {
+            name: regression.run_scenario(name, os.path.join(cassette_dir, backend), cassette_mode)
+            for name in regression.SCENARIOS
+        }
+
+
+def run(args):
+    """
+    全方式でシナリオを実行し、比較結果を表示・出力
+
+    Args:
+        args: コマンドライン引数
+
+    Returns:
+        計測結果
+    """
+    with tempfile.TemporaryDirectory() as work_dir, \
+            mock.patch.object(ct, "LOG_DIR_PATH", os.path.join(work_dir, "logs")), \
+            mock.patch.object(ct, "METRICS_SERVER_ENABLED", False):
+        results = {backend: run_backend(backend, args.mode, args.cassette_dir) for backend in BACKENDS}
+
+    print(f"{'scenario.metric':<40}" + "".join(f"{backend:>14}" for backend in BACKENDS))
+    for name in regression.SCENARIOS:
+        for metric in METRICS:
+            print(f"{name + '.' + metric:<40}" + "".join(f"{results[backend][name][metric]:>14}" for backend in BACKENDS))
+    per_turn = {
+        backend: {metric: round(sum(r[metric] for r in results[backend].values()) / len(regression.SCENARIOS), 3) for metric in METRICS}
+        for backend in BACKENDS
+    }
+    for metric in METRICS:
+        print(f"{'per_turn.' + metric:<40}" + "".join(f"{per_turn[backend][metric]:>14}" for backend in BACKENDS))
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "mode": args.mode,
+        "per_turn": per_turn,
+        "results": results,
+    }
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"agent-backends-{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"比較結果を出力しました: {output}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agentの方式ごとに、1ターンあたりのLLM呼び出し回数を比較します。")
+    parser.add_argument("mode", choices=["record", "replay"], help="記録するか、記録済みの応答を再生するか")
+    parser.add_argument("--cassette-dir", default=regression.DEFAULT_CASSETTE_DIR, help="カセットの保存先")
+    parser.add_argument("--output", help="結果の出力先（未指定の場合は benchmarks/results/agent-backends-<コミットID>.json）")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+このファイルは、外部API（OpenAIのLLM・埋め込み・Whisper、SerpAPI、Wikipedia）へのリクエストとレスポンスを
+ファイル（カセット）に記録し、再生するための仕組みが記述されたファイルです。
+
+    - record: 実際のAPIにリクエストを送り、リクエストとレスポンスをカセットに記録する
+    - replay: カセットに記録されたレスポンスを返し、ネットワークには接続しない
+
+OpenAI APIへのリクエストは rate_limiter のHTTPクライアント（httpx）を、
+SerpAPI・Wikipediaへのリクエストは requests の送信処理を差し替えて捕捉します。
+リクエストは「メソッド・URL・本文のハッシュ」で照合し、一致するものがない場合は、
+同じエンドポイントへの記録を順に返します（プロンプトの変更などで一致しなくなったリクエストの件数は unmatched に記録します）。
+APIキーはカセットに記録しません。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import json
+import time
+import base64
+import hashlib
+import threading
+from contextlib import ExitStack, contextmanager
+from collections import Counter, defaultdict, deque
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from unittest import mock
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import rate_limiter
+
+
+############################################################
+# 変数定義
+############################################################
+# カセットに記録しないクエリパラメーター（APIキーなど）
+SECRET_PARAMS = {"api_key", "key", "token", "access_token"}
+# 記録するレスポンスヘッダー（本文は展開済みで記録するため、圧縮・長さ関連のヘッダーは記録しない）
+RECORDED_HEADERS = {"content-type"}
+
+
+############################################################
+# クラス定義
+############################################################
+
+class MissingInteractionError(Exception):
+    """
+    再生時に、カセットに対応する記録がないリクエストが送られた場合のエラー
+    """
+
+
+class Cassette:
+    """
+    1シナリオ分のリクエストとレスポンスの記録
+    """
+    def __init__(self, path, mode):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"modeには「record」または「replay」を指定してください: {mode}")
+        self.path = path
+        self.mode = mode
+        self.interactions = []
+        # 外部APIの応答待ちに費やした時間（ローカル処理の時間を算出するために使う）
+        self.io_seconds = 0.0
+        # エンドポイントごとのリクエスト数（記録・再生のどちらでも数える）
+        self.calls = Counter()
+        self.unmatched = 0
+        self._lock = threading.Lock()
+        self._by_key = defaultdict(deque)
+        self._by_endpoint = defaultdict(deque)
+
+        if mode == "replay":
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"カセットがありません。先にrecordモードで記録してください: {path}")
+            with open(path, encoding="utf8") as f:
+                self.interactions = json.load(f)["interactions"]
+            for interaction in self.interactions:
+                request = interaction["request"]
+                self._by_key[request["key"]].append(interaction)
+                self._by_endpoint[request["endpoint"]].append(interaction)
+
+    def record(self, request, response):
+        """
+        リクエストとレスポンスを記録
+        """
+        with self._lock:
+            self.interactions.append({"request": request, "response": response})
+            self.calls[request["endpoint"]] += 1
+
+    def play(self, request):
+        """
+        リクエストに対応する記録済みのレスポンスを取得
+        """
+        with self._lock:
+            interaction = _next_unused(self._by_key.get(request["key"]))
+            if interaction is None:
+                # 本文まで一致する記録がない場合は、同じエンドポイントへの記録を順に返す
+                interaction = _next_unused(self._by_endpoint.get(request["endpoint"]))
+                if interaction is None:
+                    raise MissingInteractionError(f"カセットに記録がありません: {request['method']} {request['endpoint']}")
+                self.unmatched += 1
+            interaction["_used"] = True
+            self.calls[request["endpoint"]] += 1
+            return interaction["response"]
+
+    def add_io_time(self, seconds):
+        with self._lock:
+            self.io_seconds += seconds
+
+    def save(self):
+        """
+        記録をカセットファイルに書き込む（recordモードのみ）
+        """
+        if self.mode != "record":
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "w", encoding="utf8") as f:
+            json.dump({"interactions": self.interactions}, f, ensure_ascii=False, indent=1)
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """
+    OpenAI APIへのリクエストを記録・再生するhttpxのトランスポート
+    """
+    def __init__(self, cassette, transport=None):
+        self._cassette = cassette
+        self._transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        recorded = describe_request(request.method, str(request.url), request.read(), request.headers.get("content-type", ""))
+        if self._cassette.mode == "replay":
+            return _to_httpx_response(self._cassette.play(recorded))
+
+        start = time.perf_counter()
+        response = self._transport.handle_request(request)
+        response.read()
+        self._cassette.add_io_time(time.perf_counter() - start)
+        stored = _store_response(response.status_code, response.headers, response.content)
+        self._cassette.record(recorded, stored)
+        return _to_httpx_response(stored)
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    """
+    CassetteTransportの非同期版
+    """
+    def __init__(self, cassette, transport=None):
+        self._cassette = cassette
+        self._transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        body = await request.aread()
+        recorded = describe_request(request.method, str(request.url), body, request.headers.get("content-type", ""))
+        if self._cassette.mode == "replay":
+            return _to_httpx_response(self._cassette.play(recorded))
+
+        start = time.perf_counter()
+        response = await self._transport.handle_async_request(request)
+        await response.aread()
+        self._cassette.add_io_time(time.perf_counter() - start)
+        stored = _store_response(response.status_code, response.headers, response.content)
+        self._cassette.record(recorded, stored)
+        return _to_httpx_response(stored)
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _next_unused(queue):
+    """
+    キューから、まだ再生していない記録を取り出す
+    """
+    while queue:
+        interaction = queue.popleft()
+        if not interaction.get("_used"):
+            return interaction
+    return None
+
+
+def _strip_secrets(url):
+    """
+    URLからAPIキーなどのクエリパラメーターを取り除き、残りを並べ替える
+    """
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in SECRET_PARAMS)
+    return parts._replace(query=urlencode(query)).geturl()
+
+
+def describe_request(method, url, body, content_type):
+    """
+    照合用にリクエストの内容を整理
+
+    Args:
+        method: HTTPメソッド
+        url: URL
+        body: リクエスト本文（バイト列）
+        content_type: Content-Typeヘッダー
+
+    Returns:
+        記録用のリクエストの辞書（method, endpoint, url, key, body）
+    """
+    url = _strip_secrets(url)
+    body = body or b""
+    parts = urlsplit(url)
+    endpoint = f"{parts.netloc}{parts.path}"
+
+    if "application/json" in content_type:
+        # JSONはキーの順序に左右されないよう整形してから照合する
+        try:
+            body_text = json.dumps(json.loads(body), ensure_ascii=False, sort_keys=True)
+        except ValueError:
+            body_text = body.decode("utf-8", errors="replace")
+    elif "multipart/form-data" in content_type:
+        # multipartの境界文字列はリクエストごとに変わるため、固定の文字列に置き換えてから照合する
+        match = re.search(r"boundary=([^;]+)", content_type)
+        if match:
+            body = body.replace(match.group(1).strip('"').encode(), b"BOUNDARY")
+        body_text = None
+    else:
+        body_text = body.decode("utf-8", errors="replace") if body else ""
+
+    digest = hashlib.sha256(body_text.encode("utf-8") if body_text is not None else body).hexdigest()
+    return {
+        "method": method,
+        "endpoint": endpoint,
+        "url": url,
+        "key": f"{method} {url} {digest}",
+        # 音声ファイルなどのバイナリは記録しない
+        "body": body_text,
+    }
+
+
+def _store_response(status_code, headers, content):
+    """
+    記録用にレスポンスを整理（本文はテキストならそのまま、バイナリならBase64で記録）
+    """
+    stored = {
+        "status": status_code,
+        "headers": {k.lower(): v for k, v in headers.items() if k.lower() in RECORDED_HEADERS},
+    }
+    try:
+        stored["text"] = content.decode("utf-8")
+    except UnicodeDecodeError:
+        stored["base64"] = base64.b64encode(content).decode("ascii")
+    return stored
+
+
+def _stored_content(stored):
+    if "text" in stored:
+        return stored["text"].encode("utf-8")
+    return base64.b64decode(stored["base64"])
+
+
+def _to_httpx_response(stored):
+    return httpx.Response(stored["status"], headers=stored["headers"], content=_stored_content(stored))
+
+
+def _to_requests_response(stored, request):
+    response = requests.Response()
+    response.status_code = stored["status"]
+    response.headers = CaseInsensitiveDict(stored["headers"])
+    response._content = _stored_content(stored)
+    response.url = request.url
+    response.request = request
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers) or "utf-8"
+    return response
+
+
+@contextmanager
+def use_cassette(path, mode):
+    """
+    ブロック内の外部APIへのリクエストを、カセットに記録または再生する
+
+    Args:
+        path: カセットファイルのパス
+        mode: 「record」または「replay」
+
+    Yields:
+        Cassette
+    """
+    import engine
+
+    cassette = Cassette(path, mode)
+    original_send = HTTPAdapter.send
+
+    def send(adapter, request, **kwargs):
+        body = request.body.encode("utf-8") if isinstance(request.body, str) else request.body
+        recorded = describe_request(request.method, request.url, body, request.headers.get("Content-Type", ""))
+        if cassette.mode == "replay":
+            return _to_requests_response(cassette.play(recorded), request)
+
+        start = time.perf_counter()
+        response = original_send(adapter, request, **kwargs)
+        content = response.content
+        cassette.add_io_time(time.perf_counter() - start)
+        stored = _store_response(response.status_code, response.headers, content)
+        cassette.record(recorded, stored)
+        return _to_requests_response(stored, request)
+
+    http_client = httpx.Client(transport=CassetteTransport(cassette), timeout=None)
+    http_async_client = httpx.AsyncClient(transport=AsyncCassetteTransport(cassette), timeout=None)
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(rate_limiter, "_http_client", http_client))
+        stack.enter_context(mock.patch.object(rate_limiter, "_http_async_client", http_async_client))
+        stack.enter_context(mock.patch.object(HTTPAdapter, "send", send))
+        # 作成済みのLLMは差し替え前のHTTPクライアントを保持しているため、作り直させる
+        engine.reset_resources()
+        try:
+            yield cassette
+        finally:
+            engine.reset_resources()
+    http_client.close()
+    cassette.save()
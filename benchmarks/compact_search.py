@@ -0,0 +1,165 @@
+"""
+このファイルは、圧縮インデックス（compact_index.py）の次元数ごとに、インデックスの大きさ・検索時間・検索精度を、元の次元のインデックスと比較するスクリプトです。
+
+会社法のベクトルストア（移行済みの場合は保存済みの元のベクトル）から、次元数ごとに一時ディレクトリへ圧縮インデックスを作成し、
+retrieval_sweep と同じ正解データ・評価（retrieval_sweep.evaluate）で次の項目を計測します。
+    - index_mb: メモリ上に保持するインデックスの大きさ（圧縮インデックスでは、ディスク上の元の次元のベクトルを含まない）
+    - index_search: クエリのベクトルでのインデックスの検索1回あたりの処理時間（埋め込み・チャンクの取得を含まない）
+    - recall / recall_retained: recall@k と、元の次元のインデックスのrecall@kに対する割合
+    - search: retrieval._searchでの検索1回あたりの処理時間（retrieval_sweepと同じ）
+
+使い方:
+    python -m benchmarks.compact_search [--dims 128 256 512] [--method pca] [--ks 3 5 8]
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import time
+import argparse
+import tempfile
+from datetime import datetime
+from unittest import mock
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+from langchain_community.vectorstores import FAISS
+import constants as ct
+import compact_index
+import retrieval
+from benchmarks.retrieval_sweep import DEFAULT_CACHE_DIR, DEFAULT_GOLD_PATH, cached_embeddings, evaluate, load_gold
+from benchmarks.run_benchmarks import DEFAULT_RESULTS_DIR, git_commit, summarize
+
+
+############################################################
+# 設定関連
+############################################################
+# 「.env」ファイルで定義した環境変数の読み込み
+load_dotenv()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def bench_index_search(index, query_vectors, k, repeat):
+    """
+    インデックスの検索だけの処理時間を計測
+
+    Args:
+        index: FAISSのインデックス、または圧縮インデックス
+        query_vectors: 検索クエリのベクトル（件数 × 元の次元）
+        k: 取得件数
+        repeat: クエリごとに検索を繰り返す回数
+
+    Returns:
+        処理時間の代表値
+    """
+    latencies = []
+    for vector in query_vectors:
+        vector = vector.reshape(1, -1)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            index.search(vector, k)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return summarize(latencies)
+
+
+def run(args):
+    """
+    元の次元のインデックスと、次元数ごとの圧縮インデックスを評価し、結果を表示・出力
+
+    Args:
+        args: コマンドライン引数
+
+    Returns:
+        計測結果
+    """
+    gold = load_gold(args.gold)
+    embeddings = cached_embeddings(args.cache_dir)
+    store_path = ct.CORPORA[ct.COMPANY_LAW_CORPUS_ID]["store_path"]
+
+    full_vectors, inner_product = compact_index.read_full_vectors(store_path)
+    full_vectors = np.ascontiguousarray(full_vectors, dtype=np.float32)
+    full_index = faiss.IndexFlatIP(full_vectors.shape[1]) if inner_product else faiss.IndexFlatL2(full_vectors.shape[1])
+    full_index.add(full_vectors)
+
+    configs = []
+    # 検索時のクエリの埋め込みにも、キャッシュ付きの埋め込みモデルを使う
+    with mock.patch.object(retrieval, "_embeddings", embeddings):
+        vector_store = FAISS.load_local(store_path, embeddings, allow_dangerous_deserialization=True)
+        query_vectors = np.asarray(embeddings.embed_documents([item["question"] for item in gold]), dtype=np.float32)
+        if vector_store._normalize_L2:
+            faiss.normalize_L2(query_vectors)
+
+        print(f"元の次元のインデックスを評価します（{full_vectors.shape[1]}次元）")
+        vector_store.index = full_index
+        baseline = evaluate(vector_store, gold, args.ks, args.repeat)
+        for k, result in baseline.items():
+            configs.append({
+                "method": "full",
+                "dims": full_vectors.shape[1],
+                "k": k,
+                "index_mb": round(full_vectors.nbytes / 1024 / 1024, 2),
+                "index_search": bench_index_search(full_index, query_vectors, k, args.repeat),
+                "recall_retained": 1.0,
+                **result,
+            })
+
+        for dims in args.dims:
+            print(f"圧縮インデックスを評価します（{args.method}, {dims}次元）")
+            with tempfile.TemporaryDirectory() as directory:
+                compact_index.write(directory, full_vectors, dims, args.method, inner_product)
+                index = compact_index.load(directory, args.rescore_factor)
+                vector_store.index = index
+                for k, result in evaluate(vector_store, gold, args.ks, args.repeat).items():
+                    configs.append({
+                        "method": args.method,
+                        "dims": dims,
+                        "k": k,
+                        "index_mb": round(index.nbytes / 1024 / 1024, 2),
+                        "index_search": bench_index_search(index, query_vectors, k, args.repeat),
+                        "recall_retained": round(result["recall"] / baseline[k]["recall"], 4) if baseline[k]["recall"] else None,
+                        **result,
+                    })
+
+    print(f"{'method':>8} {'dims':>5} {'k':>3} {'index_mb':>9} {'recall':>7} {'retained':>8} {'mrr':>7} "
+          f"{'idx_p50':>8} {'search_p50':>10}")
+    for c in configs:
+        print(f"{c['method']:>8} {c['dims']:>5} {c['k']:>3} {c['index_mb']:>9} {c['recall']:>7} {c['recall_retained']:>8} "
+              f"{c['mrr']:>7} {c['index_search']['p50_ms']:>8} {c['search']['p50_ms']:>10}")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "gold": args.gold,
+        "questions": len(gold),
+        "chunks": len(full_vectors),
+        "rescore_factor": args.rescore_factor,
+        "configs": configs,
+    }
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"compact-search-{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"評価結果を出力しました: {output}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="圧縮インデックスの次元数ごとに、インデックスの大きさ・検索時間・検索精度を評価します。")
+    parser.add_argument("--gold", default=DEFAULT_GOLD_PATH, help="正解データ（質問と条文の対応）のパス")
+    parser.add_argument("--dims", nargs="+", type=int, default=[128, 256, 512], help="評価する次元数")
+    parser.add_argument("--method", choices=compact_index.METHODS, default=ct.COMPACT_METHOD, help="次元削減の方法")
+    parser.add_argument("--rescore-factor", type=int, default=ct.COMPACT_RESCORE_FACTOR, help="再スコアリングする候補数（取得件数の倍数）")
+    parser.add_argument("--ks", nargs="+", type=int, default=[3, 5, 8], help="評価する取得件数")
+    parser.add_argument("--repeat", type=int, default=5, help="処理時間の計測で、質問ごとに検索を繰り返す回数")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="埋め込みのキャッシュの保存先")
+    parser.add_argument("--output", help="結果の出力先（未指定の場合は benchmarks/results/compact-search-<コミットID>.json）")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
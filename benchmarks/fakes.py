@@ -0,0 +1,384 @@
+"""
+このファイルは、ベンチマーク用にOpenAI・SerpAPI・Wikipediaを置き換える、決定的な（毎回同じ結果を返す）ローカルの代替実装が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import json
+import time
+import hashlib
+import threading
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+import numpy as np
+import streamlit as st
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# ジャンルごとに、代替LLMが選択するTool名
+GENRE_TOOL_NAMES = {
+    ct.ANSWER_MODE_3: ct.MARKETING_STRATEGY_NAME,
+    ct.ANSWER_MODE_4: ct.SALES_STRATEGY_TEMPLATE_NAME,
+    ct.ANSWER_MODE_5: ct.RECRUITMENT_STRATEGY_TEMPLATE_NAME,
+    ct.ANSWER_MODE_6: ct.ORGANIZATIONAL_STRATEGY_TEMPLATE_NAME,
+    ct.ANSWER_MODE_7: ct.BUSINESS_IMPROVEMENT_NAME,
+    ct.ANSWER_MODE_8: ct.PHYSICAL_HEALTH_TEMPLATE_NAME,
+    ct.ANSWER_MODE_9: ct.MENTAL_HEALTH_TEMPLATE_NAME,
+    ct.ANSWER_MODE_10: ct.COMPANY_LAW_NAME,
+}
+
+
+############################################################
+# クラス定義
+############################################################
+
+class LatencyConfig:
+    """
+    代替実装が応答までに待機する時間の設定（秒）
+    """
+    def __init__(self, llm=0.0, llm_per_token=0.0, embedding=0.0, embedding_per_text=0.0, search=0.0, answer_tokens=200):
+        self.llm = llm
+        self.llm_per_token = llm_per_token
+        self.embedding = embedding
+        self.embedding_per_text = embedding_per_text
+        self.search = search
+        self.answer_tokens = answer_tokens
+
+
+class CallCounter:
+    """
+    代替実装ごとの呼び出し回数のカウンター（スレッドセーフ）
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        # 待機によって再現した外部APIの応答時間の合計（秒）
+        self.simulated_seconds = 0.0
+
+    def increment(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def simulate(self, seconds):
+        """
+        外部APIの応答時間を待機で再現し、合計に加算
+        """
+        if seconds > 0:
+            time.sleep(seconds)
+            with self._lock:
+                self.simulated_seconds += seconds
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+            self.simulated_seconds = 0.0
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    ChatOpenAIの代替となる決定的なチャットモデル（応答内容はfake_replyを参照）
+    """
+    model_name: str = "fake-chat-model"
+    temperature: float = 0.0
+    streaming: bool = False
+    latency: float = 0.0
+    per_token_latency: float = 0.0
+    answer_tokens: int = 200
+
+    @property
+    def _llm_type(self):
+        return "fake-chat-model"
+
+    def bind_tools(self, tools, **kwargs):
+        # ツール呼び出し形式のAgentから渡されたToolを、呼び出し時の引数として受け取る
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages, kwargs.get("tools"))
+        counter.simulate(self.latency + self.per_token_latency * len(message.content))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages, kwargs.get("tools"))
+        # 最初のトークンまでの待機時間を再現
+        counter.simulate(self.latency)
+        if message.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"], ensure_ascii=False), "id": call["id"], "index": i}
+                for i, call in enumerate(message.tool_calls)
+            ]))
+            return
+        for piece in re.findall(r".{1,4}", message.content, flags=re.S):
+            counter.simulate(self.per_token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    def _respond(self, messages, tools=None):
+        counter.increment("llm")
+        prompt = "\n".join(str(m.content) for m in messages)
+        if tools:
+            has_tool_result = any(isinstance(m, ToolMessage) for m in messages)
+            return fake_tool_call_reply(prompt, has_tool_result, self.answer_tokens)
+        return AIMessage(content=fake_reply(prompt, self.answer_tokens))
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    OpenAIEmbeddingsの代替となる決定的な埋め込みモデル（テキストのハッシュから単位ベクトルを生成）
+    """
+    def __init__(self, latency=None, dimension=1536, **kwargs):
+        self.latency = latency or LatencyConfig()
+        self.dimension = dimension
+
+    def embed_documents(self, texts):
+        counter.increment("embedding")
+        counter.simulate(self.latency.embedding + self.latency.embedding_per_text * len(texts))
+        return [fake_embedding(text, self.dimension).tolist() for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class FakeSerpAPIWrapper:
+    """
+    SerpAPIWrapperの代替となるWeb検索
+    """
+    def __init__(self, latency=None, **kwargs):
+        self.latency = latency or LatencyConfig()
+
+    def run(self, query):
+        counter.increment("search")
+        counter.simulate(self.latency.search)
+        return f"【Web検索結果】{query} に関する検索結果の要約です。"
+
+
+class FakeSessionState(dict):
+    """
+    st.session_stateの代替（Streamlitのランタイム外でも属性アクセスで状態を保持する）
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class SessionStateRouter:
+    """
+    スレッドごとに別のst.session_stateの代替へ振り分けるプロキシ（複数セッションの同時実行を再現する）
+    """
+    def __init__(self):
+        object.__setattr__(self, "_local", threading.local())
+
+    def bind(self, session_state):
+        """
+        呼び出し元のスレッドで使うst.session_stateの代替を設定
+        """
+        self._local.state = session_state
+
+    def _state(self):
+        state = getattr(self._local, "state", None)
+        if state is None:
+            raise RuntimeError("このスレッドにはセッションが割り当てられていません。")
+        return state
+
+    def __getattr__(self, name):
+        return getattr(self._state(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._state(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._state(), name)
+
+    def __getitem__(self, key):
+        return self._state()[key]
+
+    def __setitem__(self, key, value):
+        self._state()[key] = value
+
+    def __contains__(self, key):
+        return key in self._state()
+
+    def get(self, key, default=None):
+        return self._state().get(key, default)
+
+
+# 代替実装の呼び出し回数（プロセス内で共有）
+counter = CallCounter()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _stable_hash(text):
+    """
+    実行ごとに変わらないハッシュ値を算出（組み込みのhashはプロセスごとに値が変わるため使わない）
+    """
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+
+
+def _fake_answer(seed, answer_tokens):
+    """
+    シード値から決定的な回答文を生成
+    """
+    sentence = f"回答{seed % 1000:03d}: 具体的な施策として、現状分析と目標設定を行い、段階的に実行します。"
+    repeat = max(1, answer_tokens // 30)
+    return "\n".join([sentence] * repeat)
+
+
+def fake_reply(prompt, answer_tokens):
+    """
+    プロンプトから、代替LLMの決定的な応答テキストを生成
+
+    - ReAct形式のプロンプトには、選択ジャンルに対応するToolを1回呼び出してから最終回答を返す
+    - それ以外のプロンプト（専門家AIのChain）には、入力から決定的に生成した回答を返す
+
+    Args:
+        prompt: LLMに渡されたメッセージを連結したテキスト
+        answer_tokens: 回答のおおよそのトークン数
+
+    Returns:
+        応答テキスト
+    """
+    seed = _stable_hash(prompt)
+
+    # ReAct形式のプロンプトの場合
+    if "Action Input" in prompt:
+        # 書式説明にも「Observation:」が含まれるため、質問文より後ろ（途中経過）だけを判定に使う
+        if "Observation:" in prompt.split("Question:")[-1]:
+            return f"Thought: I now know the final answer\nFinal Answer: {_fake_answer(seed, answer_tokens)}"
+        genre = re.search(r"\[選択ジャンル: (.+?)\]", prompt)
+        tool_name = GENRE_TOOL_NAMES.get(genre.group(1) if genre else "", ct.MARKETING_STRATEGY_NAME)
+        question = re.findall(r"ユーザー: (.+)", prompt)
+        action_input = question[-1] if question else "質問"
+        return f"Thought: 専門家に相談します\nAction: {tool_name}\nAction Input: {action_input}"
+
+    return _fake_answer(seed, answer_tokens)
+
+
+def fake_tool_call_reply(prompt, has_tool_result, answer_tokens):
+    """
+    ツール呼び出し形式のAgentに対する、代替LLMの決定的な応答を生成
+
+    - Toolの結果を受け取る前は、選択ジャンルに対応するToolを1回呼び出す
+    - Toolの結果を受け取った後は、最終回答を返す
+
+    Args:
+        prompt: LLMに渡されたメッセージを連結したテキスト
+        has_tool_result: メッセージにToolの結果が含まれているかどうか
+        answer_tokens: 回答のおおよそのトークン数
+
+    Returns:
+        AIMessage
+    """
+    seed = _stable_hash(prompt)
+    if has_tool_result:
+        return AIMessage(content=_fake_answer(seed, answer_tokens))
+
+    genre = re.search(r"\[選択ジャンル: (.+?)\]", prompt)
+    tool_name = GENRE_TOOL_NAMES.get(genre.group(1) if genre else "", ct.MARKETING_STRATEGY_NAME)
+    question = re.findall(r"ユーザー: (.+)", prompt)
+    return AIMessage(content="", tool_calls=[{
+        "name": tool_name,
+        "args": {"query": question[-1] if question else "質問"},
+        "id": f"call_{seed % 10 ** 8:08d}",
+    }])
+
+
+def fake_embedding(text, dimension=1536):
+    """
+    テキストのハッシュから決定的な単位ベクトルを生成
+
+    Args:
+        text: 埋め込み対象のテキスト
+        dimension: ベクトルの次元数
+
+    Returns:
+        単位ベクトル（float32のnumpy配列）
+    """
+    rng = np.random.default_rng(_stable_hash(text))
+    vector = rng.standard_normal(dimension).astype("float32")
+    return vector / np.linalg.norm(vector)
+
+
+def make_fake_wikipedia_search(latency):
+    """
+    run_wikipedia_searchの代替となるWikipedia検索関数を作成
+
+    Args:
+        latency: 待機時間の設定
+
+    Returns:
+        Wikipedia検索の代替関数
+    """
+    def fake_wikipedia_search(query):
+        counter.increment("wikipedia")
+        counter.simulate(latency.search)
+        return f"【Wikipedia】{query}\n{query}の概要です。\n\nURL: https://ja.wikipedia.org/wiki/{query}"
+    return fake_wikipedia_search
+
+
+@contextmanager
+def fake_backends(latency=None, session_state=None, replace_openai=True):
+    """
+    OpenAI・SerpAPI・Wikipediaの呼び出しと、st.session_stateを代替実装に置き換える
+
+    Args:
+        latency: 待機時間の設定
+        session_state: 使用するst.session_stateの代替（未指定の場合は新規作成）
+        replace_openai: Falseの場合、OpenAIのクライアントは置き換えない（ローカルの代替サーバーに接続する場合など）
+
+    Yields:
+        置き換えたst.session_stateの代替
+    """
+    import engine
+    import model_policy
+    import retrieval
+    import tools
+
+    latency = latency or LatencyConfig()
+    session_state = session_state if session_state is not None else FakeSessionState()
+
+    def chat_model_factory(**kwargs):
+        return FakeChatModel(
+            streaming=kwargs.get("streaming", False),
+            tags=kwargs.get("tags"),
+            latency=latency.llm,
+            per_token_latency=latency.llm_per_token,
+            answer_tokens=latency.answer_tokens,
+        )
+
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(st, "session_state", session_state))
+        if replace_openai:
+            stack.enter_context(mock.patch.object(model_policy, "ChatOpenAI", chat_model_factory))
+            stack.enter_context(mock.patch.object(retrieval, "OpenAIEmbeddings", lambda **kwargs: FakeEmbeddings(latency)))
+        stack.enter_context(mock.patch.object(tools, "SerpAPIWrapper", lambda **kwargs: FakeSerpAPIWrapper(latency)))
+        stack.enter_context(mock.patch.object(tools, "run_wikipedia_search", make_fake_wikipedia_search(latency)))
+        # プロセス内で共有しているリソースを、代替実装で作成し直す（終了時も破棄して元の実装に戻す）
+        engine.reset_resources()
+        stack.callback(engine.reset_resources)
+        yield session_state
@@ -0,0 +1,271 @@
+"""
+このファイルは、複数のStreamlitセッションを同時に再現し、ローカルのOpenAI API代替サーバーに対して負荷試験を行うツールです。
+
+各セッションは実際のアプリと同じく、st.session_stateにベクトルストア・Agent Executor・LLM・エンコーダーを保持した状態で、
+以下の操作（フロー）を繰り返します。
+
+    - mode_switch: お悩みの切り替え（会話履歴のクリア・ジャンルの初期化）
+    - text_question: テキストでの質問
+    - law_question: 会社法ジャンルでの質問（RAG検索を含む）
+    - voice_confirmation: 音声認識結果を確認して送信
+
+使い方:
+    python -m benchmarks.load_test --sessions 20 --iterations 3 --ttft 0.3 --output load_test.json
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import io
+import os
+import json
+import wave
+import time
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from unittest import mock
+import openai
+import streamlit as st
+import constants as ct
+import history_store
+import rate_limiter
+from benchmarks import fakes
+from benchmarks.mock_openai_server import MockOpenAIConfig, MockOpenAIServer
+from benchmarks.run_benchmarks import current_rss_bytes, git_commit, summarize
+
+
+############################################################
+# 変数定義
+############################################################
+TEXT_QUESTION = "ラーメン屋の販路拡大策を教えてください"
+LAW_QUESTION = "取締役会と監査役の関係について教えてください"
+FLOW_NAMES = ["mode_switch", "text_question", "law_question", "voice_confirmation"]
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _silent_wav(seconds=1.0, sample_rate=16000):
+    """
+    音声入力の代わりに送信する無音のWAVデータを作成
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b"\x00\x00" * int(seconds * sample_rate))
+    return buffer.getvalue()
+
+
+def _ask(chat_message):
+    """
+    main.pyのチャット送信時の処理（回答取得と会話ログへの追加）を再現
+    """
+    import utils
+
+    llm_response = utils.get_llm_response(chat_message)
+    st.session_state.history.append({"role": "user", "content": chat_message})
+    st.session_state.history.append({"role": "assistant", "content": {"mode": st.session_state.mode, "answer": str(llm_response)}})
+
+
+def flow_mode_switch():
+    import components as cn
+
+    st.session_state.mode = ct.ANSWER_MODE_2 if st.session_state.get("mode") == ct.ANSWER_MODE_1 else ct.ANSWER_MODE_1
+    if cn.is_mode_changed():
+        cn.clear_conversation_log()
+        cn.reset_genre_selection()
+    st.session_state.mode_2 = ct.ANSWER_MODE_3 if st.session_state.mode == ct.ANSWER_MODE_1 else ct.ANSWER_MODE_8
+
+
+def flow_text_question():
+    _ask(TEXT_QUESTION)
+
+
+def flow_law_question():
+    st.session_state.mode = ct.ANSWER_MODE_1
+    st.session_state.mode_2 = ct.ANSWER_MODE_10
+    _ask(LAW_QUESTION)
+
+
+def flow_voice_confirmation(audio_bytes):
+    # main.pyと同様に、一時ファイル経由でWhisper APIに送信してから、確認済みのテキストで質問する
+    with tempfile.NamedTemporaryFile(suffix=".wav") as temp_file:
+        temp_file.write(audio_bytes)
+        temp_file.flush()
+        with open(temp_file.name, "rb") as audio_file:
+            transcript = st.session_state.openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=audio_file,
+                language="ja"
+            )
+    _ask(transcript.text)
+
+
+def run_session(router, base_url, iterations, ready_barrier, start_event, results, errors):
+    """
+    1セッション分の初期化とフローの繰り返しを実行（1スレッド = 1セッション）
+    """
+    import initialize
+
+    session_state = fakes.FakeSessionState()
+    router.bind(session_state)
+    try:
+        initialize.initialize()
+        session_state.openai_client = openai.OpenAI(api_key="mock", base_url=base_url, http_client=rate_limiter.get_http_client())
+        session_state.mode = ct.ANSWER_MODE_1
+        session_state.mode_2 = ct.ANSWER_MODE_3
+    except Exception as e:
+        errors.append(("initialize", repr(e)))
+        ready_barrier.abort()
+        return
+    audio_bytes = _silent_wav()
+
+    # 全セッションの初期化が終わってから一斉にフローを開始する
+    try:
+        ready_barrier.wait()
+    except threading.BrokenBarrierError:
+        # 他のセッションの初期化に失敗した場合は、フローを実行せずに終了
+        return
+    start_event.wait()
+
+    flows = {
+        "mode_switch": flow_mode_switch,
+        "text_question": flow_text_question,
+        "law_question": flow_law_question,
+        "voice_confirmation": lambda: flow_voice_confirmation(audio_bytes),
+    }
+    for _ in range(iterations):
+        for name in FLOW_NAMES:
+            start = time.perf_counter()
+            try:
+                flows[name]()
+            except Exception as e:
+                errors.append((name, repr(e)))
+                continue
+            results[name].append((time.perf_counter() - start) * 1000)
+
+
+def run_load_test(args):
+    """
+    負荷試験を実行し、結果を返す
+
+    Args:
+        args: コマンドライン引数
+
+    Returns:
+        スループット・フローごとのレイテンシ・セッションあたりのRSSをまとめた辞書
+    """
+    config = MockOpenAIConfig(
+        ttft=args.ttft,
+        chunk_latency=args.chunk_latency,
+        embedding_latency=args.embedding_latency,
+        transcription_latency=args.transcription_latency,
+        answer_tokens=args.answer_tokens,
+    )
+    server = MockOpenAIServer(("127.0.0.1", 0), config).start_background()
+
+    router = fakes.SessionStateRouter()
+    results = {name: [] for name in FLOW_NAMES}
+    errors = []
+    ready_barrier = threading.Barrier(args.sessions + 1)
+    start_event = threading.Event()
+
+    env = {"OPENAI_API_KEY": "mock", "OPENAI_BASE_URL": server.base_url, "OPENAI_API_BASE": server.base_url}
+    with tempfile.TemporaryDirectory() as work_dir, \
+            mock.patch.dict(os.environ, env), \
+            mock.patch.object(ct, "LOG_DIR_PATH", os.path.join(work_dir, "logs")), \
+            mock.patch.object(ct, "METRICS_SERVER_ENABLED", False), \
+            mock.patch.object(ct, "HISTORY_DB_PATH", os.path.join(work_dir, "history.sqlite3")), \
+            mock.patch.object(history_store, "_store", None), \
+            fakes.fake_backends(fakes.LatencyConfig(search=args.search_latency), session_state=router, replace_openai=False):
+        rss_baseline = current_rss_bytes()
+        threads = [
+            threading.Thread(
+                target=run_session,
+                args=(router, server.base_url, args.iterations, ready_barrier, start_event, results, errors),
+                name=f"session-{i}",
+            )
+            for i in range(args.sessions)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            ready_barrier.wait()
+        except threading.BrokenBarrierError:
+            start_event.set()
+            for thread in threads:
+                thread.join()
+            raise RuntimeError(f"セッションの初期化に失敗しました: {errors[:3]}")
+        rss_after_init = current_rss_bytes()
+
+        # フロー実行中のRSSの最大値を監視
+        peak = {"rss": rss_after_init}
+        stop_sampling = threading.Event()
+
+        def sample_rss():
+            while not stop_sampling.wait(0.1):
+                peak["rss"] = max(peak["rss"], current_rss_bytes())
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+        wall_start = time.perf_counter()
+        start_event.set()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - wall_start
+        stop_sampling.set()
+        sampler.join()
+
+    server.shutdown()
+
+    completed = sum(len(values) for values in results.values())
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "wall_seconds": round(wall, 3),
+        "throughput": {
+            "flows_per_second": round(completed / wall, 3) if wall else None,
+            "api_requests_per_second": round(sum(server.request_counts.values()) / wall, 3) if wall else None,
+            "api_requests": server.request_counts,
+        },
+        "latency": {name: summarize(values) for name, values in results.items()},
+        "errors": {"count": len(errors), "samples": errors[:10]},
+        "memory": {
+            "rss_baseline_bytes": rss_baseline,
+            "rss_after_init_bytes": rss_after_init,
+            "rss_peak_bytes": peak["rss"],
+            "rss_per_session_bytes": (rss_after_init - rss_baseline) // args.sessions,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="複数セッションを同時に再現して負荷試験を行います。")
+    parser.add_argument("--sessions", type=int, default=10, help="同時に実行するセッション数")
+    parser.add_argument("--iterations", type=int, default=3, help="セッションごとにフロー一式を繰り返す回数")
+    parser.add_argument("--ttft", type=float, default=0.0, help="代替サーバーの最初のトークンまでの待機時間（秒）")
+    parser.add_argument("--chunk-latency", type=float, default=0.0, help="代替サーバーのストリーミング1チャンクあたりの待機時間（秒）")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="代替サーバーの埋め込みAPIの待機時間（秒）")
+    parser.add_argument("--transcription-latency", type=float, default=0.0, help="代替サーバーの音声認識APIの待機時間（秒）")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="Web・Wikipedia検索の代替の待機時間（秒）")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="回答のおおよそのトークン数")
+    parser.add_argument("--output", help="結果をJSONで出力するファイル")
+    args = parser.parse_args()
+
+    report = run_load_test(args)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+このファイルは、負荷試験用にOpenAI APIを代替するローカルのHTTPサーバーが記述されたファイルです。
+
+対応エンドポイント:
+    - POST /v1/chat/completions（ストリーミング・非ストリーミング）
+    - POST /v1/embeddings
+    - POST /v1/audio/transcriptions
+
+使い方（単体で起動する場合）:
+    python -m benchmarks.mock_openai_server --port 8600 --ttft 0.5
+    OPENAI_BASE_URL=http://127.0.0.1:8600/v1 streamlit run main.py
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import json
+import time
+import base64
+import argparse
+import threading
+from uuid import uuid4
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import metrics
+from benchmarks import fakes
+
+
+############################################################
+# 変数定義
+############################################################
+# 音声認識の代替が返すテキスト
+MOCK_TRANSCRIPT = "最近デスクワークで肩こりがひどいです。対策を教えてください。"
+
+
+############################################################
+# クラス定義
+############################################################
+
+class MockOpenAIConfig:
+    """
+    代替サーバーの応答時間などの設定（秒）
+    """
+    def __init__(self, ttft=0.0, chunk_latency=0.0, embedding_latency=0.0, transcription_latency=0.0, answer_tokens=200, embedding_dimension=1536):
+        self.ttft = ttft
+        self.chunk_latency = chunk_latency
+        self.embedding_latency = embedding_latency
+        self.transcription_latency = transcription_latency
+        self.answer_tokens = answer_tokens
+        self.embedding_dimension = embedding_dimension
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """
+    OpenAI APIの代替サーバー（リクエストごとに別スレッドで応答する）
+    """
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, _MockOpenAIRequestHandler)
+        self.config = config
+        self.request_counts = {}
+        self._count_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, endpoint):
+        with self._count_lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def start_background(self):
+        """
+        バックグラウンドのスレッドでサーバーを起動
+        """
+        threading.Thread(target=self.serve_forever, name="mock-openai-server", daemon=True).start()
+        return self
+
+
+class _MockOpenAIRequestHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI APIの代替サーバーのリクエスト処理
+    """
+    # クライアント側のコネクションプールを有効に使えるよう、Keep-Aliveに対応する
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.split("?")[0].rstrip("/")
+
+        if path.endswith("/chat/completions"):
+            self.server.count("chat.completions")
+            self._chat_completions(json.loads(body))
+        elif path.endswith("/embeddings"):
+            self.server.count("embeddings")
+            self._embeddings(json.loads(body))
+        elif path.endswith("/audio/transcriptions"):
+            self.server.count("audio.transcriptions")
+            time.sleep(self.server.config.transcription_latency)
+            self._send_json({"text": MOCK_TRANSCRIPT})
+        else:
+            self._send_json({"error": {"message": f"Unknown endpoint: {path}", "type": "invalid_request_error"}}, status=404)
+
+    def log_message(self, format, *args):
+        # アクセスログは標準エラー出力に出さない
+        pass
+
+    def _chat_completions(self, request):
+        config = self.server.config
+        prompt = "\n".join(_message_text(m) for m in request.get("messages", []))
+        tool_calls = []
+        if request.get("tools"):
+            # ツール呼び出し形式のAgentからのリクエストには、Toolの呼び出しまたは最終回答を返す
+            has_tool_result = any(m.get("role") == "tool" for m in request.get("messages", []))
+            reply = fakes.fake_tool_call_reply(prompt, has_tool_result, config.answer_tokens)
+            text = reply.content
+            tool_calls = [
+                {"id": call["id"], "type": "function", "function": {"name": call["name"], "arguments": json.dumps(call["args"], ensure_ascii=False)}}
+                for call in reply.tool_calls
+            ]
+        else:
+            text = fakes.fake_reply(prompt, config.answer_tokens)
+        finish_reason = "tool_calls" if tool_calls else "stop"
+        model = request.get("model", "gpt-4o-mini")
+        completion_id = f"chatcmpl-{uuid4().hex}"
+        usage = {
+            "prompt_tokens": metrics.count_tokens(prompt),
+            "completion_tokens": metrics.count_tokens(text),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        time.sleep(config.ttft)
+
+        if not request.get("stream"):
+            self._send_json({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text, **({"tool_calls": tool_calls} if tool_calls else {})}, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+            return
+
+        # ストリーミングの場合はServer-Sent Eventsをチャンク転送で返す
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(choices, **extra):
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": choices, **extra}
+
+        self._write_event(chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]))
+        for start in range(0, len(text), 4):
+            time.sleep(config.chunk_latency)
+            self._write_event(chunk([{"index": 0, "delta": {"content": text[start:start + 4]}, "finish_reason": None}]))
+        if tool_calls:
+            delta = {"tool_calls": [{"index": i, **call} for i, call in enumerate(tool_calls)]}
+            self._write_event(chunk([{"index": 0, "delta": delta, "finish_reason": None}]))
+        self._write_event(chunk([{"index": 0, "delta": {}, "finish_reason": finish_reason}]))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self._write_event(chunk([], usage=usage))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _embeddings(self, request):
+        config = self.server.config
+        inputs = request.get("input", [])
+        if not isinstance(inputs, list) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        time.sleep(config.embedding_latency)
+
+        data = []
+        for i, item in enumerate(inputs):
+            # トークンID列で渡された場合も、内容から決定的なベクトルを生成する
+            key = item if isinstance(item, str) else json.dumps(item)
+            vector = fakes.fake_embedding(key, request.get("dimensions") or config.embedding_dimension)
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype(np.float32).tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+
+        self._send_json({
+            "object": "list",
+            "data": data,
+            "model": request.get("model", "text-embedding-ada-002"),
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        })
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_event(self, payload):
+        self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _message_text(message):
+    """
+    Chat Completions APIのメッセージから本文のテキストを取り出す
+    """
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return str(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI APIを代替するローカルのHTTPサーバーを起動します。")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--ttft", type=float, default=0.0, help="最初のトークンまでの待機時間（秒）")
+    parser.add_argument("--chunk-latency", type=float, default=0.0, help="ストリーミングの1チャンクあたりの待機時間（秒）")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="埋め込みAPI1回あたりの待機時間（秒）")
+    parser.add_argument("--transcription-latency", type=float, default=0.0, help="音声認識API1回あたりの待機時間（秒）")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="回答のおおよそのトークン数")
+    args = parser.parse_args()
+
+    config = MockOpenAIConfig(
+        ttft=args.ttft,
+        chunk_latency=args.chunk_latency,
+        embedding_latency=args.embedding_latency,
+        transcription_latency=args.transcription_latency,
+        answer_tokens=args.answer_tokens,
+    )
+    server = MockOpenAIServer((args.host, args.port), config)
+    print(f"OpenAI APIの代替サーバーを起動しました: {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+このファイルは、外部APIの応答をカセットに記録・再生して、シナリオごとの処理量の変化（性能の退行）を検出するスクリプトです。
+
+シナリオごとに次の項目を計測し、JSONファイルに出力します。
+    - model_calls: OpenAI APIの呼び出し回数（LLM・埋め込み・Whisperの合計。内訳も出力）
+    - search_calls: SerpAPI・Wikipediaの呼び出し回数
+    - agent_iterations: Agentの反復回数
+    - prompt_tokens: LLMに送信したトークン数
+    - local_ms: 実行時間から外部APIの応答待ちを除いた、ローカル処理の時間
+
+手順:
+    1. record: 実際のAPIを呼び出して、シナリオごとのカセット（benchmarks/cassettes/<シナリオ名>.json）を作成する
+       （検索に使うベクトルストアは、記録の前に作成しておく）
+    2. replay: カセットの応答を使ってシナリオを実行する（ネットワークには接続しない）
+    3. --compare: 2つの結果を比較し、呼び出し回数・反復回数・トークン数の増加と、ローカル処理時間の悪化を表示する
+
+使い方:
+    python -m benchmarks.regression record
+    python -m benchmarks.regression replay [--repeat 3] [--output 出力先]
+    python -m benchmarks.regression --compare 比較元.json 比較先.json
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import statistics
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import mock
+from dotenv import load_dotenv
+from openai import OpenAI
+import constants as ct
+import engine
+import rate_limiter
+import retrieval
+from benchmarks import cassettes
+from benchmarks.load_test import _silent_wav
+from benchmarks.run_benchmarks import BENCHMARK_QUESTIONS, DEFAULT_RESULTS_DIR, git_commit
+
+
+############################################################
+# 設定関連
+############################################################
+# 「.env」ファイルで定義した環境変数の読み込み
+load_dotenv()
+
+
+############################################################
+# 変数定義
+############################################################
+# シナリオ（シナリオ名 → (お悩み種別, ジャンル, 質問, 音声入力を使うかどうか)）
+SCENARIOS = {
+    "marketing": (*BENCHMARK_QUESTIONS[0], False),
+    "recruitment": (*BENCHMARK_QUESTIONS[1], False),
+    "company_law": (*BENCHMARK_QUESTIONS[2], False),
+    "physical_health": (*BENCHMARK_QUESTIONS[3], False),
+    "voice_marketing": (*BENCHMARK_QUESTIONS[0], True),
+}
+DEFAULT_CASSETTE_DIR = os.path.join(os.path.dirname(__file__), "cassettes")
+# 増えた場合に退行とみなす項目
+COUNT_METRICS = ["model_calls", "search_calls", "agent_iterations", "prompt_tokens"]
+# ローカル処理時間が比較元の何倍を超えた場合に退行とみなすか
+LOCAL_TIME_TOLERANCE = 1.2
+# エンドポイント（パスの末尾）ごとのOpenAI APIの種類
+MODEL_ENDPOINTS = {
+    "/chat/completions": "llm",
+    "/embeddings": "embedding",
+    "/audio/transcriptions": "transcription",
+}
+SEARCH_HOSTS = ("serpapi.com", "wikipedia.org")
+
+
+############################################################
+# クラス定義
+############################################################
+
+class SpanCollector(logging.Handler):
+    """
+    計測用ロガーに出力されたスパンを、メモリ上に集めるハンドラー
+    """
+    def __init__(self):
+        super().__init__(level=logging.INFO)
+        self.spans = []
+
+    def emit(self, record):
+        self.spans.append(json.loads(record.getMessage()))
+
+
+############################################################
+# 関数定義
+############################################################
+
+@contextmanager
+def collect_spans():
+    """
+    ブロック内で記録されたスパンを集める
+
+    Yields:
+        スパンの辞書のリスト
+    """
+    logger = logging.getLogger(ct.SPAN_LOGGER_NAME)
+    collector = SpanCollector()
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    logger.addHandler(collector)
+    try:
+        yield collector.spans
+    finally:
+        logger.removeHandler(collector)
+        logger.setLevel(level)
+
+
+def _transcribe():
+    """
+    main.pyの音声入力と同様に、Whisper APIで音声を文字起こし
+    """
+    client = OpenAI(http_client=rate_limiter.get_http_client())
+    with tempfile.NamedTemporaryFile(suffix=".wav") as temp_file:
+        temp_file.write(_silent_wav())
+        temp_file.flush()
+        with open(temp_file.name, "rb") as audio_file:
+            transcript = client.audio.transcriptions.create(
+                model="whisper-1",
+                file=audio_file,
+                language="ja"
+            )
+    return transcript.text
+
+
+def run_scenario(name, cassette_dir, cassette_mode):
+    """
+    シナリオを1回実行し、計測結果を返す
+
+    Args:
+        name: シナリオ名
+        cassette_dir: カセットの保存先
+        cassette_mode: 「record」または「replay」
+
+    Returns:
+        計測結果の辞書
+    """
+    mode, mode_2, question, use_voice = SCENARIOS[name]
+    path = os.path.join(cassette_dir, f"{name}.json")
+
+    with cassettes.use_cassette(path, cassette_mode) as cassette, collect_spans() as spans:
+        start = time.perf_counter()
+        if use_voice:
+            # 無音の音声は文字起こし結果が空になることがあるため、その場合は質問文をそのまま使う
+            question = _transcribe().strip() or question
+        # FAQインデックスの有無で結果が変わらないよう、FAQは使わない
+        engine.ask(question, mode=mode, mode_2=mode_2, use_faq=False)
+        wall_ms = (time.perf_counter() - start) * 1000
+
+    calls = {kind: 0 for kind in MODEL_ENDPOINTS.values()}
+    search_calls = 0
+    for endpoint, count in cassette.calls.items():
+        for suffix, kind in MODEL_ENDPOINTS.items():
+            if endpoint.endswith(suffix):
+                calls[kind] += count
+        if endpoint.split("/", 1)[0].endswith(SEARCH_HOSTS):
+            search_calls += count
+
+    io_ms = cassette.io_seconds * 1000
+    return {
+        "model_calls": sum(calls.values()),
+        **{f"{kind}_calls": count for kind, count in calls.items()},
+        "search_calls": search_calls,
+        "agent_iterations": sum(1 for span in spans if span["name"] == "agent_iteration"),
+        "prompt_tokens": sum(span.get("prompt_tokens", 0) for span in spans if span["name"] == "llm"),
+        "wall_ms": round(wall_ms, 2),
+        "io_ms": round(io_ms, 2),
+        "local_ms": round(wall_ms - io_ms, 2),
+        "unmatched": cassette.unmatched,
+    }
+
+
+def prepare_vector_stores():
+    """
+    シナリオで検索するコーパスのベクトルストアを作成（作成時の埋め込みリクエストをカセットに含めないため、記録の前に行う）
+    """
+    corpus_ids = {corpus_id for _, mode_2, _, _ in SCENARIOS.values() for corpus_id in retrieval.genre_corpora(mode_2)}
+    corpus_ids.add(ct.COMPANY_LAW_CORPUS_ID)
+    for corpus_id in sorted(corpus_ids):
+        retrieval.get_shard(corpus_id)
+
+
+def run(args):
+    """
+    全シナリオを実行し、結果をJSONファイルに出力
+
+    Args:
+        args: コマンドライン引数
+
+    Returns:
+        計測結果
+    """
+    names = args.scenarios or list(SCENARIOS)
+    # 記録は1回だけ行い、再生は指定回数繰り返してローカル処理時間の中央値を使う
+    repeat = 1 if args.mode == "record" else max(args.repeat, 1)
+
+    with tempfile.TemporaryDirectory() as work_dir, \
+            mock.patch.object(ct, "LOG_DIR_PATH", os.path.join(work_dir, "logs")), \
+            mock.patch.object(ct, "METRICS_SERVER_ENABLED", False):
+        if args.mode == "record":
+            prepare_vector_stores()
+
+        results = {}
+        for name in names:
+            runs = [run_scenario(name, args.cassette_dir, args.mode) for _ in range(repeat)]
+            result = dict(runs[-1])
+            for key in ("wall_ms", "io_ms", "local_ms"):
+                result[key] = round(statistics.median(r[key] for r in runs), 2)
+            results[name] = result
+            print(f"{name}: model_calls={result['model_calls']} agent_iterations={result['agent_iterations']} "
+                  f"prompt_tokens={result['prompt_tokens']} local_ms={result['local_ms']}")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "mode": args.mode,
+        "agent_backend": ct.AGENT_BACKEND,
+        "repeat": repeat,
+        "results": results,
+    }
+
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"regression-{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"計測結果を出力しました: {output}")
+    return report
+
+
+def compare(base_path, target_path):
+    """
+    2つの計測結果をシナリオごとに比較し、退行を表示
+
+    Args:
+        base_path: 比較元の結果ファイル
+        target_path: 比較先の結果ファイル
+
+    Returns:
+        退行が見つかった項目数
+    """
+    with open(base_path, encoding="utf8") as f:
+        base = json.load(f)
+    with open(target_path, encoding="utf8") as f:
+        target = json.load(f)
+
+    regressions = 0
+    print(f"{'scenario.metric':<40} {base['commit']:>14} {target['commit']:>14}")
+    for name in sorted(set(base["results"]) | set(target["results"])):
+        before = base["results"].get(name)
+        after = target["results"].get(name)
+        if before is None or after is None:
+            print(f"{name:<40} {'-' if before is None else 'あり':>14} {'-' if after is None else 'あり':>14}")
+            continue
+        for metric in COUNT_METRICS + ["local_ms"]:
+            if metric == "local_ms":
+                regressed = after[metric] > before[metric] * LOCAL_TIME_TOLERANCE
+            else:
+                regressed = after[metric] > before[metric]
+            regressions += regressed
+            mark = "  ← 退行" if regressed else ""
+            print(f"{name + '.' + metric:<40} {before[metric]:>14} {after[metric]:>14}{mark}")
+        if after.get("unmatched"):
+            print(f"{name}: カセットと一致しないリクエストが{after['unmatched']}件ありました（プロンプトなどが変わっています）")
+
+    print(f"退行: {regressions}件")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="外部APIの応答を記録・再生して、シナリオごとの性能の退行を検出します。")
+    parser.add_argument("mode", nargs="?", choices=["record", "replay"], help="記録するか、記録済みの応答を再生するか")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "TARGET"), help="2つの結果ファイルを比較して終了")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), help="実行するシナリオ（未指定の場合はすべて）")
+    parser.add_argument("--cassette-dir", default=DEFAULT_CASSETTE_DIR, help="カセットの保存先")
+    parser.add_argument("--repeat", type=int, default=3, help="再生時にシナリオを繰り返す回数")
+    parser.add_argument("--output", help="結果の出力先（未指定の場合は benchmarks/results/regression-<コミットID>.json）")
+    args = parser.parse_args()
+
+    if args.compare:
+        # 退行があれば終了コード1で終了する（CIなどでの判定用）
+        sys.exit(1 if compare(*args.compare) else 0)
+    if args.mode is None:
+        parser.error("record・replay・--compare のいずれかを指定してください")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
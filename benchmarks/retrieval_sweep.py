@@ -0,0 +1,227 @@
+"""
+このファイルは、会社法の検索設定（チャンクサイズ・重複文字数・取得件数）の組み合わせごとに、検索精度と処理量を評価するスクリプトです。
+
+正解データ（質問と、その回答の根拠となる条文の対応。既定は data/eval/company_law_gold.jsonl）を使い、
+設定の組み合わせごとに次の項目を計測します。
+    - recall@k: 正解の条文のうち、上位k件のチャンクに見出しが含まれていた割合（質問ごとの平均）
+    - mrr: 正解の条文を含む最初のチャンクの順位の逆数（上位k件に含まれない場合は0。質問ごとの平均）
+    - context_tokens: 上位k件のチャンクのトークン数（質問ごとの平均。回答生成時のプロンプトの大きさの目安）
+    - search: 検索1回あたりの処理時間（クエリの埋め込みはキャッシュ済みのため、主にベクトル検索とチャンク取得の時間）
+
+検索は本番と同じ処理（retrieval._search。複合的な質問のサブクエリへの分割を含む）で行います。
+チャンク・クエリの埋め込みはローカルのキャッシュ（既定は data/eval/embedding_cache）に保存するため、
+同じチャンクを含む設定の作成や、2回目以降の実行では埋め込みAPIを呼び出しません。
+
+正解データの形式（1行1件のJSON）:
+    {"question": "取締役会の職務と権限を教えてください", "articles": ["第三百六十二条"]}
+
+使い方:
+    python -m benchmarks.retrieval_sweep [--chunk-sizes 500 1000 1500] [--overlaps 0 100 200] [--ks 3 5 8]
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import json
+import time
+import argparse
+import itertools
+from datetime import datetime
+from unittest import mock
+from dotenv import load_dotenv
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
+from langchain_openai import OpenAIEmbeddings
+import constants as ct
+import ingestion
+import metrics
+import rate_limiter
+import retrieval
+from benchmarks.run_benchmarks import DEFAULT_RESULTS_DIR, git_commit, summarize
+
+
+############################################################
+# 設定関連
+############################################################
+# 「.env」ファイルで定義した環境変数の読み込み
+load_dotenv()
+
+
+############################################################
+# 変数定義
+############################################################
+DEFAULT_GOLD_PATH = "./data/eval/company_law_gold.jsonl"
+DEFAULT_CACHE_DIR = "./data/eval/embedding_cache"
+
+
+############################################################
+# 関数定義
+############################################################
+
+def load_gold(path):
+    """
+    正解データを読み込む
+
+    Returns:
+        {"question": 質問, "articles": 条文の見出しのリスト} のリスト
+    """
+    with open(path, encoding="utf8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def article_pattern(article):
+    """
+    チャンクに条文の本体（見出し）が含まれているかを判定する正規表現を作成
+
+    他の条文からの参照（「第三百六十二条第四項」など）や目次（「（第三百六十二条―第三百六十五条）」）には一致させず、
+    行頭の「第三百六十二条　」（条番号の直後が全角スペース）にだけ一致させる
+    """
+    return re.compile(rf"(?m)^\s*{re.escape(article)}[　 ]")
+
+
+def cached_embeddings(cache_dir):
+    """
+    埋め込みの結果をローカルに保存して再利用する埋め込みモデルを作成
+
+    Args:
+        cache_dir: キャッシュの保存先
+
+    Returns:
+        CacheBackedEmbeddings
+    """
+    underlying = OpenAIEmbeddings(http_client=rate_limiter.get_http_client())
+    return CacheBackedEmbeddings.from_bytes_store(
+        underlying,
+        LocalFileStore(cache_dir),
+        # モデルを変えた場合に、別のモデルの埋め込みを使わないよう、モデル名ごとに保存先を分ける
+        namespace=underlying.model,
+        batch_size=ct.EMBEDDING_BATCH_SIZE,
+        query_embedding_cache=True,
+    )
+
+
+def evaluate(vector_store, gold, ks, repeat):
+    """
+    1つのベクトルストアについて、取得件数ごとの検索精度と処理量を計測
+
+    Args:
+        vector_store: 評価対象のベクトルストア
+        gold: 正解データ
+        ks: 評価する取得件数のリスト
+        repeat: 処理時間の計測で、質問ごとに検索を繰り返す回数
+
+    Returns:
+        取得件数をキーとした計測結果の辞書
+    """
+    shards = [(ct.COMPANY_LAW_CORPUS_ID, vector_store)]
+    patterns = [[article_pattern(article) for article in item["articles"]] for item in gold]
+    results = {}
+
+    for k in ks:
+        recalls = []
+        reciprocal_ranks = []
+        context_tokens = []
+        latencies = []
+        for item, item_patterns in zip(gold, patterns):
+            # 1回目でクエリの埋め込みをキャッシュに載せ、2回目以降の処理時間を計測する
+            docs = retrieval._search(shards, item["question"], k)
+            for _ in range(repeat):
+                start = time.perf_counter()
+                retrieval._search(shards, item["question"], k)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+            found = [any(p.search(doc.page_content) for doc in docs) for p in item_patterns]
+            recalls.append(sum(found) / len(found))
+            first = next(
+                (rank for rank, doc in enumerate(docs, 1) if any(p.search(doc.page_content) for p in item_patterns)),
+                None
+            )
+            reciprocal_ranks.append(1 / first if first else 0.0)
+            context_tokens.append(sum(metrics.count_tokens(doc.page_content) for doc in docs))
+
+        results[k] = {
+            "recall": round(sum(recalls) / len(recalls), 4),
+            "mrr": round(sum(reciprocal_ranks) / len(reciprocal_ranks), 4),
+            "context_tokens": round(sum(context_tokens) / len(context_tokens), 1),
+            "search": summarize(latencies),
+        }
+    return results
+
+
+def run(args):
+    """
+    設定の組み合わせごとにベクトルストアを作成して評価し、結果を表示・出力
+
+    Args:
+        args: コマンドライン引数
+
+    Returns:
+        計測結果
+    """
+    gold = load_gold(args.gold)
+    embeddings = cached_embeddings(args.cache_dir)
+    pdf_path = ct.CORPORA[ct.COMPANY_LAW_CORPUS_ID]["pdf_path"]
+
+    configs = []
+    # 検索時のクエリの埋め込みにも、キャッシュ付きの埋め込みモデルを使う
+    with mock.patch.object(retrieval, "_embeddings", embeddings):
+        for chunk_size, chunk_overlap in itertools.product(args.chunk_sizes, args.overlaps):
+            if chunk_overlap >= chunk_size:
+                continue
+            print(f"ベクトルストアを作成します（chunk_size={chunk_size}, chunk_overlap={chunk_overlap}）")
+            start = time.perf_counter()
+            vector_store = ingestion.build_vector_store(
+                pdf_path, embeddings,
+                metadata={"corpus": ct.COMPANY_LAW_CORPUS_ID},
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+            )
+            build_seconds = time.perf_counter() - start
+
+            for k, result in evaluate(vector_store, gold, args.ks, args.repeat).items():
+                configs.append({
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": chunk_overlap,
+                    "k": k,
+                    "chunks": vector_store.index.ntotal,
+                    "build_seconds": round(build_seconds, 2),
+                    **result,
+                })
+
+    print(f"{'chunk_size':>10} {'overlap':>8} {'k':>3} {'chunks':>7} {'recall':>7} {'mrr':>7} {'tokens':>8} {'p50_ms':>8} {'p95_ms':>8}")
+    for c in configs:
+        print(f"{c['chunk_size']:>10} {c['chunk_overlap']:>8} {c['k']:>3} {c['chunks']:>7} {c['recall']:>7} {c['mrr']:>7} "
+              f"{c['context_tokens']:>8} {c['search']['p50_ms']:>8} {c['search']['p95_ms']:>8}")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "gold": args.gold,
+        "questions": len(gold),
+        "current": {"chunk_size": ct.CHUNK_SIZE, "chunk_overlap": ct.CHUNK_OVERLAP, "k": ct.SEARCH_TOP_K},
+        "configs": configs,
+    }
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"retrieval-sweep-{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"評価結果を出力しました: {output}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会社法の検索設定の組み合わせごとに、検索精度と処理量を評価します。")
+    parser.add_argument("--gold", default=DEFAULT_GOLD_PATH, help="正解データ（質問と条文の対応）のパス")
+    parser.add_argument("--chunk-sizes", nargs="+", type=int, default=[500, 1000, 1500], help="評価するチャンクサイズ")
+    parser.add_argument("--overlaps", nargs="+", type=int, default=[0, 100, 200], help="評価するチャンクの重複文字数")
+    parser.add_argument("--ks", nargs="+", type=int, default=[3, 5, 8], help="評価する取得件数")
+    parser.add_argument("--repeat", type=int, default=5, help="処理時間の計測で、質問ごとに検索を繰り返す回数")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="埋め込みのキャッシュの保存先")
+    parser.add_argument("--output", help="結果の出力先（未指定の場合は benchmarks/results/retrieval-sweep-<コミットID>.json）")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+"""
+このファイルは、外部APIを代替実装に置き換えた状態で主要な処理の性能を計測し、結果をJSONファイルに出力するベンチマークです。
+
+計測項目:
+    - index_build: 会社法PDFからのベクトルストア作成時間
+    - faiss_query: ベクトルストアの検索レイテンシ
+    - context_build: 「_build_conversational_input」の処理時間
+    - agent_turn: Agent Executorの1ターンあたりの処理時間（代替APIの待機時間を除いたオーバーヘッド）
+    - session_memory: セッション1つあたりの常駐メモリ（RSS）の増加量
+
+使い方:
+    python -m benchmarks.run_benchmarks [--output 出力先] [--llm-latency 秒] ...
+    python -m benchmarks.run_benchmarks --compare 比較元.json 比較先.json
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+from unittest import mock
+import constants as ct
+import metrics
+import history_store
+from benchmarks import fakes
+
+
+############################################################
+# 変数定義
+############################################################
+# 計測に使う質問（ジャンル、質問文）
+BENCHMARK_QUESTIONS = [
+    (ct.ANSWER_MODE_1, ct.ANSWER_MODE_3, "ラーメン屋の販路拡大策を教えてください"),
+    (ct.ANSWER_MODE_1, ct.ANSWER_MODE_5, "エンジニアの採用を強化したいです。どんな施策が有効ですか？"),
+    (ct.ANSWER_MODE_1, ct.ANSWER_MODE_10, "取締役会と監査役の関係について教えてください"),
+    (ct.ANSWER_MODE_2, ct.ANSWER_MODE_8, "最近デスクワークで肩こりがひどいです。対策を教えてください。"),
+]
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+############################################################
+# 関数定義
+############################################################
+
+def current_rss_bytes():
+    """
+    現在の常駐メモリ（RSS）をバイト単位で取得
+
+    Returns:
+        RSS（/proc が使えない環境では最大RSS）
+    """
+    try:
+        with open("/proc/self/status", encoding="utf8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # macOSではバイト単位、Linuxではキロバイト単位で返る
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def git_commit():
+    """
+    計測対象のコミットIDを取得
+
+    Returns:
+        コミットID（取得できない場合は「unknown」）
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def summarize(values_ms):
+    """
+    計測値の一覧から代表値を算出
+
+    Args:
+        values_ms: 計測値（ミリ秒）の一覧
+
+    Returns:
+        件数・平均・パーセンタイルの辞書
+    """
+    values = sorted(values_ms)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 3) if values else None,
+        "p50_ms": metrics.percentile(values, 50),
+        "p95_ms": metrics.percentile(values, 95),
+        "p99_ms": metrics.percentile(values, 99),
+    }
+
+
+def bench_index_build(latency, store_path):
+    """
+    会社法PDFからのベクトルストア作成時間を計測
+
+    Args:
+        latency: 代替APIの待機時間の設定
+        store_path: ベクトルストアの保存先
+
+    Returns:
+        計測結果
+    """
+    import initialize
+
+    fakes.counter.reset()
+    with fakes.fake_backends(latency) as session_state, mock.patch.dict(ct.CORPORA[ct.COMPANY_LAW_CORPUS_ID], {"store_path": store_path}):
+        start = time.perf_counter()
+        initialize.initialize_vector_store()
+        elapsed = time.perf_counter() - start
+        vector_store = session_state.vector_store
+
+    if vector_store is None:
+        raise RuntimeError("ベクトルストアの作成に失敗しました。ログを確認してください。")
+
+    return {
+        "seconds": round(elapsed, 3),
+        "local_seconds": round(elapsed - fakes.counter.simulated_seconds, 3),
+        "chunks": vector_store.index.ntotal,
+        "embedding_calls": fakes.counter.counts.get("embedding", 0),
+    }
+
+
+def bench_faiss_query(store_path, repeat):
+    """
+    ベクトルストアの検索レイテンシを計測（埋め込みの待機時間は含めない）
+
+    Args:
+        store_path: ベクトルストアの保存先
+        repeat: 検索回数
+
+    Returns:
+        計測結果
+    """
+    import initialize
+
+    with fakes.fake_backends() as session_state, mock.patch.dict(ct.CORPORA[ct.COMPANY_LAW_CORPUS_ID], {"store_path": store_path}):
+        initialize.initialize_vector_store()
+        vector_store = session_state.vector_store
+
+        embeddings = fakes.FakeEmbeddings()
+        questions = [question for _, _, question in BENCHMARK_QUESTIONS]
+        query_vectors = [embeddings.embed_query(q) for q in questions]
+
+        durations = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            vector_store.similarity_search_by_vector(query_vectors[i % len(query_vectors)], k=ct.SEARCH_TOP_K)
+            durations.append((time.perf_counter() - start) * 1000)
+
+    return summarize(durations)
+
+
+def bench_context_build(repeat, history_turns):
+    """
+    「_build_conversational_input」の処理時間を計測
+
+    Args:
+        repeat: 実行回数
+        history_turns: 会話ログに積んでおくターン数
+
+    Returns:
+        計測結果
+    """
+    import utils
+
+    store = history_store.HistoryStore(":memory:")
+    session_state = fakes.FakeSessionState(mode=ct.ANSWER_MODE_1, mode_2=ct.ANSWER_MODE_3, history=history_store.SessionHistory("bench", store))
+    for i in range(history_turns):
+        session_state.history.append({"role": "user", "content": f"質問{i}: 売上を伸ばすための施策を教えてください。"})
+        session_state.history.append({"role": "assistant", "content": {"mode": ct.ANSWER_MODE_1, "answer": "回答です。" * 100}})
+
+    durations = []
+    with fakes.fake_backends(session_state=session_state):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            utils._build_conversational_input("新しい質問です")
+            durations.append((time.perf_counter() - start) * 1000)
+
+    return summarize(durations)
+
+
+def bench_agent_turn(latency, store_path, repeat):
+    """
+    Agent Executorの1ターンあたりの処理時間を計測
+
+    Args:
+        latency: 代替APIの待機時間の設定
+        store_path: ベクトルストアの保存先
+        repeat: 質問セットの繰り返し回数
+
+    Returns:
+        計測結果（「overhead」は代替APIの待機時間を除いたローカル処理時間）
+    """
+    import initialize
+    import utils
+
+    walls = []
+    overheads = []
+    llm_calls = []
+    with fakes.fake_backends(latency) as session_state, mock.patch.dict(ct.CORPORA[ct.COMPANY_LAW_CORPUS_ID], {"store_path": store_path}):
+        initialize.initialize()
+        for _ in range(repeat):
+            for mode, mode_2, question in BENCHMARK_QUESTIONS:
+                session_state.mode = mode
+                session_state.mode_2 = mode_2
+                fakes.counter.reset()
+                start = time.perf_counter()
+                utils.get_llm_response(question)
+                wall = time.perf_counter() - start
+                walls.append(wall * 1000)
+                overheads.append((wall - fakes.counter.simulated_seconds) * 1000)
+                llm_calls.append(fakes.counter.counts.get("llm", 0))
+
+    return {
+        "wall": summarize(walls),
+        "overhead": summarize(overheads),
+        "llm_calls_per_turn": round(sum(llm_calls) / len(llm_calls), 3),
+    }
+
+
+def bench_session_memory(store_path, sessions):
+    """
+    セッション1つあたりの常駐メモリ（RSS）の増加量を計測
+
+    Args:
+        store_path: ベクトルストアの保存先
+        sessions: 作成するセッション数
+
+    Returns:
+        計測結果（共有リソースの作成分は「rss_shared_bytes」、以降のセッションごとの増加分は「rss_per_session_bytes」）
+    """
+    import initialize
+
+    router = fakes.SessionStateRouter()
+    # 計測対象のセッションをすべて保持したまま、RSSの増加量を計測する
+    session_states = [fakes.FakeSessionState() for _ in range(sessions + 1)]
+    history_path = os.path.join(os.path.dirname(store_path), "history.sqlite3")
+    with fakes.fake_backends(session_state=router), \
+            mock.patch.dict(ct.CORPORA[ct.COMPANY_LAW_CORPUS_ID], {"store_path": store_path}), \
+            mock.patch.object(ct, "HISTORY_DB_PATH", history_path), \
+            mock.patch.object(history_store, "_store", None):
+        before = current_rss_bytes()
+        # 1つ目のセッションでプロセス内の共有リソースが作成される
+        router.bind(session_states[0])
+        initialize.initialize()
+        after_first = current_rss_bytes()
+        for session_state in session_states[1:]:
+            router.bind(session_state)
+            initialize.initialize()
+        after = current_rss_bytes()
+
+    return {
+        "sessions": sessions,
+        "rss_before_bytes": before,
+        "rss_after_bytes": after,
+        "rss_shared_bytes": after_first - before,
+        "rss_per_session_bytes": (after - after_first) // max(sessions, 1),
+    }
+
+
+def run(args):
+    """
+    ベンチマークを実行し、結果をJSONファイルに出力
+
+    Args:
+        args: コマンドライン引数
+
+    Returns:
+        計測結果
+    """
+    latency = fakes.LatencyConfig(
+        llm=args.llm_latency,
+        llm_per_token=args.llm_token_latency,
+        embedding=args.embedding_latency,
+        embedding_per_text=args.embedding_text_latency,
+        search=args.search_latency,
+        answer_tokens=args.answer_tokens,
+    )
+
+    with tempfile.TemporaryDirectory() as work_dir, \
+            mock.patch.object(ct, "LOG_DIR_PATH", os.path.join(work_dir, "logs")), \
+            mock.patch.object(ct, "METRICS_SERVER_ENABLED", False):
+        store_path = os.path.join(work_dir, "vector_store")
+        results = {
+            "index_build": bench_index_build(latency, store_path),
+            "faiss_query": bench_faiss_query(store_path, args.query_repeat),
+            "context_build": bench_context_build(args.context_repeat, args.history_turns),
+            "agent_turn": bench_agent_turn(latency, store_path, args.turn_repeat),
+            "session_memory": bench_session_memory(store_path, args.sessions),
+        }
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": results,
+    }
+
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"ベンチマーク結果を出力しました: {output}")
+    return report
+
+
+def _flatten(data, prefix=""):
+    """
+    入れ子の計測結果を「項目.指標」形式の数値のみの辞書に変換
+    """
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(base_path, target_path):
+    """
+    2つのベンチマーク結果を比較して差分を表示
+
+    Args:
+        base_path: 比較元の結果ファイル
+        target_path: 比較先の結果ファイル
+    """
+    with open(base_path, encoding="utf8") as f:
+        base = json.load(f)
+    with open(target_path, encoding="utf8") as f:
+        target = json.load(f)
+
+    base_values = _flatten(base["results"])
+    target_values = _flatten(target["results"])
+
+    print(f"{'metric':<45} {base['commit']:>14} {target['commit']:>14} {'change':>9}")
+    for name in sorted(set(base_values) | set(target_values)):
+        before = base_values.get(name)
+        after = target_values.get(name)
+        change = ""
+        if before not in (None, 0) and after is not None:
+            change = f"{(after - before) / before * 100:+.1f}%"
+        print(f"{name:<45} {str(before):>14} {str(after):>14} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="外部APIを代替実装に置き換えてベンチマークを実行します。")
+    parser.add_argument("--output", help="結果の出力先（未指定の場合は benchmarks/results/<コミットID>.json）")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "TARGET"), help="2つの結果ファイルを比較して終了")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="LLMの最初のトークンまでの待機時間（秒）")
+    parser.add_argument("--llm-token-latency", type=float, default=0.0, help="LLMの出力1チャンクあたりの待機時間（秒）")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="埋め込みAPI1回あたりの待機時間（秒）")
+    parser.add_argument("--embedding-text-latency", type=float, default=0.0, help="埋め込み対象テキスト1件あたりの待機時間（秒）")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="Web・Wikipedia検索1回あたりの待機時間（秒）")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="代替LLMが返す回答のおおよそのトークン数")
+    parser.add_argument("--query-repeat", type=int, default=200, help="ベクトル検索の計測回数")
+    parser.add_argument("--context-repeat", type=int, default=1000, help="文脈付き入力生成の計測回数")
+    parser.add_argument("--history-turns", type=int, default=20, help="文脈付き入力生成の計測時に積んでおく会話ターン数")
+    parser.add_argument("--turn-repeat", type=int, default=5, help="Agentの計測で質問セットを繰り返す回数")
+    parser.add_argument("--sessions", type=int, default=5, help="メモリ計測で作成するセッション数")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+このファイルは、ログから頻出の質問を抽出してFAQ（よくある質問）のインデックスを作成するコマンドです。
+
+手順:
+    1. mine: ローテーション済みのログ（logs/application.log.*）から、ジャンルごとに頻出の質問を抽出し、
+       回答を事前生成して回答候補ファイル（data/faq/candidates.jsonl）に出力する
+    2. 回答候補ファイルの内容を確認し、公開してよい回答の「approved」をtrueにする（必要に応じて「answer」を修正する）
+    3. build: 確認済みの回答候補だけを埋め込みインデックス（data/faq/index）に登録する
+
+再度 mine を実行した場合、確認済みの回答候補はそのまま残し、出現回数と言い回しの例だけを更新します。
+
+使い方:
+    python build_faq.py mine [--logs "logs/application.log.*"] [--min-count 3]
+    python build_faq.py build
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import hashlib
+import argparse
+from collections import Counter, defaultdict
+import numpy as np
+from dotenv import load_dotenv
+from langchain_openai import OpenAIEmbeddings
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+import constants as ct
+import app_logging
+import engine
+import log_parser
+import rate_limiter
+import singleflight
+
+
+############################################################
+# 設定関連
+############################################################
+# 「.env」ファイルで定義した環境変数の読み込み
+load_dotenv()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def faq_id(genre, question):
+    """
+    回答候補の識別子を、ジャンルと代表の質問から算出
+    """
+    key = json.dumps([genre, singleflight.normalize(question)], ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def load_candidates(path=ct.FAQ_CANDIDATES_PATH):
+    """
+    回答候補ファイルを読み込む
+
+    Returns:
+        識別子をキーとした回答候補の辞書
+    """
+    candidates = {}
+    if not os.path.exists(path):
+        return candidates
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            if line.strip():
+                candidate = json.loads(line)
+                candidates[candidate["id"]] = candidate
+    return candidates
+
+
+def save_candidates(candidates, path=ct.FAQ_CANDIDATES_PATH):
+    """
+    回答候補ファイルに書き込む（出現回数の多い順）
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf8") as f:
+        for candidate in sorted(candidates.values(), key=lambda c: (c["genre"], -c["count"])):
+            f.write(json.dumps(candidate, ensure_ascii=False) + "\n")
+
+
+def collect_questions(paths):
+    """
+    ログから、ジャンルごとの質問と出現回数を集計
+
+    Args:
+        paths: ログファイルのパスのリスト
+
+    Returns:
+        {ジャンル: Counter({正規化した質問: 出現回数})}, {(ジャンル, 正規化した質問): (お悩み種別, 元の質問)}
+    """
+    counts = defaultdict(Counter)
+    originals = {}
+    unparsed = []
+    # 回答のレコードはログ出力時に切り詰められて解析できないことがあるため、先頭だけで回答の有無を判定する
+    records = log_parser.iter_records(paths)
+    consultations = log_parser.iter_consultations(records, parse_answers=False, on_unparsed=unparsed.append)
+    for consultation in consultations:
+        # ジャンルが記録されていない（ジャンル出力前の）ログと、回答できなかった質問は対象外
+        if not consultation["genre"] or consultation["answered_at"] is None:
+            continue
+        question = consultation["question"].strip()
+        normalized = singleflight.normalize(question)
+        counts[consultation["genre"]][normalized] += 1
+        originals.setdefault((consultation["genre"], normalized), (consultation["mode"], question))
+    if unparsed:
+        # 切り詰めに対応する前のログで、長い質問が切り詰められている場合
+        print(f"解析できない質問のレコードが{len(unparsed)}件あったため、集計の対象外にしました")
+    return counts, originals
+
+
+def cluster_questions(questions, vectors, threshold):
+    """
+    出現回数の多い質問から順に、類似度がしきい値以上の質問を同じグループにまとめる
+
+    Args:
+        questions: (正規化した質問, 出現回数) のリスト（出現回数の多い順）
+        vectors: 質問の埋め込みベクトル（長さ1に正規化済み）
+        threshold: 同じ質問とみなすコサイン類似度の下限
+
+    Returns:
+        グループのリスト（各グループは questions のインデックスのリストで、先頭が代表の質問）
+    """
+    clusters = []
+    representatives = []
+    for i in range(len(questions)):
+        if representatives:
+            similarities = np.asarray(representatives) @ vectors[i]
+            best = int(np.argmax(similarities))
+            if similarities[best] >= threshold:
+                clusters[best].append(i)
+                continue
+        clusters.append([i])
+        representatives.append(vectors[i])
+    return clusters
+
+
+def mine(paths, min_count):
+    """
+    ログから頻出の質問を抽出し、回答を事前生成して回答候補ファイルを更新
+
+    Args:
+        paths: ログファイルのパスのリスト
+        min_count: 回答候補にする質問の最小出現回数
+
+    Returns:
+        追加した回答候補の件数
+    """
+    counts, originals = collect_questions(paths)
+    candidates = load_candidates()
+    embeddings = OpenAIEmbeddings(http_client=rate_limiter.get_http_client())
+    added = 0
+
+    for genre, counter in counts.items():
+        questions = counter.most_common()
+        # ジャンル内の質問を1回のリクエストでまとめて埋め込む
+        vectors = np.asarray(embeddings.embed_documents([originals[(genre, q)][1] for q, _ in questions]), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+        for cluster in cluster_questions(questions, vectors, ct.FAQ_CLUSTER_THRESHOLD):
+            total = sum(questions[i][1] for i in cluster)
+            if total < min_count:
+                continue
+            mode, question = originals[(genre, questions[cluster[0]][0])]
+            variants = [originals[(genre, questions[i][0])][1] for i in cluster]
+            cid = faq_id(genre, question)
+
+            if cid in candidates:
+                candidates[cid]["count"] = total
+                candidates[cid]["variants"] = variants
+                continue
+
+            print(f"[{genre}] {question}（{total}回）の回答を生成します")
+            candidates[cid] = {
+                "id": cid,
+                "genre": genre,
+                "mode": mode,
+                "question": question,
+                "variants": variants,
+                "count": total,
+                "answer": engine.ask(question, mode=mode, mode_2=genre, use_faq=False),
+                "approved": False,
+            }
+            added += 1
+
+    save_candidates(candidates)
+    return added
+
+
+def build():
+    """
+    確認済みの回答候補だけを、FAQインデックスに登録
+
+    Returns:
+        登録した回答の件数
+    """
+    approved = [c for c in load_candidates().values() if c.get("approved") and c.get("answer")]
+    if not approved:
+        return 0
+
+    # 言い回しの例もそれぞれ登録し、どの言い回しで質問されても同じ回答に一致させる
+    documents = [
+        Document(page_content=variant, metadata={"faq_id": c["id"], "genre": c["genre"], "answer": c["answer"]})
+        for c in approved
+        for variant in dict.fromkeys([c["question"], *c.get("variants", [])])
+    ]
+    embeddings = OpenAIEmbeddings(http_client=rate_limiter.get_http_client())
+    store = FAISS.from_documents(documents, embeddings)
+    os.makedirs(ct.FAQ_INDEX_PATH, exist_ok=True)
+    store.save_local(ct.FAQ_INDEX_PATH)
+    return len(approved)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ログから頻出の質問を抽出し、FAQインデックスを作成します。")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    mine_parser = subparsers.add_parser("mine", help="頻出の質問を抽出して回答候補を作成")
+    mine_parser.add_argument("--logs", default=None, help="対象のログファイルのglobパターン（既定はローテーション済みのログ）")
+    mine_parser.add_argument("--min-count", type=int, default=ct.FAQ_MIN_COUNT, help="回答候補にする質問の最小出現回数")
+    subparsers.add_parser("build", help="確認済みの回答候補からFAQインデックスを作成")
+    args = parser.parse_args()
+
+    app_logging.setup_logger()
+    app_logging.setup_span_logger()
+
+    if args.command == "mine":
+        paths = log_parser.find_log_files(args.logs)
+        added = mine(paths, args.min_count)
+        print(f"完了: {len(paths)}ファイルから回答候補を{added}件追加しました（{ct.FAQ_CANDIDATES_PATH}）")
+    else:
+        count = build()
+        print(f"完了: 確認済みの回答{count}件をFAQインデックスに登録しました（{ct.FAQ_INDEX_PATH}）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+このファイルは、実行中の回答生成を途中で取り消すための仕組み（キャンセルトークン）が記述されたファイルです。
+
+取り消し可能な処理にはキャンセルトークンを渡し、Agent Executorの実行にはコールバックとして組み込みます。
+トークンが取り消されると、次のLLM呼び出し・Tool呼び出し・ストリーミングのトークン受信の時点で
+OperationCancelledを送出して処理を打ち切ります。
+
+実行中のトークンは use_token でコンテキストに設定し、OpenAI APIの送信前・レート制限の待機中・
+Web検索などのHTTPリクエストの前にも確認します（raise_if_cancelled）。
+画面からの回答生成は、セッションごとに実行中のトークンを登録し（start_request）、
+お悩み種別の変更・新しいメッセージの送信・セッションの終了時に取り消します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from langchain_core.callbacks import BaseCallbackHandler
+import metrics
+
+
+############################################################
+# 変数定義
+############################################################
+# 実行中の処理のキャンセルトークン
+_current_token = contextvars.ContextVar("cancellation_token", default=None)
+
+# セッションIDごとの、実行中の回答生成のキャンセルトークン
+_requests = {}
+_requests_lock = threading.Lock()
+
+# 理由ごとの、取り消された回答生成の件数
+_cancelled = Counter()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class OperationCancelled(Exception):
+    """
+    キャンセルトークンが取り消されたため、処理を打ち切ったことを示すエラー
+    """
+
+
+class CancellationToken:
+    """
+    処理の取り消しを伝えるためのトークン（スレッド間で共有できる）
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = None
+
+    def cancel(self, reason=""):
+        """
+        処理を取り消す
+
+        Args:
+            reason: 取り消しの理由（ログ出力用）
+        """
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        """
+        取り消された時点で呼び出す関数を登録（すでに取り消されている場合はすぐに呼び出す）
+
+        Args:
+            callback: 呼び出す関数（引数なし）
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def wait(self, timeout=None):
+        """
+        取り消されるまで待つ
+
+        Returns:
+            取り消された場合True、タイムアウトした場合False
+        """
+        return self._event.wait(timeout)
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        """
+        取り消されていればOperationCancelledを送出
+        """
+        if self._event.is_set():
+            raise OperationCancelled(self.reason or "cancelled")
+
+
+class CancellationCallbackHandler(BaseCallbackHandler):
+    """
+    Agent Executorの実行中、処理の区切りごとにキャンセルトークンを確認するコールバック
+    """
+    # コールバック内で送出したエラーを握りつぶさずに、実行中の処理へ伝える
+    raise_error = True
+    run_inline = True
+
+    def __init__(self, token):
+        self._token = token
+
+    def on_chain_start(self, serialized, inputs, **kwargs):
+        self._token.raise_if_cancelled()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._token.raise_if_cancelled()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._token.raise_if_cancelled()
+
+    def on_llm_new_token(self, token, **kwargs):
+        self._token.raise_if_cancelled()
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self._token.raise_if_cancelled()
+
+    def on_agent_action(self, action, **kwargs):
+        self._token.raise_if_cancelled()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def current_token():
+    """
+    実行中の処理のキャンセルトークンを取得
+
+    Returns:
+        キャンセルトークン（設定されていない場合はNone）
+    """
+    return _current_token.get()
+
+
+@contextmanager
+def use_token(token):
+    """
+    ブロック内の処理のキャンセルトークンを設定（Noneの場合は何もしない）
+
+    Args:
+        token: キャンセルトークン
+    """
+    if token is None:
+        yield
+        return
+    reset = _current_token.set(token)
+    try:
+        yield
+    finally:
+        _current_token.reset(reset)
+
+
+def raise_if_cancelled():
+    """
+    実行中の処理のキャンセルトークンが取り消されていれば、OperationCancelledを送出
+    """
+    token = _current_token.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def start_request(session_id):
+    """
+    セッションの回答生成を開始し、そのキャンセルトークンを登録（同じセッションで実行中の回答生成は取り消す）
+
+    Args:
+        session_id: セッションID
+
+    Returns:
+        キャンセルトークン
+    """
+    token = CancellationToken()
+    with _requests_lock:
+        previous = _requests.get(session_id)
+        _requests[session_id] = token
+    if previous is not None:
+        previous.cancel("superseded")
+    return token
+
+
+def finish_request(session_id, token):
+    """
+    セッションの回答生成の終了時に、キャンセルトークンの登録を解除
+
+    Args:
+        session_id: セッションID
+        token: start_requestで登録したキャンセルトークン
+    """
+    with _requests_lock:
+        if _requests.get(session_id) is token:
+            del _requests[session_id]
+        if token.cancelled:
+            _cancelled[token.reason or "cancelled"] += 1
+
+
+def cancel_session(session_id, reason="cancelled"):
+    """
+    セッションで実行中の回答生成を取り消す
+
+    Args:
+        session_id: セッションID
+        reason: 取り消しの理由
+    """
+    with _requests_lock:
+        token = _requests.pop(session_id, None)
+    if token is not None:
+        token.cancel(reason)
+
+
+def snapshot():
+    """
+    取り消しの状況を取得
+
+    Returns:
+        実行中の回答生成の件数と、理由ごとの取り消された回答生成の件数
+    """
+    with _requests_lock:
+        return {"in_flight": len(_requests), "cancelled": dict(_cancelled)}
+
+
+metrics.register_snapshot_provider("cancellation", snapshot)
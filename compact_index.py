@@ -0,0 +1,402 @@
+"""
+このファイルは、ベクトルストアの埋め込みを次元削減した「圧縮インデックス」と、それを使った2段階の検索が記述されたファイルです。
+
+    1. 粗い検索: 次元削減したベクトル（メモリ上のFAISSインデックス）で、取得件数 × COMPACT_RESCORE_FACTOR 件の候補を検索
+    2. 再スコアリング: 候補のベクトルだけを元の次元でディスクから読み込み（np.memmap）、正確な距離で並べ替えて上位を返す
+
+次元削減の方法（COMPACT_METHOD）:
+    - "pca": 保存済みのベクトルで主成分分析を行い、上位の主成分へ射影する（text-embedding-ada-002など、どのモデルでも使える）
+    - "truncate": 先頭の次元だけを残して長さ1に正規化する。text-embedding-3系のモデルでは、
+      埋め込みAPIの dimensions オプションで短くした埋め込みと同じベクトルになる
+      （検索クエリは元の次元で1回だけ埋め込み、粗い検索用のベクトルはローカルで作る）
+
+移行（migrate）すると、ベクトルストアの保存先に移行ごとのディレクトリ（compact-<ID>）を作り、
+次元削減したベクトルのインデックス・元のベクトル（COMPACT_FULL_VECTORS_FILE）・射影（COMPACT_PROJECTION_FILE）を保存します。
+すべて書き込んだ後に、そのディレクトリを指す移行情報（COMPACT_MANIFEST_FILE）を1回の置き換えで切り替えるため、
+途中で失敗しても、検索に使うファイルの組み合わせが崩れることはありません。
+index.faiss も次元削減したインデックスに置き換え、LangChainの読み込み時に元の次元のインデックスをメモリに載せないようにします。
+retrieval.py はシャードの読み込み時に移行情報があれば、2段階の検索に切り替えます。
+移行済みのシャードを再度 migrate すると、保存済みの元のベクトルから射影し直します。restore で元のインデックスに戻せます。
+
+使い方:
+    python compact_index.py migrate [--corpus company_law] [--dims 256] [--method pca]
+    python compact_index.py restore [--corpus company_law]
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import shutil
+import argparse
+from uuid import uuid4
+import faiss
+import numpy as np
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# 次元削減の方法
+METHOD_PCA = "pca"
+METHOD_TRUNCATE = "truncate"
+METHODS = (METHOD_PCA, METHOD_TRUNCATE)
+
+# LangChainのFAISSベクトルストアが保存するインデックスのファイル名
+INDEX_FILE = "index.faiss"
+
+# 移行ごとに作成する、圧縮インデックスのディレクトリ名の接頭辞
+GENERATION_PREFIX = "compact-"
+
+
+############################################################
+# クラス定義
+############################################################
+
+class Projection:
+    """
+    元の次元のベクトルを、次元削減したベクトルに変換する射影
+    """
+    def __init__(self, method, dims, mean=None, components=None):
+        self.method = method
+        self.dims = dims
+        # 主成分分析の場合の平均ベクトルと、主成分（dims × 元の次元）
+        self.mean = mean
+        self.components = components
+
+    def apply(self, vectors):
+        """
+        ベクトルを次元削減
+
+        Args:
+            vectors: 元の次元のベクトル（件数 × 元の次元）
+
+        Returns:
+            次元削減したベクトル（件数 × dims）
+        """
+        if self.method == METHOD_TRUNCATE:
+            compact = np.ascontiguousarray(vectors[:, :self.dims], dtype=np.float32)
+            faiss.normalize_L2(compact)
+            return compact
+        return np.ascontiguousarray((vectors - self.mean) @ self.components.T, dtype=np.float32)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                method=np.array(self.method),
+                dims=np.array(self.dims),
+                mean=self.mean if self.mean is not None else np.empty(0, dtype=np.float32),
+                components=self.components if self.components is not None else np.empty((0, 0), dtype=np.float32),
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            method = str(data["method"])
+            if method == METHOD_TRUNCATE:
+                return cls(method, int(data["dims"]))
+            return cls(method, int(data["dims"]), data["mean"], data["components"])
+
+
+class TwoStageIndex:
+    """
+    次元削減したベクトルで候補を絞り込み、元の次元のベクトルで再スコアリングするインデックス
+
+    FAISSのインデックスと同じ search(vectors, k) で、元の次元のベクトルを受け取って検索できるため、
+    ベクトルストアの index を置き換えて使う（距離はFAISSの元のインデックスと同じ尺度で返す）
+    """
+    def __init__(self, coarse, projection, full_vectors, rescore_factor=ct.COMPACT_RESCORE_FACTOR):
+        self.coarse = coarse
+        self.projection = projection
+        self.full_vectors = full_vectors
+        self.rescore_factor = rescore_factor
+        # FAISSのインデックスと同じく、検索結果の尺度を示す
+        self.metric_type = coarse.metric_type
+        self.inner_product = coarse.metric_type == faiss.METRIC_INNER_PRODUCT
+        self.d = full_vectors.shape[1]
+        self.ntotal = coarse.ntotal
+
+    @property
+    def nbytes(self):
+        """
+        メモリ上に保持するインデックスの大きさ（バイト。元の次元のベクトルはディスク上にあるため含めない）
+        """
+        return self.ntotal * self.coarse.d * 4
+
+    def search(self, vectors, k):
+        """
+        2段階で検索
+
+        Args:
+            vectors: 検索クエリのベクトル（件数 × 元の次元）
+            k: 取得件数
+
+        Returns:
+            (距離の配列, インデックスの配列)。件数が足りない場合、インデックスは-1で埋める
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        candidates = min(self.ntotal, k * self.rescore_factor)
+        _, coarse_indices = self.coarse.search(self.projection.apply(vectors), candidates)
+
+        empty = np.finfo(np.float32).min if self.inner_product else np.finfo(np.float32).max
+        distances = np.full((len(vectors), k), empty, dtype=np.float32)
+        indices = np.full((len(vectors), k), -1, dtype=np.int64)
+        for row, candidate_ids in enumerate(coarse_indices):
+            # ディスクを先頭から順に読むよう、候補を並べ替えてから読み込む
+            candidate_ids = np.sort(candidate_ids[candidate_ids != -1])
+            if not len(candidate_ids):
+                continue
+            full = np.asarray(self.full_vectors[candidate_ids], dtype=np.float32)
+            if self.inner_product:
+                scores = full @ vectors[row]
+                top = np.argsort(-scores)[:k]
+            else:
+                # FAISSのIndexFlatL2と同じく、二乗L2距離で比較する
+                scores = ((full - vectors[row]) ** 2).sum(axis=1)
+                top = np.argsort(scores)[:k]
+            distances[row, :len(top)] = scores[top]
+            indices[row, :len(top)] = candidate_ids[top]
+        return distances, indices
+
+
+############################################################
+# 関数定義
+############################################################
+
+def fit_projection(vectors, dims, method=ct.COMPACT_METHOD):
+    """
+    次元削減の射影を作成
+
+    Args:
+        vectors: 元の次元のベクトル（件数 × 元の次元）
+        dims: 次元削減後の次元数
+        method: 次元削減の方法（"pca" または "truncate"）
+
+    Returns:
+        射影
+    """
+    if method not in METHODS:
+        raise ValueError(f"次元削減の方法は {', '.join(METHODS)} のいずれかを指定してください: {method}")
+    if not 0 < dims < vectors.shape[1]:
+        raise ValueError(f"次元数は1以上{vectors.shape[1]}未満で指定してください: {dims}")
+
+    if method == METHOD_TRUNCATE:
+        return Projection(method, dims)
+
+    # 共分散行列の固有ベクトルのうち、固有値の大きい順にdims個を主成分とする
+    mean = vectors.mean(axis=0)
+    centered = vectors - mean
+    _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+    components = eigenvectors[:, ::-1][:, :dims].T
+    return Projection(method, dims, mean.astype(np.float32), np.ascontiguousarray(components, dtype=np.float32))
+
+
+def _read_manifest(store_path):
+    """
+    移行済みの圧縮インデックスの情報を読み込む（移行していない場合はNone）
+    """
+    path = os.path.join(store_path, ct.COMPACT_MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf8") as f:
+        return json.load(f)
+
+
+def _replace_file(path, write_fn):
+    """
+    一時ファイルに書き込んでから置き換える（書き込みの途中で失敗しても、元のファイルを壊さない）
+    """
+    write_fn(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def is_compact(store_path):
+    """
+    ベクトルストアが圧縮インデックスに移行済みかどうか
+    """
+    return _read_manifest(store_path) is not None
+
+
+def read_full_vectors(store_path):
+    """
+    ベクトルストアの元の次元のベクトルを読み込む（移行済みの場合は保存済みのファイルから）
+
+    Args:
+        store_path: ベクトルストアの保存先
+
+    Returns:
+        (元の次元のベクトル, 内積で検索するインデックスかどうか)
+    """
+    manifest = _read_manifest(store_path)
+    if manifest is not None:
+        directory = os.path.join(store_path, manifest["directory"])
+        return np.load(os.path.join(directory, ct.COMPACT_FULL_VECTORS_FILE)), manifest["inner_product"]
+    index = faiss.read_index(os.path.join(store_path, INDEX_FILE))
+    return index.reconstruct_n(0, index.ntotal), index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+
+def _new_index(dims, inner_product):
+    return faiss.IndexFlatIP(dims) if inner_product else faiss.IndexFlatL2(dims)
+
+
+def write(directory, full_vectors, dims=ct.COMPACT_DIMENSIONS, method=ct.COMPACT_METHOD, inner_product=False):
+    """
+    元の次元のベクトルから射影を作成し、圧縮インデックスのファイル（元の次元のベクトル・射影・インデックス）を書き込む
+
+    Args:
+        directory: 書き込み先のディレクトリ（検索に使っていない新しいディレクトリ）
+        full_vectors: 元の次元のベクトル
+        dims: 次元削減後の次元数
+        method: 次元削減の方法
+        inner_product: 内積で検索するインデックスかどうか
+
+    Returns:
+        射影
+    """
+    full_vectors = np.ascontiguousarray(full_vectors, dtype=np.float32)
+    projection = fit_projection(full_vectors, dims, method)
+    coarse = _new_index(dims, inner_product)
+    coarse.add(projection.apply(full_vectors))
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ct.COMPACT_FULL_VECTORS_FILE), "wb") as f:
+        np.save(f, full_vectors)
+    projection.save(os.path.join(directory, ct.COMPACT_PROJECTION_FILE))
+    faiss.write_index(coarse, os.path.join(directory, INDEX_FILE))
+    return projection
+
+
+def load(directory, rescore_factor=ct.COMPACT_RESCORE_FACTOR):
+    """
+    圧縮インデックスを読み込む（元の次元のベクトルはメモリに載せず、np.memmapで必要な行だけ読む）
+
+    Args:
+        directory: writeで書き込んだディレクトリ
+        rescore_factor: 粗い検索で取得する候補数（取得件数の倍数）
+
+    Returns:
+        2段階で検索するインデックス
+    """
+    return TwoStageIndex(
+        faiss.read_index(os.path.join(directory, INDEX_FILE)),
+        Projection.load(os.path.join(directory, ct.COMPACT_PROJECTION_FILE)),
+        np.load(os.path.join(directory, ct.COMPACT_FULL_VECTORS_FILE), mmap_mode="r"),
+        rescore_factor,
+    )
+
+
+def attach(vector_store, store_path):
+    """
+    移行済みのベクトルストアであれば、検索を2段階の検索に切り替える
+
+    インデックスは移行情報が指すディレクトリから読み込むため、index.faiss の置き換えが済んでいなくても正しく検索できる
+
+    Args:
+        vector_store: 読み込んだベクトルストア
+        store_path: ベクトルストアの保存先
+
+    Returns:
+        切り替えた場合True
+    """
+    manifest = _read_manifest(store_path)
+    if manifest is None:
+        return False
+    vector_store.index = load(os.path.join(store_path, manifest["directory"]))
+    return True
+
+
+def _remove_generations(store_path, keep=None):
+    """
+    検索に使っていない圧縮インデックスのディレクトリ（以前の移行や、途中で失敗した移行のもの）を削除
+    """
+    for name in os.listdir(store_path):
+        path = os.path.join(store_path, name)
+        if name.startswith(GENERATION_PREFIX) and name != keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def migrate(store_path, dims=ct.COMPACT_DIMENSIONS, method=ct.COMPACT_METHOD):
+    """
+    保存済みのベクトルストアを圧縮インデックスに移行（移行済みの場合は射影し直す）
+
+    新しいディレクトリにすべてのファイルを書き込んでから、移行情報（COMPACT_MANIFEST_FILE）を1回の置き換えで切り替える。
+    どの時点で失敗しても、移行情報は切り替え前後のどちらか一方の、そろったファイルを指す
+
+    Args:
+        store_path: ベクトルストアの保存先
+        dims: 次元削減後の次元数
+        method: 次元削減の方法
+
+    Returns:
+        (移行前のインデックスの大きさ, 移行後のインデックスの大きさ)（バイト）
+    """
+    full_vectors, inner_product = read_full_vectors(store_path)
+    name = f"{GENERATION_PREFIX}{uuid4().hex[:12]}"
+    directory = os.path.join(store_path, name)
+    write(directory, full_vectors, dims, method, inner_product)
+
+    manifest = {"directory": name, "method": method, "dims": dims, "inner_product": inner_product}
+    def write_manifest(path):
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+    _replace_file(os.path.join(store_path, ct.COMPACT_MANIFEST_FILE), write_manifest)
+
+    # LangChainの読み込み時に元の次元のインデックスをメモリに載せないよう、index.faiss も次元削減したものに置き換える
+    # （検索には移行情報が指すディレクトリのインデックスを使うため、この置き換えの前に失敗しても検索できる）
+    _replace_file(
+        os.path.join(store_path, INDEX_FILE),
+        lambda path: shutil.copyfile(os.path.join(directory, INDEX_FILE), path)
+    )
+    _remove_generations(store_path, keep=name)
+    return full_vectors.nbytes, len(full_vectors) * dims * 4
+
+
+def restore(store_path):
+    """
+    圧縮インデックスに移行したベクトルストアを、元の次元のインデックスに戻す
+
+    Args:
+        store_path: ベクトルストアの保存先
+    """
+    if not is_compact(store_path):
+        return
+    full_vectors, inner_product = read_full_vectors(store_path)
+    index = _new_index(full_vectors.shape[1], inner_product)
+    index.add(np.ascontiguousarray(full_vectors, dtype=np.float32))
+
+    # 元のインデックスを書き込んでから移行情報を削除する（途中で失敗しても、移行済みとして検索できる）
+    _replace_file(os.path.join(store_path, INDEX_FILE), lambda path: faiss.write_index(index, path))
+    os.remove(os.path.join(store_path, ct.COMPACT_MANIFEST_FILE))
+    _remove_generations(store_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベクトルストアを、次元削減した圧縮インデックスに移行します。")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="圧縮インデックスに移行（移行済みの場合は射影し直す）")
+    migrate_parser.add_argument("--corpus", nargs="+", default=[ct.COMPANY_LAW_CORPUS_ID], help="対象のコーパスID")
+    migrate_parser.add_argument("--dims", type=int, default=ct.COMPACT_DIMENSIONS, help="次元削減後の次元数")
+    migrate_parser.add_argument("--method", choices=METHODS, default=ct.COMPACT_METHOD, help="次元削減の方法")
+    restore_parser = subparsers.add_parser("restore", help="元の次元のインデックスに戻す")
+    restore_parser.add_argument("--corpus", nargs="+", default=[ct.COMPANY_LAW_CORPUS_ID], help="対象のコーパスID")
+    args = parser.parse_args()
+
+    for corpus_id in args.corpus:
+        corpus = ct.CORPORA[corpus_id]
+        if not os.path.exists(os.path.join(corpus["store_path"], INDEX_FILE)):
+            print(f"{corpus['name']}: ベクトルストアがないため、スキップします（{corpus['store_path']}）")
+            continue
+        if args.command == "migrate":
+            before, after = migrate(corpus["store_path"], args.dims, args.method)
+            print(f"{corpus['name']}: 移行しました（{args.method}, {args.dims}次元）。"
+                  f"メモリ上のインデックス {before / 1024 / 1024:.1f}MB → {after / 1024 / 1024:.1f}MB")
+        else:
+            restore(corpus["store_path"])
+            print(f"{corpus['name']}: 元の次元のインデックスに戻しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,7 @@
 import streamlit as st
 import utils
 import constants as ct
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain import LLMChain
+import jobs
 
 
 ############################################################
@@ -113,7 +111,8 @@ def clear_conversation_log():
     """
     会話履歴のクリア
     """
-    st.session_state.messages = []
+    st.session_state.history.clear()
+    st.session_state.show_older_history = False
 
 def reset_genre_selection():
     """
@@ -155,42 +154,78 @@ def display_conversation_log():
     """
     会話ログの一覧表示
     """
+    history = st.session_state.history
+
+    # メモリに保持していない古い会話は、表示が求められた場合だけ読み込んで表示
+    older_count = history.older_count()
+    if older_count:
+        if st.session_state.get("show_older_history"):
+            for message in history.load_older():
+                display_message(message)
+        elif st.button(ct.SHOW_OLDER_HISTORY_BUTTON_LABEL.format(count=older_count)):
+            st.session_state.show_older_history = True
+            st.rerun()
+
     # 会話ログのループ処理
-    for message in st.session_state.messages:
-        # 「message」辞書の中の「role」キーには「user」か「assistant」が入っている
-        with st.chat_message(message["role"]):
-
-            # ユーザー入力値の場合、そのままテキストを表示するだけ
-            if message["role"] == "user":
-                st.markdown(message["content"])
-            
-            # LLMからの回答の場合
-            else:
-                # LLMからの回答を表示
-                st.markdown(message["content"]["answer"])
-
-                # 参照元のありかを一覧表示（オプション）
-                if "file_info_list" in message["content"]:
-                    # 区切り線の表示
-                    st.divider()
-                    # 「情報源」の文字を太字で表示
-                    st.markdown(f"##### {message['content']['message']}")
-                    # ドキュメントのありかを一覧表示
-                    for file_info in message["content"]["file_info_list"]:
-                        # 参照元のありかに応じて、適したアイコンを取得
-                        icon = utils.get_source_icon(file_info)
-                        st.info(file_info, icon=icon)
-
-
-def result_chain(param, system_template):
-    llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.5)
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_template),
-        ("human", "{input}")
-    ])
-    chain = LLMChain(prompt=prompt, llm=llm)
-    result = chain.run(param)
-    return result
+    for message in history.recent():
+        display_message(message)
+
+
+def display_message(message):
+    """
+    会話ログ1件の表示
+
+    Args:
+        message: {"role": ..., "content": ...} 形式の会話ログ
+    """
+    # 「message」辞書の中の「role」キーには「user」か「assistant」が入っている
+    with st.chat_message(message["role"]):
+
+        # ユーザー入力値の場合、そのままテキストを表示するだけ
+        if message["role"] == "user":
+            st.markdown(message["content"])
+
+        # LLMからの回答の場合
+        else:
+            # LLMからの回答を表示
+            st.markdown(message["content"]["answer"])
+
+            # 参照元のありかを一覧表示（オプション）
+            if "file_info_list" in message["content"]:
+                # 区切り線の表示
+                st.divider()
+                # 「情報源」の文字を太字で表示
+                st.markdown(f"##### {message['content']['message']}")
+                # ドキュメントのありかを一覧表示
+                for file_info in message["content"]["file_info_list"]:
+                    # 参照元のありかに応じて、適したアイコンを取得
+                    icon = utils.get_source_icon(file_info)
+                    st.info(file_info, icon=icon)
+
+
+@st.fragment(run_every=ct.JOB_POLL_SECONDS)
+def display_job_progress(job_id):
+    """
+    回答生成のジョブの途中経過を表示（一定間隔で、この部分だけを再実行して更新する）
+
+    ジョブが終了した場合は、画面全体を再実行して回答を表示させる
+
+    Args:
+        job_id: ジョブID
+    """
+    job = jobs.get(job_id)
+    if job is None or job.finished:
+        st.rerun()
+
+    with st.chat_message("assistant"):
+        # 回答の生成が始まっていれば途中までの回答を、始まっていなければ呼び出し中の専門家AIなどを表示
+        if job.partial:
+            st.markdown(job.partial + "▌")
+        elif job.progress:
+            st.markdown(f"{ct.SPINNER_TEXT}（{job.progress[-1]}）")
+        else:
+            st.markdown(ct.SPINNER_TEXT)
+
 
 def display_contact_llm_response(llm_response):
     """
@@ -219,65 +254,3 @@ def display_contact_llm_response(llm_response):
     
     # ログ用に回答内容を返す
     return {"mode": st.session_state.mode, "answer": answer}
-
-def get_marketing_strategy_advice(param):
-    system_template = ct.MARKEIING_STORATEGY_TEMPLATE
-    result = result_chain(param, system_template)
-    return result
-
-def get_sales_strategy_advice(param):
-    system_template = ct.SALES_STRATEGY_TEMPLATE
-    result = result_chain(param, system_template)
-    return result
-
-def get_recruitment_strategy_advice(param):
-    system_template = ct.RECRUITMENT_STRATEGY_TEMPLATE
-    result = result_chain(param, system_template)
-    return result
-
-def get_organizational_storategy_advice(param):
-    system_template = ct.ORGANIZATIONAL_STRATEGY_TEMPLATE
-    result = result_chain(param, system_template)
-    return result
-
-def get_buisiness_improvement_advice(param):
-    system_template = ct.BUSINESS_IMPROVEMENT_TEMPLATE
-    result = result_chain(param, system_template)
-    return result
-
-def get_physical_health_advice(param):
-    system_template = ct.PHYSICAL_HEALTH_TEMPLATE
-    result = result_chain(param, system_template)
-    return result
-
-def get_mental_health_advice(param):
-    system_template = ct.MENTAL_HEALTH_TEMPLATE
-    result = result_chain(param, system_template)
-    return result
-
-def get_company_law_advice(param):
-    """
-    会社法に関する質問に対して、RAGを使って回答を生成
-    """
-    
-    # ベクトルストアが初期化されていない場合はエラーメッセージ
-    if "vector_store" not in st.session_state or st.session_state.vector_store is None:
-        return "会社法の資料が読み込まれていません。アプリを再起動してください。"
-    
-    try:
-        # 関連する文書を検索
-        retriever = st.session_state.vector_store.as_retriever(search_kwargs={"k": ct.SEARCH_TOP_K})
-        docs = retriever.get_relevant_documents(param)
-        
-        # 検索結果を文脈として結合
-        context = "\n\n".join([doc.page_content for doc in docs])
-        
-        # プロンプトテンプレートに文脈を埋め込み
-        system_template = ct.COMPANY_LAW_TEMPLATE.format(context=context)
-        result = result_chain(param, system_template)
-        return result
-    except Exception as e:
-        return f"会社法の検索中にエラーが発生しました: {str(e)}"
-
-
-
@@ -5,6 +5,7 @@
 ############################################################
 # ライブラリの読み込み
 ############################################################
+import os
 from langchain_community.document_loaders import PyMuPDFLoader
 
 
@@ -51,9 +52,49 @@ SAMPLE_RATE = 41_000
 LOG_DIR_PATH = "./logs"
 LOGGER_NAME = "ApplicationLog"
 LOG_FILE = "application.log"
+# 回答本文などの大きなペイロードの全文を出力するファイル
+LOG_PAYLOAD_FILE = "payload.log"
+# 通常のログファイルに出力するメッセージの上限文字数（超えた分は切り詰め、全文はペイロード用ファイルに出力）
+LOG_MAX_MESSAGE_LENGTH = 500
+# 出力するログメッセージのフォーマット定義
+# - 「levelname」: ログの重要度（INFO, WARNING, ERRORなど）
+# - 「asctime」: ログのタイムスタンプ（いつ記録されたか）
+# - 「lineno」: ログが出力されたファイルの行番号
+# - 「funcName」: ログが出力された関数名
+# - 「session_id」: セッションID（誰のアプリ操作か分かるように、レコードごとに付与）
+# - 「message」: ログメッセージ
+LOG_FORMAT = "[%(levelname)s] %(asctime)s line %(lineno)s, in %(funcName)s, session_id=%(session_id)s: %(message)s"
 APP_BOOT_MESSAGE = "アプリが起動されました。"
 
 
+# ==========================================
+# 会話ログ保存系
+# ==========================================
+# 会話ログをセッションIDごとに保存するSQLiteデータベース
+HISTORY_DB_PATH = "./data/history.sqlite3"
+# メモリ（st.session_state）に保持する直近の会話の件数（ユーザー・AIそれぞれ1件と数える）
+HISTORY_MEMORY_WINDOW = 20
+SHOW_OLDER_HISTORY_BUTTON_LABEL = "以前の会話を表示（{count}件）"
+# 最後の会話からこの日数を過ぎたセッションの会話を削除する（Noneの場合は削除しない）
+HISTORY_RETENTION_DAYS = 30
+# 保存期間を過ぎた会話を削除する間隔（秒。プロセスの起動後、最初に会話ログを使う時点でも削除する）
+HISTORY_PURGE_INTERVAL_SECONDS = 60 * 60
+
+
+# ==========================================
+# 計測（メトリクス）系
+# ==========================================
+SPAN_LOGGER_NAME = "SpanLog"
+# リクエスト内の各処理の所要時間・トークン数を1行1件のJSONで出力するファイル
+SPAN_LOG_FILE = "spans.jsonl"
+# パーセンタイル算出用に、集計キーごとにメモリ上へ保持する直近の計測数
+METRICS_RESERVOIR_SIZE = 1000
+# 集計結果を返すメトリクスエンドポイント（GET /metrics）
+METRICS_SERVER_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 8502
+
+
 # ==========================================
 # LLM設定系
 # ==========================================
@@ -61,6 +102,140 @@ MODEL = "gpt-4o-mini"
 TEMPERATURE = 0.5
 ENCODING_KIND = "cl100k_base"
 AI_AGENT_MAX_ITERATIONS = 3
+# ストリーミング時にAgentのLLMの出力を識別するためのタグ
+AGENT_LLM_TAG = "agent_llm"
+# Agentの方式（「tool_calling」: モデルのツール呼び出し機能でToolを選択、「react」: テキストのAction行を解析してToolを選択）
+AGENT_BACKEND = os.getenv("AGENT_BACKEND", "tool_calling")
+# ツール呼び出し形式のAgentに渡すシステムプロンプト
+AGENT_SYSTEM_PROMPT = """
+あなたは、ビジネスと健康の悩みに答える相談アシスタントです。
+入力の[お悩み種別]と[選択ジャンル]、会話ログを踏まえ、選択ジャンルに対応する専門家のToolを使って回答してください。
+必要な場合だけ、Web検索やWikipedia検索のToolを使ってください。
+Toolの結果を受け取ったら、それをもとに日本語で最終回答を作成してください。
+"""
+
+
+# ==========================================
+# モデル階層系
+# ==========================================
+# モデルの階層（料金は100万トークンあたりのUSDで、階層ごとのコストの集計に使う）
+MODEL_TIERS = {
+    "fast": {"model": MODEL, "input_cost": 0.15, "cached_input_cost": 0.075, "output_cost": 0.60},
+    "strong": {"model": "gpt-4o", "input_cost": 2.50, "cached_input_cost": 1.25, "output_cost": 10.00},
+}
+# 処理ごとに使う階層（routing: AgentのTool選択、answer: 専門家AIの回答生成）
+MODEL_TIER_POLICY = {
+    "routing": "fast",
+    "answer": "fast",
+}
+# ジャンルごとの上書き（会社法は条文に基づく正確さを優先し、回答生成に上位の階層を使う）
+GENRE_MODEL_TIER_POLICY = {
+    ANSWER_MODE_10: {"answer": "strong"},
+}
+# 回答の確信度が低い場合に昇格させる階層（Noneの場合は昇格しない）
+MODEL_ESCALATION_TIER = "strong"
+# 回答の確信度（出力トークンの確率の幾何平均）がこの値を下回った場合に昇格
+MODEL_ESCALATION_CONFIDENCE = 0.6
+# LLMのメタデータに階層名を付与する際のキー
+MODEL_TIER_METADATA_KEY = "model_tier"
+
+
+# ==========================================
+# 相談エンジンAPI系
+# ==========================================
+# 相談エンジンAPIのURL（設定されている場合、画面からはAPI経由で回答を取得し、未設定の場合は同じプロセス内で実行する）
+ENGINE_API_URL = os.getenv("ENGINE_API_URL", "")
+ENGINE_API_HOST = "127.0.0.1"
+ENGINE_API_PORT = 8503
+# API呼び出しのタイムアウト（秒）
+ENGINE_API_TIMEOUT = 180
+
+
+# ==========================================
+# 検索サービス系
+# ==========================================
+# 検索サービスのURL（設定されている場合、会社法などの検索は検索サービス経由で行い、未設定の場合は同じプロセス内で行う）
+RETRIEVAL_SERVICE_URL = os.getenv("RETRIEVAL_SERVICE_URL", "")
+RETRIEVAL_SERVICE_HOST = "127.0.0.1"
+RETRIEVAL_SERVICE_PORT = 8504
+# 検索サービス呼び出しのタイムアウト（秒）
+RETRIEVAL_SERVICE_TIMEOUT = 30
+# 同時に届いた検索を1回の埋め込みリクエストにまとめるため、検索の開始を待つ時間（ミリ秒）
+RETRIEVAL_SERVICE_BATCH_WINDOW_MS = 5
+# 1回にまとめて検索するクエリ数の上限
+RETRIEVAL_SERVICE_MAX_BATCH = 32
+# 検索結果をキャッシュする件数（最近使われていないものから破棄）
+RETRIEVAL_SERVICE_CACHE_SIZE = 2048
+
+
+# ==========================================
+# 先行生成系
+# ==========================================
+# 音声入力の文字起こし結果で、送信前に回答の生成を始めておくかどうか
+SPECULATION_ENABLED = True
+# 先行生成を同時に実行する数の上限（プロセス全体）
+SPECULATION_MAX_WORKERS = 4
+# 送信されないまま先行生成を保持する時間（秒）
+SPECULATION_TTL_SECONDS = 600
+
+
+# ==========================================
+# 取り消し系
+# ==========================================
+# 共有している処理の結果を待っている間に、呼び出し元の取り消しを確認する間隔（秒）
+CANCELLATION_POLL_SECONDS = 0.5
+
+
+# ==========================================
+# バックグラウンドジョブ系
+# ==========================================
+# 回答生成のジョブを同時に実行する数（プロセス全体）
+JOB_MAX_WORKERS = 8
+# 実行待ちのジョブ数の上限（超えた場合は受け付けない）
+JOB_MAX_QUEUE = 64
+# 画面がジョブの状態を確認する間隔（秒）
+JOB_POLL_SECONDS = 0.5
+# この時間状態が確認されなかったジョブは、セッションが終了したとみなして取り消す（秒）
+JOB_ABANDON_SECONDS = 30
+# 終了したジョブの結果を保持する時間（秒）
+JOB_RESULT_TTL_SECONDS = 600
+
+
+# ==========================================
+# 一括回答（バッチ処理）系
+# ==========================================
+BATCH_DEFAULT_WORKERS = 4
+# 1分あたりに開始する質問数の上限
+BATCH_DEFAULT_RPM = 60
+
+
+# ==========================================
+# レート制限系
+# ==========================================
+# モデルごとの1分あたりのリクエスト数（rpm）・トークン数（tpm）の上限（Noneの場合は制限なし）
+# ここにないモデルは「default」の上限を使う（その場合は初回に警告をログ出力する）
+# 契約プランの上限に合わせて設定する（API側の残量はレスポンスヘッダーからも随時反映される）
+RATE_LIMITS = {
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200000},
+    # モデル階層「strong」（MODEL_TIERS）で使うモデル
+    "gpt-4o": {"rpm": 500, "tpm": 30000},
+    "text-embedding-ada-002": {"rpm": 3000, "tpm": 1000000},
+    "whisper-1": {"rpm": 50, "tpm": None},
+    "default": {"rpm": 500, "tpm": None},
+}
+# モデルごとの同時実行数（429の発生状況に応じて、1〜最大値の範囲で自動調整される）
+RATE_LIMIT_INITIAL_CONCURRENCY = 8
+RATE_LIMIT_MAX_CONCURRENCY = 32
+# 出力トークン数の上限が未指定のリクエストで、消費を見込む出力トークン数
+RATE_LIMIT_DEFAULT_COMPLETION_TOKENS = 500
+# 429の発生時に、待機時間がレスポンスヘッダーで示されない場合の待機時間（秒）
+RATE_LIMIT_DEFAULT_BACKOFF = 1.0
+# 429の発生時に、待機してから再送する回数
+RATE_LIMIT_MAX_RETRIES = 3
+# OpenAI API呼び出しのタイムアウト（秒）
+OPENAI_HTTP_TIMEOUT = 600
+# 待機中の接続を接続プールに保持する時間（秒）
+OPENAI_HTTP_KEEPALIVE_EXPIRY = 60
 
 
 # ==========================================
@@ -69,15 +244,99 @@ AI_AGENT_MAX_ITERATIONS = 3
 COMPANY_LAW_PDF_PATH = "./data/company_law.pdf"
 COMPANY_LAW_PDF_URL = "https://laws.e-gov.go.jp/data/Act/417AC0000000086/618544_1/417AC0000000086_20240522_506AC0000000032_h1.pdf"
 VECTOR_STORE_PATH = "./data/vector_store"
+# 検索対象の資料（コーパス）の一覧。コーパスごとに1つのベクトルストア（シャード）を作成する
+# - 「pdf_path」: 資料のPDF（「url」が未登録の資料は、PDFを配置するまで検索対象から除外される）
+# - 「store_path」: ベクトルストアの保存先
+COMPANY_LAW_CORPUS_ID = "company_law"
+CORPORA = {
+    COMPANY_LAW_CORPUS_ID: {
+        "name": "会社法",
+        "pdf_path": COMPANY_LAW_PDF_PATH,
+        "url": COMPANY_LAW_PDF_URL,
+        "store_path": VECTOR_STORE_PATH,
+    },
+    "labor_law": {
+        "name": "労働関係法令",
+        "pdf_path": "./data/corpora/labor_law.pdf",
+        "store_path": "./data/vector_stores/labor_law",
+    },
+    "health_guidelines": {
+        "name": "健康づくりのガイドライン",
+        "pdf_path": "./data/corpora/health_guidelines.pdf",
+        "store_path": "./data/vector_stores/health_guidelines",
+    },
+    "hr_policies": {
+        "name": "社内人事規程",
+        "pdf_path": "./data/corpora/hr_policies.pdf",
+        "store_path": "./data/vector_stores/hr_policies",
+    },
+}
+# ジャンルごとに検索するコーパス（ここにないジャンルの専門家AIはRAGを使わない）
+GENRE_CORPORA = {
+    ANSWER_MODE_5: ["labor_law", "hr_policies"],
+    ANSWER_MODE_6: ["hr_policies", "labor_law"],
+    ANSWER_MODE_8: ["health_guidelines"],
+    ANSWER_MODE_9: ["health_guidelines", "labor_law"],
+    ANSWER_MODE_10: [COMPANY_LAW_CORPUS_ID],
+}
+# 複数のシャードを並列に検索するスレッド数
+RETRIEVAL_MAX_WORKERS = 4
+# シャードの読み込み・作成に失敗した場合に、再試行するまでの時間（秒。その間は検索対象から除外する）
+SHARD_RETRY_SECONDS = 60
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 SEARCH_TOP_K = 5
+# 複合的な質問をサブクエリに分割して検索する場合に取得するチャンク数
+MULTI_QUERY_TOP_K = 8
+# 1つの質問から作成するサブクエリの上限（元の質問全体を含む）
+MAX_SUB_QUERIES = 4
+# サブクエリとして扱う最小文字数（これより短い断片は検索しない）
+SUB_QUERY_MIN_LENGTH = 2
 EMBEDDING_BATCH_SIZE = 100  # OpenAI Embedding APIの制限を考慮したバッチサイズ
+# PDFの取り込み時に、ページの解析に使うプロセス数
+INGEST_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+# 1つのプロセスにまとめて解析させるページ数
+INGEST_PAGES_PER_TASK = 8
+# PDFの取り込み時に、同時に送る埋め込みリクエスト数
+INGEST_EMBED_CONCURRENCY = 2
+# 新しく作成したシャードを、次元削減した圧縮インデックス（compact_index.py）に移行するかどうか
+# （既存のシャードは「python compact_index.py migrate」で移行する。移行済みのシャードは、この設定に関わらず2段階で検索する）
+COMPACT_INDEX_ENABLED = False
+# 次元削減の方法（"pca": 主成分分析 / "truncate": 先頭の次元だけを残す。text-embedding-3系のdimensionsオプションと同じ）
+COMPACT_METHOD = "pca"
+# 次元削減後の次元数
+COMPACT_DIMENSIONS = 256
+# 粗い検索で取得し、元の次元で再スコアリングする候補数（取得するチャンク数の倍数）
+COMPACT_RESCORE_FACTOR = 10
+# 圧縮インデックスの移行情報のファイル名（ベクトルストアの保存先に置き、検索に使うディレクトリを指す）
+COMPACT_MANIFEST_FILE = "compact.json"
+# 圧縮インデックスの元の次元のベクトル・射影のファイル名（移行ごとのディレクトリに置く）
+COMPACT_FULL_VECTORS_FILE = "full_vectors.npy"
+COMPACT_PROJECTION_FILE = "projection.npz"
+
+
+# ==========================================
+# FAQ（よくある質問）系
+# ==========================================
+FAQ_DIR_PATH = "./data/faq"
+# ログから抽出した回答候補（確認後に「approved」をtrueにしたものだけがインデックスに登録される）
+FAQ_CANDIDATES_PATH = "./data/faq/candidates.jsonl"
+FAQ_INDEX_PATH = "./data/faq/index"
+# FAQの回答を返す、質問同士のコサイン類似度の下限
+FAQ_MATCH_THRESHOLD = 0.93
+# ログの質問を同じ質問とみなしてまとめる、コサイン類似度の下限
+FAQ_CLUSTER_THRESHOLD = 0.9
+# 回答候補にする質問の最小出現回数
+FAQ_MIN_COUNT = 3
+# FAQの回答を会話の最初の質問にだけ使うかどうか
+FAQ_FIRST_TURN_ONLY = True
 
 
 # ==========================================
 # システムテンプレート
 # ==========================================
+# プロバイダー側のプロンプトキャッシュ（先頭が一致する部分の再利用）が効くよう、
+# システムテンプレートには固定の指示だけを記述し、質問ごとに変わる内容はユーザーメッセージの末尾に置く
 MARKEIING_STORATEGY_TEMPLATE = """
     あなたは優秀なマーケティング戦略の専門家です。
     ユーザーが提供する情報をもとに、ターゲット市場の分析、マーケティング戦略の立案、
@@ -101,12 +360,19 @@ COMPANY_LAW_TEMPLATE = """
     4. マークダウン記法で回答する際にhタグの見出しを使う場合、最も大きい見出しをh3としてください。
     5. 法律用語は分かりやすく説明を加えてください。
     6. 提供された文脈に該当する情報がない場合は、「提供された会社法の資料からは該当する情報が見つかりませんでした」と回答してください。
+"""
+# RAGを使う専門家AIのユーザーメッセージ（検索結果は質問ごとに変わるため、システムメッセージではなくこちらに含める）
+RAG_HUMAN_TEMPLATE = """【参考情報】
+{context}
 
-    【参考情報】
-    {context}
+【質問】
+{input}"""
+# RAGを使う専門家AI（会社法以外）のシステムテンプレートの末尾に加える指示
+RAG_SYSTEM_INSTRUCTION = """
+    ユーザーメッセージの【参考情報】に質問と関連する内容がある場合は、それを根拠として回答してください。
 """
 COMPANY_LAW_NAME = "会社法の専門家AI"
-COMPANY_LAW_DESCRIPTION = "会社法に関する質問に対して、条文に基づいた正確な回答を提供します。会社の設立、機関、株式、合併、解散などの法的事項について相談できます。"
+COMPANY_LAW_DESCRIPTION = "会社法に関する質問に対して、条文に基づいた正確な回答を提供します。会社の設立、機関、株式、合併、解散などの法的事項について相談できます。複数の論点を含む質問も、分けずに1回でまとめて渡してください。"
 
 SALES_STRATEGY_TEMPLATE = """
     あなたは優秀な営業戦略の専門家です。
@@ -165,7 +431,8 @@ SEARCH_WIKIPEDIA_INFO_TOOL_DESCRIPTION = "質問に回答するために必要
 # ==========================================
 # LLMレスポンスの一致判定用
 # ==========================================
-# (未使用のため削除済み)
+# Agentが反復回数の上限（AI_AGENT_MAX_ITERATIONS）に達して打ち切られた場合に、LangChainが返す固定の出力
+AGENT_STOPPED_OUTPUT = "Agent stopped due to max iterations."
 
 
 # ==========================================
@@ -176,3 +443,5 @@ INITIALIZE_ERROR_MESSAGE = "初期化処理に失敗しました。"
 CONVERSATION_LOG_ERROR_MESSAGE = "過去の会話履歴の表示に失敗しました。"
 GET_LLM_RESPONSE_ERROR_MESSAGE = "回答生成に失敗しました。"
 DISP_ANSWER_ERROR_MESSAGE = "回答表示に失敗しました。"
+AGENT_STOPPED_MESSAGE = "ご質問への回答をまとめきれませんでした。お手数ですが、質問を具体的にするか、いくつかに分けて再度お試しください。"
+JOB_QUEUE_FULL_MESSAGE = "ただいま混み合っているため、回答を生成できませんでした。しばらくしてから再度お試しください。"
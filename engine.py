@@ -0,0 +1,438 @@
+"""
+このファイルは、画面（Streamlit）から独立した相談エンジン（文脈付き入力の生成 → Agent Executor → 専門家AIのTool）が記述されたファイルです。
+
+LLM・Agent Executor・ベクトルストアなどの重いリソースはプロセス内で1つだけ作成して全リクエストで共有し、
+セッションごとの情報（お悩み種別・ジャンル・会話履歴）は呼び出しごとに引数で受け取ります。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import threading
+from contextlib import aclosing
+from langchain.agents import AgentExecutor, AgentType, create_tool_calling_agent, initialize_agent
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+import constants as ct
+import faq
+import cancellation
+from cancellation import CancellationCallbackHandler, CancellationToken
+import metrics
+import model_policy
+import rate_limiter
+import retrieval
+import singleflight
+import tools
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するリソース（モデルの階層ごとに作成）
+_llms = {}
+_agent_executors = {}
+_resource_lock = threading.Lock()
+
+# 同じ入力（お悩み種別・ジャンル・文脈付き入力）のAgentの実行を、実行中の1回にまとめる
+_agent_flight = singleflight.SingleFlight("agent")
+_agent_stream_flight = singleflight.StreamFlight("agent_stream")
+
+# Agentの最終回答の開始を示す文字列（ストリーミング時にここから後ろだけを返す）
+FINAL_ANSWER_MARKER = "Final Answer:"
+
+
+############################################################
+# クラス定義
+############################################################
+
+class _FinalAnswerFilter:
+    """
+    AgentのLLMの出力の断片から、最終回答の部分だけを取り出すクラス
+
+    ReAct形式では「Final Answer:」より後ろの部分だけを、ツール呼び出し形式では本文をそのまま最終回答とする
+    （ツール呼び出し形式では、Toolを呼び出す応答の本文は空になる）
+    """
+    def __init__(self):
+        self._buffers = {}
+        self._streamed_runs = set()
+
+    def feed(self, run_id, text):
+        """
+        LLMの出力の断片を受け取り、最終回答として返す部分を取得
+
+        Args:
+            run_id: LLM呼び出しの実行ID
+            text: 出力の断片
+
+        Returns:
+            最終回答の断片（最終回答でない・まだ最終回答に達していない場合は空文字）
+        """
+        if ct.AGENT_BACKEND == "tool_calling" or run_id in self._streamed_runs:
+            return text or ""
+        self._buffers[run_id] = self._buffers.get(run_id, "") + (text or "")
+        if FINAL_ANSWER_MARKER not in self._buffers[run_id]:
+            return ""
+        self._streamed_runs.add(run_id)
+        return self._buffers.pop(run_id).split(FINAL_ANSWER_MARKER, 1)[1].lstrip()
+
+
+class _AnswerEventCallbackHandler(BaseCallbackHandler):
+    """
+    Agent Executorの実行中のTool呼び出しと最終回答の断片を、イベントとして通知するコールバック
+    """
+    run_inline = True
+
+    def __init__(self, on_event):
+        self._on_event = on_event
+        self._filter = _FinalAnswerFilter()
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self._on_event({"event": "tool", "name": (serialized or {}).get("name", "")})
+
+    def on_llm_new_token(self, token, *, run_id, tags=None, **kwargs):
+        if ct.AGENT_LLM_TAG not in (tags or []):
+            return
+        text = self._filter.feed(run_id, token)
+        if text:
+            self._on_event({"event": "token", "text": text})
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_llm(tier=None):
+    """
+    Agent Executor用のLLMを取得（階層ごとにプロセス内で1回だけ作成）
+
+    Args:
+        tier: モデルの階層（未指定の場合はTool選択の標準の階層）
+
+    Returns:
+        LLM
+    """
+    tier = tier or model_policy.tier_for("routing")
+
+    if tier not in _llms:
+        with _resource_lock:
+            if tier not in _llms:
+                # ストリーミング時にAgentのLLMの出力だけを取り出せるよう、タグを付与しておく
+                _llms[tier] = model_policy.chat_model(
+                    tier,
+                    temperature=ct.TEMPERATURE,
+                    streaming=True,
+                    # ストリーミング時もAPIから使用量（キャッシュ済みの入力トークン数を含む）を受け取る
+                    stream_usage=True,
+                    tags=[ct.AGENT_LLM_TAG],
+                    http_async_client=rate_limiter.get_http_async_client(),
+                )
+    return _llms[tier]
+
+
+def get_agent_executor(mode_2=""):
+    """
+    Agent Executor（AIエージェント機能の実行を担当するオブジェクト）を取得（階層ごとにプロセス内で1回だけ作成）
+
+    Args:
+        mode_2: ジャンル（Tool選択に使うモデルの階層の決定に使う）
+
+    Returns:
+        Agent Executor
+    """
+    tier = model_policy.tier_for("routing", mode_2)
+
+    if tier not in _agent_executors:
+        llm = get_llm(tier)
+        with _resource_lock:
+            if tier not in _agent_executors:
+                _agent_executors[tier] = _build_agent_executor(llm)
+    return _agent_executors[tier]
+
+
+def _build_agent_executor(llm):
+    """
+    設定（AGENT_BACKEND）に応じたAgent Executorを作成
+
+    - tool_calling: モデルのツール呼び出し機能でToolを選択する（出力の書式解析が不要なため、書式エラーによる再試行が発生しない）
+    - react: テキストの「Action: / Action Input:」を解析してToolを選択する（従来の方式）
+    """
+    agent_tools = tools.build_tools()
+
+    if ct.AGENT_BACKEND == "tool_calling":
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", ct.AGENT_SYSTEM_PROMPT),
+            ("human", "{input}"),
+            MessagesPlaceholder("agent_scratchpad"),
+        ])
+        # ツール呼び出し形式のAgentは「early_stopping_method="generate"」に対応していないため、上限に達した場合はそこで打ち切る
+        # （打ち切られた場合の出力は_replace_stopped_outputで置き換える）
+        return AgentExecutor(
+            agent=create_tool_calling_agent(llm, agent_tools, prompt),
+            tools=agent_tools,
+            max_iterations=ct.AI_AGENT_MAX_ITERATIONS,
+        )
+
+    return initialize_agent(
+        llm=llm,
+        tools=agent_tools,
+        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+        max_iterations=ct.AI_AGENT_MAX_ITERATIONS,
+        early_stopping_method="generate",
+        handle_parsing_errors=True
+    )
+
+
+def warm_up():
+    """
+    共有リソース（エンコーダー・ベクトルストア・FAQインデックス・Agent Executor）を事前に作成
+    """
+    metrics.get_encoder()
+    retrieval.warm_up([ct.COMPANY_LAW_CORPUS_ID])
+    faq.get_faq_store()
+    get_agent_executor()
+
+
+def reset_resources():
+    """
+    共有リソースを破棄（次回の取得時に作成し直す）
+    """
+    with _resource_lock:
+        _llms.clear()
+        _agent_executors.clear()
+    retrieval.reset_vector_store()
+    faq.reset_faq_store()
+
+
+def build_conversational_input(chat_message, mode="", mode_2="", messages=None, max_turns=4):
+    """直近の会話ログとアプリのモード・ジャンルを踏まえた文脈付き入力テキストを生成する。
+
+    Args:
+        chat_message: ユーザーの最新入力
+        mode: お悩み種別
+        mode_2: ジャンル
+        messages: 表示用の会話ログ（{"role": ..., "content": ...}のリスト）
+        max_turns: 直近何ペア分の会話を含めるか
+
+    Returns:
+        文脈付きの入力テキスト
+    """
+    # ヘッダー作成：お悩み種別とジャンルを常に同じ形式・順序で含める
+    # （プロンプトの先頭側が会話をまたいで一致し、プロバイダー側のキャッシュが効きやすくなるように、
+    #   変わりにくい内容から順に「ヘッダー → 会話ログ → 最新の入力」の順で並べる）
+    header = "\n".join([
+        f"[お悩み種別: {mode or '未選択'}]",
+        f"[選択ジャンル: {mode_2 or '未選択'}]",
+    ])
+
+    # 表示用ログ（`messages`）から直近の会話を抽出（ユーザー/AIのテキストのみ使用）
+    history = []
+    if isinstance(messages, list):
+        # ユーザー/AIの発話本文があれば取り出す
+        for m in messages:
+            role = m.get("role") if isinstance(m, dict) else None
+            content = m.get("content") if isinstance(m, dict) else None
+            if role in ("user", "assistant") and isinstance(content, str):
+                history.append((role, content))
+
+    # 直近max_turnsペア分に圧縮
+    history_text = []
+    for role, content in history[-max_turns * 2:]:
+        prefix = "ユーザー:" if role == "user" else "アシスタント:"
+        history_text.append(f"{prefix} {content}")
+
+    history_block = "\n".join(history_text) if history_text else ""
+
+    # 最終的な入力テキスト
+    parts = [p for p in [header, history_block, f"ユーザー: {chat_message}"] if p]
+    return "\n\n".join(parts)
+
+
+def _prepare_input(chat_message, mode, mode_2, messages):
+    """
+    文脈付き入力テキストを生成し、計測用のスパンを記録
+    """
+    with metrics.span("context_build") as span:
+        contextual_input = build_conversational_input(chat_message, mode, mode_2, messages)
+        span["prompt_tokens"] = metrics.count_tokens(contextual_input)
+    return contextual_input
+
+
+def _faq_answer(chat_message, mode_2, messages):
+    """
+    FAQインデックスから回答を取得（該当しない場合はNone）
+    """
+    # 会話の途中の質問は前の発言に依存するため、設定により最初の質問だけを対象にする
+    if ct.FAQ_FIRST_TURN_ONLY and any(isinstance(m, dict) and m.get("role") == "user" for m in messages or []):
+        return None
+    return faq.lookup(chat_message, mode_2)
+
+
+def _flight_key(mode, mode_2, contextual_input):
+    """
+    Agentの実行をまとめるためのキーを作成
+    """
+    return (mode or "", mode_2 or "", singleflight.normalize(contextual_input))
+
+
+def _invoke_agent(contextual_input, mode_2="", on_event=None):
+    """
+    ジャンルに対応するAgent Executorを実行し、回答を取得
+    """
+    # LLM呼び出し・Tool呼び出し・Agentの反復ごとの所要時間とトークン数をコールバックで記録
+    callbacks = [metrics.MetricsCallbackHandler()]
+    # シングルフライトで実行する場合は、結果を待っている呼び出し元が全員取り消した場合に取り消されるトークンになる
+    cancel_token = cancellation.current_token()
+    if cancel_token is not None:
+        callbacks.append(CancellationCallbackHandler(cancel_token))
+    if on_event is not None:
+        callbacks.append(_AnswerEventCallbackHandler(on_event))
+    result = get_agent_executor(mode_2).invoke(
+        {"input": contextual_input},
+        config={"callbacks": callbacks}
+    )
+    # AgentExecutorは標準で{"output": "..."}形式を返す
+    return _replace_stopped_output(result.get("output", result))
+
+
+def _replace_stopped_output(answer):
+    """
+    反復回数の上限で打ち切られた場合のLangChainの固定の出力（英語）を、ユーザー向けのメッセージに置き換える
+    （ツール呼び出し形式のAgentは上限に達した時点で打ち切るため、この出力がそのまま返る）
+    """
+    if isinstance(answer, str) and answer.strip() == ct.AGENT_STOPPED_OUTPUT:
+        return ct.AGENT_STOPPED_MESSAGE
+    return answer
+
+
+def ask(chat_message, mode="", mode_2="", messages=None, use_faq=True, cancel_token=None, on_event=None):
+    """
+    Agent Executorを使用して、直近の会話文脈を含めた入力で回答を取得する。
+
+    選択中のジャンルのFAQに十分近い質問がある場合は、その回答をすぐに返す。
+    同じ入力の回答を生成中の場合は、新たにAgentを実行せずにその回答を受け取る
+    （この場合、途中経過のイベントは通知されない）。
+
+    Args:
+        chat_message: ユーザー入力値
+        mode: お悩み種別
+        mode_2: ジャンル
+        messages: 表示用の会話ログ
+        use_faq: FAQインデックスを使うかどうか（FAQの回答を事前生成する際はFalse）
+        cancel_token: 取り消し用のキャンセルトークン（取り消された場合はOperationCancelledを送出）
+        on_event: 途中経過のイベント（astreamと同じ形式の「tool」「token」）を受け取る関数
+
+    Returns:
+        文字列の回答
+    """
+    with metrics.request_trace(mode, mode_2):
+        if use_faq:
+            answer = _faq_answer(chat_message, mode_2, messages)
+            if answer is not None:
+                return answer
+
+        contextual_input = _prepare_input(chat_message, mode, mode_2, messages)
+        # 同じ入力の実行を共有している他の呼び出し元がいる間は、取り消されても実行を続ける
+        with cancellation.use_token(cancel_token):
+            return _agent_flight.do(
+                _flight_key(mode, mode_2, contextual_input),
+                lambda: _invoke_agent(contextual_input, mode_2, on_event)
+            )
+
+
+async def aask(chat_message, mode="", mode_2="", messages=None):
+    """
+    askの非同期版（イベントループをブロックせずに回答を取得する）
+
+    同じ入力のストリーミング（astream）と実行を共有するため、その最終回答を返す。
+
+    Args:
+        chat_message: ユーザー入力値
+        mode: お悩み種別
+        mode_2: ジャンル
+        messages: 表示用の会話ログ
+
+    Returns:
+        文字列の回答
+    """
+    answer = ""
+    # 呼び出し元が中断された場合も、ストリーミングの購読をすぐに終了する
+    async with aclosing(astream(chat_message, mode, mode_2, messages)) as events:
+        async for event in events:
+            if event["event"] == "final":
+                answer = event["answer"]
+    return answer
+
+
+async def astream(chat_message, mode="", mode_2="", messages=None):
+    """
+    回答をストリーミングで取得する非同期ジェネレーター
+
+    同じ入力の回答を生成中の場合は、新たにAgentを実行せずに同じイベント列を先頭から受け取る。
+
+    Args:
+        chat_message: ユーザー入力値
+        mode: お悩み種別
+        mode_2: ジャンル
+        messages: 表示用の会話ログ
+
+    Yields:
+        イベントの辞書
+        - {"event": "tool", "name": Tool名}: Toolの呼び出し開始
+        - {"event": "token", "text": 文字列}: 最終回答の断片
+        - {"event": "final", "answer": 文字列}: 最終回答の全文
+    """
+    with metrics.request_trace(mode, mode_2):
+        answer = await asyncio.to_thread(_faq_answer, chat_message, mode_2, messages)
+        if answer is not None:
+            yield {"event": "token", "text": answer}
+            yield {"event": "final", "answer": answer}
+            return
+
+        contextual_input = _prepare_input(chat_message, mode, mode_2, messages)
+        events = _agent_stream_flight.stream(
+            _flight_key(mode, mode_2, contextual_input),
+            lambda: _astream_agent(contextual_input, mode_2)
+        )
+        async for event in events:
+            yield event
+
+
+async def _astream_agent(contextual_input, mode_2=""):
+    """
+    Agent Executorをストリーミングで実行し、イベントを返す非同期ジェネレーター
+    """
+    # AgentのLLMの出力のうち、最終回答の部分だけを返す
+    answer_filter = _FinalAnswerFilter()
+    final_answer = None
+    completed = False
+    # 購読者が全員いなくなって（接続が切れて）タスクが中断された場合に、スレッドで実行中のToolも取り消す
+    cancel_token = CancellationToken()
+    events = get_agent_executor(mode_2).astream_events(
+        {"input": contextual_input},
+        config={"callbacks": [metrics.MetricsCallbackHandler(), CancellationCallbackHandler(cancel_token)]},
+        version="v2",
+    )
+    try:
+        with cancellation.use_token(cancel_token):
+            async for event in events:
+                kind = event["event"]
+                if kind == "on_tool_start":
+                    yield {"event": "tool", "name": event["name"]}
+                elif kind == "on_chat_model_stream" and ct.AGENT_LLM_TAG in event.get("tags", []):
+                    text = answer_filter.feed(event["run_id"], event["data"]["chunk"].content)
+                    if text:
+                        yield {"event": "token", "text": text}
+                elif kind == "on_chain_end" and event.get("parent_ids") == []:
+                    output = event["data"].get("output") or {}
+                    final_answer = output.get("output") if isinstance(output, dict) else output
+        completed = True
+    finally:
+        if not completed:
+            cancel_token.cancel("disconnected")
+
+    answer = _replace_stopped_output(final_answer)
+    if answer != final_answer:
+        # 打ち切られた場合の出力はLLMの出力ではなく、トークンとして返していないため、ここで返す
+        yield {"event": "token", "text": answer}
+    yield {"event": "final", "answer": answer or ""}
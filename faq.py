@@ -0,0 +1,124 @@
+"""
+このファイルは、よくある質問（FAQ）の回答を、事前に作成した埋め込みインデックスから返す処理が記述されたファイルです。
+
+インデックスは build_faq.py で作成します（ログから頻出の質問を抽出 → 回答を事前生成 → 確認済みの回答だけを登録）。
+選択中のジャンルで類似度がしきい値以上の質問が見つかった場合だけ、その回答をすぐに返し、
+見つからない場合は通常の処理（Agent Executor）で回答を生成します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import logging
+import threading
+from langchain_openai import OpenAIEmbeddings
+from langchain_community.vectorstores import FAISS
+import constants as ct
+import cancellation
+import metrics
+import rate_limiter
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するFAQインデックス（未作成・読み込みに失敗した場合はNone）
+_faq_store = None
+_faq_store_loaded = False
+_faq_store_lock = threading.Lock()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_faq_store():
+    """
+    FAQインデックスを取得（初回呼び出し時に読み込み）
+
+    Returns:
+        FAQインデックス（未作成の場合はNone）
+    """
+    global _faq_store, _faq_store_loaded
+
+    if not _faq_store_loaded:
+        with _faq_store_lock:
+            if not _faq_store_loaded:
+                _faq_store = _load_faq_store()
+                _faq_store_loaded = True
+    return _faq_store
+
+
+def reset_faq_store():
+    """
+    FAQインデックスを破棄（次回の取得時に読み込み直す）
+    """
+    global _faq_store, _faq_store_loaded
+
+    with _faq_store_lock:
+        _faq_store = None
+        _faq_store_loaded = False
+
+
+def _load_faq_store():
+    """
+    保存済みのFAQインデックスを読み込み
+
+    Returns:
+        FAQインデックス（未作成・読み込みに失敗した場合はNone）
+    """
+    if not os.path.exists(ct.FAQ_INDEX_PATH):
+        return None
+    try:
+        embeddings = OpenAIEmbeddings(http_client=rate_limiter.get_http_client())
+        return FAISS.load_local(ct.FAQ_INDEX_PATH, embeddings, allow_dangerous_deserialization=True)
+    except Exception as e:
+        logging.getLogger(ct.LOGGER_NAME).warning(f"FAQインデックスの読み込みに失敗しました: {e}")
+        return None
+
+
+def distance_to_similarity(distance):
+    """
+    FAISSの距離（L2距離の2乗）をコサイン類似度に変換（OpenAIの埋め込みは長さ1に正規化されている前提）
+    """
+    return 1.0 - distance / 2.0
+
+
+def lookup(question, mode_2):
+    """
+    選択中のジャンルのFAQから、質問に十分近い質問の回答を取得
+
+    Args:
+        question: ユーザーの質問
+        mode_2: ジャンル
+
+    Returns:
+        回答の文字列（類似度がしきい値未満、インデックスがない、または検索に失敗した場合はNone）
+    """
+    if not mode_2:
+        return None
+    store = get_faq_store()
+    if store is None:
+        return None
+
+    answer = None
+    with metrics.span("faq_lookup") as span:
+        try:
+            results = store.similarity_search_with_score(question, k=1, filter={"genre": mode_2})
+        except cancellation.OperationCancelled:
+            raise
+        except Exception as e:
+            # FAQの照合は高速化のためのものなので、失敗した場合はAgentでの回答生成に進む
+            logging.getLogger(ct.LOGGER_NAME).warning(f"FAQの検索に失敗しました: {e}")
+            span["error"] = type(e).__name__
+            results = []
+        if results:
+            doc, distance = results[0]
+            similarity = distance_to_similarity(float(distance))
+            span["similarity"] = round(similarity, 4)
+            if similarity >= ct.FAQ_MATCH_THRESHOLD:
+                answer = doc.metadata["answer"]
+                span["faq_id"] = doc.metadata.get("faq_id")
+        span["hit"] = answer is not None
+    return answer
@@ -0,0 +1,240 @@
+"""
+このファイルは、会話ログをセッションIDごとにローカルのSQLite（WALモード）へ保存する処理が記述されたファイルです。
+
+会話ログは追加のたびにSQLiteへ書き込み、メモリ（st.session_state）には直近の一定件数だけを保持します。
+それより古い会話は、画面で表示が求められた場合にだけSQLiteから読み込むため、
+会話が長く続いてもセッションごとのメモリ使用量は一定の範囲に収まります。
+
+最後の会話から HISTORY_RETENTION_DAYS 日を過ぎたセッションの会話は、起動時と、その後 HISTORY_PURGE_INTERVAL_SECONDS ごとに削除します
+（ブラウザを閉じただけのセッションは削除されないため、SQLiteのファイルが際限なく大きくならないようにする）。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import sqlite3
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from collections import deque
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有する保存先
+_store = None
+_store_lock = threading.Lock()
+
+# 保存期間を過ぎた会話を最後に削除した時刻
+_last_purge = None
+
+
+############################################################
+# クラス定義
+############################################################
+
+class HistoryStore:
+    """
+    会話ログを保存するSQLiteデータベース（プロセス内で1つの接続を共有する）
+    """
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # WALモードにすると、書き込み中も他のプロセス（分析用のスクリプトなど）から読み込める
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS turns (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID
+            """
+        )
+
+    def append(self, session_id, seq, role, content):
+        """
+        会話1件を保存
+
+        Args:
+            session_id: セッションID
+            seq: セッション内の連番
+            role: 「user」または「assistant」
+            content: 発話の内容（文字列または辞書）
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO turns (session_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                (session_id, seq, role, json.dumps(content, ensure_ascii=False), datetime.now().isoformat(timespec="seconds")),
+            )
+
+    def load(self, session_id, before_seq=None, limit=None):
+        """
+        会話を古い順に読み込む
+
+        Args:
+            session_id: セッションID
+            before_seq: この連番より前の会話だけを読み込む（未指定の場合はすべて）
+            limit: 読み込む件数の上限（新しい方から数える。未指定の場合は制限なし）
+
+        Returns:
+            (連番, {"role": ..., "content": ...}) のリスト
+        """
+        query = "SELECT seq, role, content FROM turns WHERE session_id = ?"
+        params = [session_id]
+        if before_seq is not None:
+            query += " AND seq < ?"
+            params.append(before_seq)
+        query += " ORDER BY seq DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [(seq, {"role": role, "content": json.loads(content)}) for seq, role, content in reversed(rows)]
+
+    def delete(self, session_id):
+        """
+        セッションの会話をすべて削除
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+
+    def purge_expired(self, retention_days):
+        """
+        最後の会話から保存期間を過ぎたセッションの会話をすべて削除
+
+        Args:
+            retention_days: 保存期間（日）
+
+        Returns:
+            削除した会話の件数
+        """
+        cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat(timespec="seconds")
+        with self._lock:
+            cursor = self._conn.execute(
+                """
+                DELETE FROM turns WHERE session_id IN (
+                    SELECT session_id FROM turns GROUP BY session_id HAVING MAX(created_at) < ?
+                )
+                """,
+                (cutoff,),
+            )
+        return cursor.rowcount
+
+
+class SessionHistory:
+    """
+    1セッション分の会話ログ（直近の会話だけをメモリに保持し、すべての会話をSQLiteに保存する）
+    """
+    def __init__(self, session_id, store=None, window=ct.HISTORY_MEMORY_WINDOW):
+        self.session_id = session_id
+        self._store = store or get_store()
+        # セッションIDはセッションごとに新しく作成するため、会話は空の状態から始める
+        self._recent = deque(maxlen=window)
+        self._next_seq = 0
+
+    def append(self, message):
+        """
+        会話1件を追加
+
+        Args:
+            message: {"role": ..., "content": ...} 形式の辞書
+        """
+        seq = self._next_seq
+        self._store.append(self.session_id, seq, message["role"], message["content"])
+        self._recent.append((seq, message))
+        self._next_seq += 1
+
+    def recent(self):
+        """
+        メモリに保持している直近の会話を古い順に取得
+
+        Returns:
+            {"role": ..., "content": ...} のリスト
+        """
+        return [message for _, message in self._recent]
+
+    def older_count(self):
+        """
+        メモリに保持していない（SQLiteにだけある）古い会話の件数
+        """
+        if not self._recent:
+            return 0
+        return self._recent[0][0]
+
+    def load_older(self):
+        """
+        メモリに保持していない古い会話を、SQLiteから古い順に読み込む（読み込んだ会話はメモリに保持しない）
+
+        Returns:
+            {"role": ..., "content": ...} のリスト
+        """
+        if not self._recent:
+            return []
+        return [message for _, message in self._store.load(self.session_id, before_seq=self._recent[0][0])]
+
+    def clear(self):
+        """
+        会話をすべて削除
+        """
+        self._store.delete(self.session_id)
+        self._recent.clear()
+        self._next_seq = 0
+
+    def __len__(self):
+        return len(self._recent)
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_store():
+    """
+    会話ログの保存先を取得（プロセス内で1回だけ作成）
+
+    Returns:
+        HistoryStore
+    """
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = HistoryStore(ct.HISTORY_DB_PATH)
+    _purge_if_due(_store)
+    return _store
+
+
+def _purge_if_due(store):
+    """
+    前回の削除から HISTORY_PURGE_INTERVAL_SECONDS を過ぎていれば、保存期間を過ぎた会話を削除
+    """
+    global _last_purge
+
+    if ct.HISTORY_RETENTION_DAYS is None:
+        return
+    now = time.monotonic()
+    with _store_lock:
+        if _last_purge is not None and now - _last_purge < ct.HISTORY_PURGE_INTERVAL_SECONDS:
+            return
+        _last_purge = now
+    try:
+        deleted = store.purge_expired(ct.HISTORY_RETENTION_DAYS)
+    except sqlite3.Error as e:
+        logging.getLogger(ct.LOGGER_NAME).warning(f"保存期間を過ぎた会話ログの削除に失敗しました: {e}")
+        return
+    if deleted:
+        logging.getLogger(ct.LOGGER_NAME).info(f"保存期間を過ぎた会話ログを{deleted}件削除しました")
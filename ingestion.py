@@ -0,0 +1,189 @@
+"""
+このファイルは、資料（PDF）を読み込んでベクトルストアを作成する取り込み処理が記述されたファイルです。
+
+PDF全体を一度にメモリへ読み込むのではなく、次の段階を順に流すパイプラインとして処理します。
+
+    1. ページの解析: 数ページずつプロセスプールで並列に解析
+    2. チャンク分割: 解析済みのページから順にチャンクへ分割（ジェネレーター）
+    3. 埋め込み: チャンクをバッチにまとめ、並列に埋め込みを作成してベクトルストアに追加
+
+各段階で処理中にできる件数に上限を設けているため、後段が詰まると前段は待機します（バックプレッシャー）。
+そのため、取り込み中のメモリ使用量は資料の大きさではなくバッチサイズで決まります
+（作成したベクトルストア自体は、従来どおりメモリ上に保持されます）。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import fitz
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _parse_pages(pdf_path, start, end):
+    """
+    PDFの指定範囲のページからテキストを取り出す（プロセスプールのワーカーで実行）
+
+    Args:
+        pdf_path: PDFのパス
+        start: 開始ページ（0始まり）
+        end: 終了ページ（このページは含まない）
+
+    Returns:
+        (テキスト, メタデータ) のリスト
+    """
+    pages = []
+    with fitz.open(pdf_path) as pdf:
+        for page_no in range(start, min(end, pdf.page_count)):
+            pages.append((pdf[page_no].get_text(), {
+                "source": pdf_path,
+                "file_path": pdf_path,
+                "page": page_no,
+                "total_pages": pdf.page_count,
+            }))
+    return pages
+
+
+def iter_pages(pdf_path, workers=ct.INGEST_WORKERS, pages_per_task=ct.INGEST_PAGES_PER_TASK):
+    """
+    PDFのページを、プロセスプールで並列に解析しながらページ順に返す
+
+    解析中・解析済みで未取得のタスクは「workers × 2」件までとし、それ以上は呼び出し元が取り出すまで解析を進めない
+
+    Args:
+        pdf_path: PDFのパス
+        workers: 解析に使うプロセス数
+        pages_per_task: 1タスクで解析するページ数
+
+    Yields:
+        ページのDocument
+    """
+    with fitz.open(pdf_path) as pdf:
+        page_count = pdf.page_count
+    ranges = iter(range(0, page_count, pages_per_task))
+
+    # Streamlitなどのスレッドから安全に起動できるよう、forkではなくspawnでワーカーを作成
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        pending = deque()
+        for start in ranges:
+            pending.append(executor.submit(_parse_pages, pdf_path, start, start + pages_per_task))
+            if len(pending) >= workers * 2:
+                break
+
+        while pending:
+            pages = pending.popleft().result()
+            # 1件取り出すごとに、次の範囲の解析を1件追加する
+            start = next(ranges, None)
+            if start is not None:
+                pending.append(executor.submit(_parse_pages, pdf_path, start, start + pages_per_task))
+            for text, metadata in pages:
+                yield Document(page_content=text, metadata=metadata)
+
+
+def iter_chunks(pages, metadata=None, chunk_size=ct.CHUNK_SIZE, chunk_overlap=ct.CHUNK_OVERLAP):
+    """
+    ページを順にチャンクへ分割
+
+    Args:
+        pages: ページのDocumentのイテラブル
+        metadata: 全チャンクに付与するメタデータ
+        chunk_size: チャンクの最大文字数
+        chunk_overlap: 前後のチャンクと重複させる文字数
+
+    Yields:
+        チャンクのDocument
+    """
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    )
+    for page in pages:
+        for chunk in text_splitter.split_documents([page]):
+            if metadata:
+                chunk.metadata.update(metadata)
+            yield chunk
+
+
+def iter_batches(items, batch_size):
+    """
+    要素を指定件数ずつのリストにまとめる
+
+    Yields:
+        要素のリスト
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _embed_batch(embeddings, batch):
+    """
+    チャンクのバッチの埋め込みを作成
+    """
+    return batch, embeddings.embed_documents([chunk.page_content for chunk in batch])
+
+
+def build_vector_store(pdf_path, embeddings, metadata=None, batch_size=ct.EMBEDDING_BATCH_SIZE,
+                       chunk_size=ct.CHUNK_SIZE, chunk_overlap=ct.CHUNK_OVERLAP):
+    """
+    PDFをストリーミングで取り込み、ベクトルストアを作成
+
+    Args:
+        pdf_path: PDFのパス
+        embeddings: 埋め込みモデル
+        metadata: 全チャンクに付与するメタデータ
+        batch_size: 1回の埋め込みリクエストで送るチャンク数
+        chunk_size: チャンクの最大文字数
+        chunk_overlap: 前後のチャンクと重複させる文字数
+
+    Returns:
+        ベクトルストア（チャンクが1件もない場合はNone）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    chunks = iter_chunks(iter_pages(pdf_path), metadata, chunk_size, chunk_overlap)
+    batches = iter_batches(chunks, batch_size)
+
+    vector_store = None
+    chunk_count = 0
+    batch_count = 0
+
+    def add(batch, vectors):
+        nonlocal vector_store, chunk_count, batch_count
+        text_embeddings = [(chunk.page_content, vector) for chunk, vector in zip(batch, vectors)]
+        metadatas = [chunk.metadata for chunk in batch]
+        if vector_store is None:
+            vector_store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas)
+        else:
+            vector_store.add_embeddings(text_embeddings, metadatas=metadatas)
+        chunk_count += len(batch)
+        batch_count += 1
+        logger.info(f"{batch_count}バッチ目の追加が完了しました（累計{chunk_count}チャンク）")
+
+    # 埋め込みはバッチ単位で並列に作成し、処理中のバッチが上限に達したら、最も古いバッチの完了を待ってから次を送る
+    with ThreadPoolExecutor(max_workers=ct.INGEST_EMBED_CONCURRENCY) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(_embed_batch, embeddings, batch))
+            if len(pending) >= ct.INGEST_EMBED_CONCURRENCY:
+                add(*pending.popleft().result())
+        while pending:
+            add(*pending.popleft().result())
+
+    logger.info(f"{chunk_count}個のチャンクを取り込みました")
+    return vector_store
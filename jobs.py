@@ -0,0 +1,283 @@
+"""
+このファイルは、回答生成をStreamlitのスクリプトの実行から切り離して行う、バックグラウンドのジョブ実行の仕組みが記述されたファイルです。
+
+    - submit: 回答生成のジョブを受け付け、ジョブを返す（ジョブIDで後から取得できる）
+    - get: ジョブの状態・途中経過（呼び出したTool）・回答の途中までの文字列・最終結果を取得
+    - cancel: ジョブを取り消す
+
+ジョブはプロセス全体で共有するスレッドプール（JOB_MAX_WORKERS）で実行し、実行待ちのジョブがJOB_MAX_QUEUEを超える場合は受け付けません。
+画面はジョブIDをセッションに保持して状態を定期的に確認（ポーリング）するため、生成中も画面の操作・再実行ができます。
+JOB_ABANDON_SECONDS の間状態が確認されなかったジョブは、セッションが終了したとみなして取り消します。
+
+実行待ちの件数・待ち時間（スパン「job_wait」）は、metrics の集計結果で確認できます。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import time
+import logging
+import threading
+import contextvars
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+import constants as ct
+import cancellation
+import metrics
+
+
+############################################################
+# 変数定義
+############################################################
+# ジョブの状態
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+FINISHED_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+# ジョブを実行するスレッドプール
+_executor = ThreadPoolExecutor(max_workers=ct.JOB_MAX_WORKERS, thread_name_prefix="job")
+
+# ジョブIDごとのジョブ
+_jobs = {}
+_lock = threading.Lock()
+
+# 受け付け・終了したジョブの件数
+_stats = {"submitted": 0, "rejected": 0, STATUS_DONE: 0, STATUS_FAILED: 0, STATUS_CANCELLED: 0}
+
+# 状態が確認されなくなったジョブの取り消しと、終了したジョブの破棄を行うスレッド
+_reaper = None
+
+
+############################################################
+# クラス定義
+############################################################
+
+class JobQueueFull(Exception):
+    """
+    実行待ちのジョブが上限に達しているため、ジョブを受け付けられないことを示すエラー
+    """
+
+
+class Job:
+    """
+    回答生成のジョブ1件分の状態
+
+    画面からは読み取りだけを行い、更新はジョブを実行するスレッドだけが行う
+    """
+    def __init__(self, session_id, key, token):
+        self.id = uuid4().hex
+        self.session_id = session_id
+        # ジョブの内容を識別するキー（同じ内容のジョブを引き継ぐかどうかの判定用）
+        self.key = key
+        self.token = token
+        self.status = STATUS_QUEUED
+        # 途中経過（呼び出したToolの名前）
+        self.progress = []
+        # 回答の途中までの文字列
+        self.partial = ""
+        self.result = None
+        self.error = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.last_polled = self.submitted_at
+        self._done = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def wait(self, timeout=None):
+        """
+        ジョブが終了するまで待つ
+
+        Returns:
+            終了した場合True、タイムアウトした場合False
+        """
+        return self._done.wait(timeout)
+
+    def on_event(self, event):
+        """
+        回答生成の途中経過のイベントを反映（engine.askのon_eventに渡す）
+        """
+        if event["event"] == "tool":
+            self.progress.append(event["name"])
+        elif event["event"] == "token":
+            self.partial += event["text"]
+
+
+############################################################
+# 関数定義
+############################################################
+
+def submit(session_id, fn, key=None):
+    """
+    回答生成のジョブを受け付ける（同じセッションで実行中のジョブは取り消す）
+
+    Args:
+        session_id: セッションID
+        fn: 回答を生成する関数（キーワード引数「cancel_token」「on_event」を受け取り、回答を返す）
+        key: ジョブの内容を識別するキー
+
+    Returns:
+        ジョブ
+
+    Raises:
+        JobQueueFull: 実行待ちのジョブが上限に達している場合
+    """
+    _start_reaper()
+    with _lock:
+        queued = sum(1 for job in _jobs.values() if job.status == STATUS_QUEUED)
+        if queued >= ct.JOB_MAX_QUEUE:
+            _stats["rejected"] += 1
+            raise JobQueueFull(f"実行待ちのジョブが上限（{ct.JOB_MAX_QUEUE}件）に達しています")
+
+    # 同じセッションで実行中の回答生成は取り消し、このジョブのキャンセルトークンを登録する
+    token = cancellation.start_request(session_id)
+    job = Job(session_id, key, token)
+    with _lock:
+        _jobs[job.id] = job
+        _stats["submitted"] += 1
+
+    # ログ・レート制限でセッションを識別できるよう、呼び出し元のコンテキストを引き継いで実行する
+    context = contextvars.copy_context()
+    _executor.submit(context.run, _run, job, fn)
+    return job
+
+
+def _run(job, fn):
+    """
+    ジョブを実行し、結果を反映
+    """
+    job.started_at = time.monotonic()
+    metrics.record_span("job_wait", (job.started_at - job.submitted_at) * 1000)
+    status, result, error = None, None, None
+    try:
+        # 実行を待っている間に取り消されたジョブは実行しない
+        job.token.raise_if_cancelled()
+        job.status = STATUS_RUNNING
+        result = fn(cancel_token=job.token, on_event=job.on_event)
+        status = STATUS_DONE
+    except cancellation.OperationCancelled as e:
+        status, error = STATUS_CANCELLED, e
+    except Exception as e:
+        status, error = STATUS_FAILED, e
+    finally:
+        status = status or STATUS_FAILED
+        cancellation.finish_request(job.session_id, job.token)
+        with _lock:
+            # 終了した状態と終了時刻は同時に設定する（終了済みのジョブに終了時刻がない状態を作らない）
+            job.result, job.error = result, error
+            job.finished_at = time.monotonic()
+            job.status = status
+            _stats[status] += 1
+        job._done.set()
+
+
+def get(job_id):
+    """
+    ジョブを取得（状態を確認したことを記録する）
+
+    Args:
+        job_id: ジョブID
+
+    Returns:
+        ジョブ（存在しない・破棄済みの場合はNone）
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        job.last_polled = time.monotonic()
+    return job
+
+
+def cancel(job_id, reason="cancelled"):
+    """
+    ジョブを取り消す
+
+    Args:
+        job_id: ジョブID
+        reason: 取り消しの理由
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is not None and not job.finished:
+        job.token.cancel(reason)
+
+
+def discard(job_id):
+    """
+    結果を受け取ったジョブを破棄
+
+    Args:
+        job_id: ジョブID
+    """
+    with _lock:
+        _jobs.pop(job_id, None)
+
+
+def _start_reaper():
+    """
+    状態が確認されなくなったジョブを取り消すスレッドを開始（プロセス内で1回だけ）
+    """
+    global _reaper
+
+    with _lock:
+        if _reaper is not None:
+            return
+        _reaper = threading.Thread(target=_reap, name="job-reaper", daemon=True)
+        _reaper.start()
+
+
+def _reap():
+    """
+    一定時間状態が確認されなかったジョブを取り消し、結果を保持する時間を過ぎたジョブを破棄
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    while True:
+        time.sleep(max(1.0, ct.JOB_ABANDON_SECONDS / 3))
+        # 1回の確認で失敗しても、スレッドを終了させずに次の確認を続ける
+        try:
+            _reap_once(time.monotonic(), logger)
+        except Exception as e:
+            logger.error(f"ジョブの取り消し・破棄に失敗しました: {e}")
+
+
+def _reap_once(now, logger):
+    """
+    状態が確認されなくなったジョブの取り消しと、結果を保持する時間を過ぎたジョブの破棄を1回行う
+    """
+    with _lock:
+        jobs = [(job, job.finished, job.finished_at) for job in _jobs.values()]
+    for job, finished, finished_at in jobs:
+        if finished:
+            if finished_at is not None and now - finished_at > ct.JOB_RESULT_TTL_SECONDS:
+                discard(job.id)
+        elif now - job.last_polled > ct.JOB_ABANDON_SECONDS:
+            logger.info(f"状態が確認されなくなったため、ジョブを取り消します: {job.id}")
+            job.token.cancel("session_ended")
+
+
+def snapshot():
+    """
+    ジョブの実行状況を取得
+
+    Returns:
+        実行待ち・実行中の件数、スレッド数・実行待ちの上限、受け付け・終了したジョブの件数
+    """
+    with _lock:
+        queued = sum(1 for job in _jobs.values() if job.status == STATUS_QUEUED)
+        running = sum(1 for job in _jobs.values() if job.status == STATUS_RUNNING)
+        return {
+            "queued": queued,
+            "running": running,
+            "workers": ct.JOB_MAX_WORKERS,
+            "queue_limit": ct.JOB_MAX_QUEUE,
+            **_stats,
+        }
+
+
+metrics.register_snapshot_provider("jobs", snapshot)
@@ -0,0 +1,181 @@
+"""
+このファイルは、アプリのログファイル（application.log とローテーション済みの application.log.*）を読み込むためのパーサーが記述されたファイルです。
+
+ログの1レコードは「[レベル] 日時 line 行番号, in 関数名, session_id=セッションID: メッセージ」の形式で、
+メッセージが複数行にわたる場合は、次のレコードの開始行までを同じレコードとして扱います。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import ast
+import glob
+from datetime import datetime
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# ログレコードの開始行（session_idは古いログには含まれないため任意）
+RECORD_PATTERN = re.compile(
+    r"^\[(?P<level>[A-Z]+)\] (?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) "
+    r"line (?P<lineno>\d+), in (?P<func>.+?)(?:, session_id=(?P<session_id>[^:]*))?: (?P<message>.*)$"
+)
+
+# AIの回答のレコード（{"message": {"mode": ..., "answer": ...}} の形式）の先頭
+ANSWER_PREFIX_PATTERN = re.compile(r"^\{['\"]message['\"]: \{")
+
+# ユーザーの質問のレコード（{"message": 質問, "application_mode": ...} の形式）の先頭
+QUESTION_PREFIX_PATTERN = re.compile(r"^\{['\"]message['\"]: ['\"]")
+
+
+############################################################
+# 関数定義
+############################################################
+
+def find_log_files(pattern=None, include_current=False):
+    """
+    ログファイルのパスを古い順に取得
+
+    Args:
+        pattern: globのパターン（未指定の場合はローテーション済みの application.log.*）
+        include_current: 出力中の application.log も含めるかどうか
+
+    Returns:
+        ログファイルのパスのリスト
+    """
+    if pattern is None:
+        pattern = os.path.join(ct.LOG_DIR_PATH, f"{ct.LOG_FILE}.*")
+    paths = sorted(glob.glob(pattern))
+    current = os.path.join(ct.LOG_DIR_PATH, ct.LOG_FILE)
+    if include_current and os.path.exists(current):
+        paths.append(current)
+    return paths
+
+
+def parse_lines(lines):
+    """
+    ログの行をレコード単位にまとめて解析
+
+    Args:
+        lines: ログの行（改行付きの文字列）のイテラブル
+
+    Yields:
+        レコードの辞書（level, timestamp, lineno, func, session_id, message）
+    """
+    record = None
+    for line in lines:
+        line = line.rstrip("\n")
+        match = RECORD_PATTERN.match(line)
+        if match:
+            if record is not None:
+                yield record
+            record = match.groupdict()
+            record["timestamp"] = datetime.strptime(record["timestamp"], "%Y-%m-%d %H:%M:%S,%f")
+            record["lineno"] = int(record["lineno"])
+            record["session_id"] = record["session_id"] or ""
+        elif record is not None:
+            # 複数行のメッセージの続き
+            record["message"] += "\n" + line
+    if record is not None:
+        yield record
+
+
+def iter_records(paths):
+    """
+    複数のログファイルのレコードを順に取得
+
+    Args:
+        paths: ログファイルのパスのリスト
+
+    Yields:
+        レコードの辞書
+    """
+    for path in paths:
+        with open(path, encoding="utf8", errors="replace") as f:
+            yield from parse_lines(f)
+
+
+def parse_payload(message):
+    """
+    辞書形式で出力されたメッセージ（{"message": ..., "application_mode": ...}）を解析
+
+    Args:
+        message: レコードのメッセージ
+
+    Returns:
+        辞書（辞書形式でない、または出力時に切り詰められて解析できない場合はNone）
+    """
+    if not message.startswith("{"):
+        return None
+    try:
+        payload = ast.literal_eval(message)
+    except (ValueError, SyntaxError):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def iter_consultations(records, parse_answers=True, on_unparsed=None):
+    """
+    ログのレコードから、ユーザーの質問とAIの回答の組を取得
+
+    質問のレコードの後、同じセッションで最初に出力された回答のレコードを、その質問への回答とみなす
+    質問のレコードが解析できない場合（切り詰めに対応する前のログで、長い質問が切り詰められている場合）は、
+    その質問への回答を前の質問と組み合わせないよう、次の回答のレコードまで読み飛ばす
+
+    Args:
+        records: レコードの辞書のイテラブル
+        parse_answers: 回答のレコードを解析して回答本文を取得するかどうか
+            （Falseの場合、数KBになる回答のレコードは先頭だけで判定し、answer はNoneのままにする）
+        on_unparsed: 解析できない質問のレコードを受け取る関数（件数の集計用）
+
+    Yields:
+        相談の辞書（session_id, timestamp, answered_at, mode, genre, question, answer）
+        回答が見つからない質問は answered_at・answer がNoneになる
+    """
+    # セッションIDごとの回答待ちの質問（解析できなかった質問の場合はNone）
+    pending = {}
+    for record in records:
+        session_id = record["session_id"]
+        if not parse_answers and ANSWER_PREFIX_PATTERN.match(record["message"]):
+            consultation = pending.pop(session_id, None)
+            if consultation is not None:
+                consultation["answered_at"] = record["timestamp"]
+                yield consultation
+            continue
+
+        payload = parse_payload(record["message"])
+        if payload is None or "message" not in payload:
+            if QUESTION_PREFIX_PATTERN.match(record["message"]):
+                if pending.get(session_id) is not None:
+                    yield pending[session_id]
+                pending[session_id] = None
+                if on_unparsed is not None:
+                    on_unparsed(record)
+            continue
+
+        message = payload["message"]
+        if isinstance(message, str):
+            # 前の質問に回答がないまま次の質問が来た場合は、回答なしとして出力
+            if pending.get(session_id) is not None:
+                yield pending[session_id]
+            pending[session_id] = {
+                "session_id": session_id,
+                "timestamp": record["timestamp"],
+                "answered_at": None,
+                "mode": payload.get("application_mode") or "",
+                "genre": payload.get("genre") or "",
+                "question": message,
+                "answer": None,
+            }
+        elif isinstance(message, dict):
+            consultation = pending.pop(session_id, None)
+            if consultation is not None:
+                consultation["answered_at"] = record["timestamp"]
+                consultation["answer"] = message.get("answer")
+                yield consultation
+
+    yield from (consultation for consultation in pending.values() if consultation is not None)
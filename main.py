@@ -26,6 +26,14 @@ from initialize import initialize
 import components as cn
 # （自作）変数（定数）がまとめて定義・管理されているモジュール
 import constants as ct
+# （自作）処理時間・トークン数の計測を行うモジュール
+import metrics
+# （自作）OpenAI API呼び出しのレート制限を行うモジュール
+import rate_limiter
+# （自作）回答生成の取り消しを行うモジュール
+import cancellation
+# （自作）回答生成をバックグラウンドで行うモジュール
+import jobs
 
 
 ############################################################
@@ -73,7 +81,7 @@ if "audio_recorder_key" not in st.session_state:
 if "audio_error_count" not in st.session_state:
     st.session_state.audio_error_count = 0
 if "openai_client" not in st.session_state:
-    st.session_state.openai_client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    st.session_state.openai_client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=rate_limiter.get_http_client())
 
 
 ############################################################
@@ -95,8 +103,15 @@ cn.display_select_genre()
 # 選択内容の表示（お悩み・ジャンル）
 cn.display_selected_filters()
 
+# ジャンル選択時に、そのジャンルで検索する資料の読み込みとAPIへの接続をバックグラウンドで済ませておく
+utils.warm_up_genre()
+
 # モード変更時の処理
 if cn.is_mode_changed():
+    # 実行中の回答生成・先行生成の取り消し（送信待ちのメッセージも破棄する）
+    utils.cancel_generation("mode_changed")
+    st.session_state.chat_message_to_send = None
+    st.session_state.processing_message = False
     # 会話履歴のクリア
     cn.clear_conversation_log()
     # ジャンル選択の初期化
@@ -155,7 +170,9 @@ with col2:
     # テキスト入力があった場合、session_stateに保存
     if chat_message_input:
         st.session_state.chat_message_to_send = chat_message_input
-        # テキスト入力時は音声入力の状態をリセット
+        # テキスト入力時は音声入力の状態をリセット（音声入力のテキストでの先行生成も取り消す）
+        if st.session_state.transcribed_text:
+            utils.cancel_speculation("superseded")
         st.session_state.transcribed_text = None
         st.session_state.last_audio_hash = None
         # audio_recorderをリセット（キーを変更してコンポーネントを再生成）
@@ -180,14 +197,18 @@ if audio_bytes and not st.session_state.get("chat_message_to_send") and not st.s
             temp_file.close()
             
             # OpenAI Whisper APIで音声をテキストに変換
-            with open(temp_file.name, "rb") as audio_file:
-                transcript = st.session_state.openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="ja"
-                )
+            with metrics.span("transcription", mode=st.session_state.mode, mode_2=st.session_state.mode_2) as span:
+                with open(temp_file.name, "rb") as audio_file:
+                    transcript = st.session_state.openai_client.audio.transcriptions.create(
+                        model="whisper-1",
+                        file=audio_file,
+                        language="ja"
+                    )
+                span["completion_tokens"] = metrics.count_tokens(transcript.text)
             
             st.session_state.transcribed_text = transcript.text
+            # ユーザーがテキストを確認している間に、回答の生成を始めておく
+            utils.start_speculation(transcript.text)
             
             # 成功したらエラーカウントをリセット
             st.session_state.audio_error_count = 0
@@ -219,6 +240,9 @@ if st.session_state.transcribed_text and not st.session_state.processing_message
         height=80,
         label_visibility="collapsed"
     )
+    # テキストが編集された場合は、元のテキストでの先行生成を取り消す
+    if edited_message != st.session_state.transcribed_text:
+        utils.cancel_speculation("edited")
     
     # 送信ボタン
     col_send, col_cancel = st.columns(2)
@@ -233,6 +257,8 @@ if st.session_state.transcribed_text and not st.session_state.processing_message
     
     with col_cancel:
         if st.button("✕ キャンセル", use_container_width=True, key="cancel_button"):
+            # 先行生成の取り消し
+            utils.cancel_speculation()
             # 音声関連の状態を完全にリセット
             st.session_state.transcribed_text = None
             st.session_state.last_audio_hash = None
@@ -250,13 +276,10 @@ if "chat_message_to_send" in st.session_state and st.session_state.chat_message_
 if chat_message:
     # メッセージ処理中フラグを立てる
     st.session_state.processing_message = True
-    
+
     # ==========================================
     # 7-1. ユーザーメッセージの表示
     # ==========================================
-    # ユーザーメッセージのログ出力
-    logger.info({"message": chat_message, "application_mode": st.session_state.mode})
-
     # ユーザーメッセージを表示
     with st.chat_message("user"):
         st.markdown(chat_message)
@@ -264,21 +287,44 @@ if chat_message:
     # ==========================================
     # 7-2. LLMからの回答取得
     # ==========================================
-    # 「st.spinner」でグルグル回っている間、表示の不具合が発生しないよう空のエリアを表示
-    res_box = st.empty()
-    # LLMによる回答生成（回答生成が完了するまでグルグル回す）
-    with st.spinner(ct.SPINNER_TEXT):
+    # 回答生成はバックグラウンドのジョブで行い、画面の再実行をまたいで同じメッセージのジョブを引き継ぐ
+    job = utils.get_llm_job(chat_message)
+    if job is None:
+        # ユーザーメッセージのログ出力（ジョブの受け付け時に1回だけ）
+        logger.info({"message": chat_message, "application_mode": st.session_state.mode, "genre": st.session_state.mode_2})
         try:
-            # 画面読み込み時に作成したRetrieverを使い、Chainを実行
-            llm_response = utils.get_llm_response(chat_message)
-        except Exception as e:
-            # エラーログの出力
-            logger.error(f"{ct.GET_LLM_RESPONSE_ERROR_MESSAGE}\n{e}")
-            # エラーメッセージの画面表示
-            st.error(utils.build_error_message(ct.GET_LLM_RESPONSE_ERROR_MESSAGE), icon=ct.ERROR_ICON)
-            # 後続の処理を中断
+            job = utils.submit_llm_job(chat_message)
+        except jobs.JobQueueFull as e:
+            logger.warning(f"{ct.JOB_QUEUE_FULL_MESSAGE}\n{e}")
+            st.session_state.chat_message_to_send = None
+            st.session_state.processing_message = False
+            st.error(ct.JOB_QUEUE_FULL_MESSAGE, icon=ct.ERROR_ICON)
             st.stop()
-    
+
+    if not job.finished:
+        # 生成中は途中経過を表示して、このスクリプトの実行を終える（終了時に画面全体が再実行される）
+        cn.display_job_progress(job.id)
+        st.stop()
+
+    try:
+        llm_response = utils.take_llm_job_result(job)
+    except cancellation.OperationCancelled as e:
+        # 取り消された回答生成（セッションの終了など）は、エラーを表示せずに終了
+        logger.info(f"回答生成を取り消しました: {e}")
+        st.session_state.chat_message_to_send = None
+        st.session_state.processing_message = False
+        st.stop()
+    except Exception as e:
+        # エラーログの出力
+        logger.error(f"{ct.GET_LLM_RESPONSE_ERROR_MESSAGE}\n{e}")
+        # エラーメッセージの画面表示
+        st.error(utils.build_error_message(ct.GET_LLM_RESPONSE_ERROR_MESSAGE), icon=ct.ERROR_ICON)
+        # 同じメッセージで生成し直さないよう、送信待ちのメッセージを破棄する
+        st.session_state.chat_message_to_send = None
+        st.session_state.processing_message = False
+        # 後続の処理を中断
+        st.stop()
+
     # ==========================================
     # 7-3. LLMからの回答表示
     # ==========================================
@@ -305,7 +351,7 @@ if chat_message:
                 content = cn.display_contact_llm_response(llm_response)
             
             # AIメッセージのログ出力
-            logger.info({"message": content, "application_mode": st.session_state.mode})
+            logger.info({"message": content, "application_mode": st.session_state.mode, "genre": st.session_state.mode_2})
         except Exception as e:
             # エラーログの出力
             logger.error(f"{ct.DISP_ANSWER_ERROR_MESSAGE}\n{e}")
@@ -318,9 +364,9 @@ if chat_message:
     # 7-4. 会話ログへの追加
     # ==========================================
     # 表示用の会話ログにユーザーメッセージを追加
-    st.session_state.messages.append({"role": "user", "content": chat_message})
+    st.session_state.history.append({"role": "user", "content": chat_message})
     # 表示用の会話ログにAIメッセージを追加
-    st.session_state.messages.append({"role": "assistant", "content": content})
+    st.session_state.history.append({"role": "assistant", "content": content})
     
     # ==========================================
     # 7-5. セッション状態のクリーンアップ
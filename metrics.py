@@ -0,0 +1,564 @@
+"""
+このファイルは、リクエストごとの処理時間・トークン数の計測（スパン）と、その集計結果を返すメトリクスエンドポイントが記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import json
+import time
+import logging
+import threading
+import contextvars
+from uuid import uuid4
+from datetime import datetime
+from contextlib import contextmanager
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import tiktoken
+from langchain_core.callbacks import BaseCallbackHandler
+import constants as ct
+import app_logging
+
+
+############################################################
+# 変数定義
+############################################################
+# 実行中のリクエスト（チャット1回分）の情報
+_trace_var = contextvars.ContextVar("request_trace", default=None)
+
+# 消費トークン数カウント用のオブジェクト（プロセス内で共有）
+_encoder = None
+_encoder_lock = threading.Lock()
+
+# メトリクスエンドポイントのサーバー（プロセス内で1つだけ）
+_server = None
+_server_lock = threading.Lock()
+
+# 集計結果に含める追加の状態（名前 → 状態を返す関数）
+_snapshot_providers = {}
+
+
+############################################################
+# クラス定義
+############################################################
+
+class RequestTrace:
+    """
+    チャット1回分のリクエストの識別情報
+    """
+    def __init__(self, mode, mode_2):
+        self.request_id = uuid4().hex
+        self.mode = mode or ""
+        self.mode_2 = mode_2 or ""
+        # リクエスト内のLLM呼び出しの合計
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost_usd = 0.0
+
+    def add_llm_usage(self, span):
+        """
+        LLM呼び出しのスパンのトークン数をリクエストの合計に加算
+        """
+        self.llm_calls += 1
+        self.prompt_tokens += span.get("prompt_tokens") or 0
+        self.completion_tokens += span.get("completion_tokens") or 0
+        self.cached_tokens += span.get("cached_tokens") or 0
+        self.cost_usd += span.get("cost_usd") or 0.0
+
+
+class MetricsRegistry:
+    """
+    スパンの所要時間・トークン数を「スパン名・お悩み種別・ジャンル」単位で集計するクラス
+    """
+    def __init__(self, reservoir_size=ct.METRICS_RESERVOIR_SIZE):
+        self._lock = threading.Lock()
+        self._durations = defaultdict(lambda: deque(maxlen=reservoir_size))
+        self._counts = defaultdict(int)
+        self._prompt_tokens = defaultdict(int)
+        self._completion_tokens = defaultdict(int)
+        self._cached_tokens = defaultdict(int)
+        # LLM呼び出しの「モデルの階層・モデル」単位の集計
+        self._tier_durations = defaultdict(lambda: deque(maxlen=reservoir_size))
+        self._tier_totals = defaultdict(lambda: defaultdict(float))
+
+    def add(self, span):
+        """
+        スパン1件を集計に追加
+
+        Args:
+            span: record_spanで作成したスパンの辞書
+        """
+        key = (span["name"], span["mode"], span["mode_2"])
+        with self._lock:
+            self._durations[key].append(span["duration_ms"])
+            self._counts[key] += 1
+            self._prompt_tokens[key] += span.get("prompt_tokens") or 0
+            self._completion_tokens[key] += span.get("completion_tokens") or 0
+            self._cached_tokens[key] += span.get("cached_tokens") or 0
+            if span["name"] == "llm" and span.get("tier"):
+                tier_key = (span["tier"], span.get("model", ""))
+                self._tier_durations[tier_key].append(span["duration_ms"])
+                totals = self._tier_totals[tier_key]
+                totals["count"] += 1
+                totals["errors"] += 1 if span.get("error") else 0
+                for field in ("prompt_tokens", "completion_tokens", "cached_tokens", "cost_usd"):
+                    totals[field] += span.get(field) or 0
+
+    def tier_snapshot(self):
+        """
+        モデルの階層ごとの集計結果を取得
+
+        Returns:
+            階層・モデルごとの件数・パーセンタイル・合計トークン数・合計コストのリスト
+        """
+        with self._lock:
+            items = [(key, sorted(durations), dict(self._tier_totals[key])) for key, durations in self._tier_durations.items()]
+
+        results = []
+        for (tier, model), durations, totals in sorted(items):
+            results.append({
+                "tier": tier,
+                "model": model,
+                "count": int(totals.get("count", 0)),
+                "errors": int(totals.get("errors", 0)),
+                "p50_ms": percentile(durations, 50),
+                "p95_ms": percentile(durations, 95),
+                "prompt_tokens": int(totals.get("prompt_tokens", 0)),
+                "completion_tokens": int(totals.get("completion_tokens", 0)),
+                "cached_tokens": int(totals.get("cached_tokens", 0)),
+                "cost_usd": round(totals.get("cost_usd", 0.0), 6),
+            })
+        return results
+
+    def snapshot(self):
+        """
+        現時点の集計結果を取得
+
+        Returns:
+            集計キーごとの件数・パーセンタイル・合計トークン数のリスト
+        """
+        with self._lock:
+            items = [(key, sorted(durations)) for key, durations in self._durations.items()]
+            counts = dict(self._counts)
+            prompt_tokens = dict(self._prompt_tokens)
+            completion_tokens = dict(self._completion_tokens)
+            cached_tokens = dict(self._cached_tokens)
+
+        results = []
+        for (name, mode, mode_2), durations in sorted(items):
+            results.append({
+                "name": name,
+                "mode": mode,
+                "mode_2": mode_2,
+                "count": counts[(name, mode, mode_2)],
+                "p50_ms": percentile(durations, 50),
+                "p95_ms": percentile(durations, 95),
+                "p99_ms": percentile(durations, 99),
+                "prompt_tokens": prompt_tokens[(name, mode, mode_2)],
+                "completion_tokens": completion_tokens[(name, mode, mode_2)],
+                "cached_tokens": cached_tokens[(name, mode, mode_2)],
+            })
+        return results
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Agent Executorの実行中に発生するイベントから、LLM呼び出し・Tool呼び出し・Agentの反復ごとのスパンを記録するコールバック
+    """
+    # 非同期実行時もイベントの順序が入れ替わらないよう、別スレッドに回さずその場で処理する
+    run_inline = True
+
+    def __init__(self):
+        self._llm_runs = {}
+        self._tool_runs = {}
+        self._iteration = 0
+        self._iteration_start = None
+        self._iteration_tool = None
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        # 最上位のChain（Agent Executor）の開始を、1回目の反復の開始とする
+        if parent_run_id is None and self._iteration_start is None:
+            self._iteration_start = time.perf_counter()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        text = "\n".join(str(m.content) for batch in messages for m in batch)
+        self._start_llm_run(serialized, text, run_id, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start_llm_run(serialized, "\n".join(prompts), run_id, kwargs)
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._llm_runs.get(run_id)
+        if run and run["first_token"] is None:
+            run["first_token"] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._llm_runs.pop(run_id, None)
+        if run is None:
+            return
+        ttft_ms = None
+        if run["first_token"] is not None:
+            ttft_ms = (run["first_token"] - run["start"]) * 1000
+        # APIから使用量（キャッシュ済みの入力トークン数を含む）が返された場合はそれを使い、なければ推定値を使う
+        usage = _usage_from_result(response)
+        if usage is None:
+            text = "".join(g.text for batch in response.generations for g in batch)
+            usage = {"prompt_tokens": run["prompt_tokens"], "completion_tokens": count_tokens(text)}
+        record_span(
+            "llm",
+            (time.perf_counter() - run["start"]) * 1000,
+            model=run["model"],
+            tier=run["tier"],
+            ttft_ms=ttft_ms,
+            cost_usd=llm_cost(run["tier"], usage),
+            **usage,
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._llm_runs.pop(run_id, None)
+        if run is not None:
+            record_span(
+                "llm",
+                (time.perf_counter() - run["start"]) * 1000,
+                model=run["model"],
+                tier=run["tier"],
+                prompt_tokens=run["prompt_tokens"],
+                error=type(error).__name__,
+            )
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._tool_runs[run_id] = {
+            "name": (serialized or {}).get("name", ""),
+            "start": time.perf_counter(),
+            "prompt_tokens": count_tokens(input_str),
+        }
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        run = self._tool_runs.pop(run_id, None)
+        if run is not None:
+            record_span(
+                "tool",
+                (time.perf_counter() - run["start"]) * 1000,
+                tool=run["name"],
+                prompt_tokens=run["prompt_tokens"],
+                completion_tokens=count_tokens(str(output)),
+            )
+        # Toolの実行完了までを1回分の反復とする
+        if self._iteration_tool is not None:
+            self._end_iteration()
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        run = self._tool_runs.pop(run_id, None)
+        if run is not None:
+            record_span(
+                "tool",
+                (time.perf_counter() - run["start"]) * 1000,
+                tool=run["name"],
+                prompt_tokens=run["prompt_tokens"],
+                error=type(error).__name__,
+            )
+        if self._iteration_tool is not None:
+            self._end_iteration()
+
+    def on_agent_action(self, action, *, run_id, **kwargs):
+        self._iteration_tool = action.tool
+
+    def on_agent_finish(self, finish, *, run_id, **kwargs):
+        self._end_iteration()
+
+    def _start_llm_run(self, serialized, text, run_id, kwargs):
+        params = kwargs.get("invocation_params") or {}
+        self._llm_runs[run_id] = {
+            "model": params.get("model_name") or params.get("model") or "",
+            # model_policyで作成したモデルには、メタデータに階層名が付与されている
+            "tier": (kwargs.get("metadata") or {}).get(ct.MODEL_TIER_METADATA_KEY),
+            "start": time.perf_counter(),
+            "first_token": None,
+            "prompt_tokens": count_tokens(text),
+        }
+
+    def _end_iteration(self):
+        now = time.perf_counter()
+        self._iteration += 1
+        if self._iteration_start is not None:
+            record_span(
+                "agent_iteration",
+                (now - self._iteration_start) * 1000,
+                iteration=self._iteration,
+                tool=self._iteration_tool,
+            )
+        self._iteration_start = now
+        self._iteration_tool = None
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    メトリクスエンドポイント（GET /metrics）のリクエスト処理
+    """
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = json.dumps(snapshot(), ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # アクセスログは標準エラー出力に出さない
+        pass
+
+
+# プロセス内で共有する集計オブジェクト
+registry = MetricsRegistry()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _usage_from_result(response):
+    """
+    LLMの実行結果から、APIが返したトークン数を取得
+
+    Args:
+        response: LLMの実行結果（LLMResult）
+
+    Returns:
+        「prompt_tokens」「completion_tokens」「cached_tokens」の辞書（使用量が含まれない場合はNone）
+    """
+    for batch in response.generations:
+        for generation in batch:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return {
+                    "prompt_tokens": usage.get("input_tokens"),
+                    "completion_tokens": usage.get("output_tokens"),
+                    "cached_tokens": (usage.get("input_token_details") or {}).get("cache_read") or 0,
+                }
+
+    token_usage = (response.llm_output or {}).get("token_usage") or {}
+    if token_usage:
+        return {
+            "prompt_tokens": token_usage.get("prompt_tokens"),
+            "completion_tokens": token_usage.get("completion_tokens"),
+            "cached_tokens": (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0,
+        }
+    return None
+
+
+def llm_cost(tier, usage):
+    """
+    LLM呼び出し1回のコストを、階層の料金から算出
+
+    Args:
+        tier: モデルの階層（未設定の場合はNone）
+        usage: 「prompt_tokens」「completion_tokens」「cached_tokens」の辞書
+
+    Returns:
+        コスト（USD。階層が不明な場合はNone）
+    """
+    prices = ct.MODEL_TIERS.get(tier) if tier else None
+    if prices is None:
+        return None
+    cached = usage.get("cached_tokens") or 0
+    prompt = (usage.get("prompt_tokens") or 0) - cached
+    completion = usage.get("completion_tokens") or 0
+    cost = prompt * prices["input_cost"] + cached * prices["cached_input_cost"] + completion * prices["output_cost"]
+    return round(cost / 1_000_000, 8)
+
+
+def get_encoder():
+    """
+    消費トークン数カウント用のオブジェクトを取得（プロセス内で1回だけ作成）
+
+    Returns:
+        tiktokenのエンコーダー
+    """
+    global _encoder
+
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                _encoder = tiktoken.get_encoding(ct.ENCODING_KIND)
+    return _encoder
+
+
+def count_tokens(text):
+    """
+    テキストのトークン数を計測
+
+    Args:
+        text: 計測対象のテキスト
+
+    Returns:
+        トークン数
+    """
+    if not text:
+        return 0
+    return len(get_encoder().encode(text, disallowed_special=()))
+
+
+def percentile(sorted_values, pct):
+    """
+    ソート済みの値からパーセンタイル値を算出（最近傍順位法）
+
+    Args:
+        sorted_values: 昇順にソートされた値のリスト
+        pct: パーセンタイル（0〜100）
+
+    Returns:
+        パーセンタイル値（値が空の場合はNone）
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return round(sorted_values[int(rank) - 1], 2)
+
+
+def current_trace():
+    """
+    計測中のリクエストの識別情報を取得
+
+    Returns:
+        リクエストの識別情報（計測範囲の外側の場合はNone）
+    """
+    return _trace_var.get()
+
+
+@contextmanager
+def request_trace(mode, mode_2):
+    """
+    チャット1回分のリクエストの計測範囲を設定し、終了時にリクエスト全体のスパンを記録
+
+    すでに計測範囲の内側にいる場合は、新しい範囲を作らず外側のリクエストの一部として計測する
+
+    Args:
+        mode: お悩み種別
+        mode_2: ジャンル
+
+    Yields:
+        リクエストの識別情報
+    """
+    current = _trace_var.get()
+    if current is not None:
+        yield current
+        return
+
+    trace = RequestTrace(mode, mode_2)
+    token = _trace_var.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        record_span("request", (time.perf_counter() - start) * 1000)
+        try:
+            _trace_var.reset(token)
+        except ValueError:
+            # 非同期ジェネレーターが別のコンテキストで終了した場合
+            _trace_var.set(None)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    ブロック内の処理時間をスパンとして記録
+
+    ブロック内で返却された辞書に「prompt_tokens」「completion_tokens」などを設定すると、スパンの属性として記録される
+
+    Args:
+        name: スパン名
+        attrs: スパンに記録する属性
+
+    Yields:
+        スパンに記録する属性の辞書
+    """
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        record_span(name, (time.perf_counter() - start) * 1000, **attrs)
+
+
+def record_span(name, duration_ms, **attrs):
+    """
+    スパンをJSONLファイルに出力し、集計に追加
+
+    Args:
+        name: スパン名
+        duration_ms: 所要時間（ミリ秒）
+        attrs: スパンに記録する属性
+    """
+    trace = _trace_var.get()
+    mode = attrs.pop("mode", "")
+    mode_2 = attrs.pop("mode_2", "")
+    span_data = {
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "name": name,
+        "request_id": trace.request_id if trace else None,
+        "session_id": app_logging.get_session_id(),
+        "mode": trace.mode if trace else mode,
+        "mode_2": trace.mode_2 if trace else mode_2,
+        "duration_ms": round(duration_ms, 2),
+    }
+    span_data.update({key: value for key, value in attrs.items() if value is not None})
+
+    if trace is not None and name == "llm":
+        trace.add_llm_usage(span_data)
+
+    registry.add(span_data)
+    logging.getLogger(ct.SPAN_LOGGER_NAME).info(json.dumps(span_data, ensure_ascii=False))
+
+
+def register_snapshot_provider(name, provider):
+    """
+    集計結果に含める追加の状態を登録
+
+    Args:
+        name: 集計結果のキー
+        provider: 状態を返す関数（引数なし）
+    """
+    _snapshot_providers[name] = provider
+
+
+def snapshot():
+    """
+    メトリクスエンドポイントで返す集計結果を取得
+
+    Returns:
+        スパンの集計結果と、登録された追加の状態の辞書
+    """
+    result = {"spans": registry.snapshot(), "model_tiers": registry.tier_snapshot()}
+    for name, provider in list(_snapshot_providers.items()):
+        result[name] = provider()
+    return result
+
+
+def start_metrics_server():
+    """
+    集計結果を返すメトリクスエンドポイントを、バックグラウンドのスレッドで起動（プロセス内で1回だけ実行される）
+    """
+    global _server
+
+    if not ct.METRICS_SERVER_ENABLED or _server is not None:
+        return
+
+    with _server_lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer((ct.METRICS_HOST, ct.METRICS_PORT), _MetricsRequestHandler)
+        except OSError as e:
+            # 同じポートを別プロセスが使用中の場合は、エンドポイントなしで動作を継続
+            logging.getLogger(ct.LOGGER_NAME).warning(f"メトリクスエンドポイントの起動に失敗しました: {e}")
+            _server = False
+            return
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
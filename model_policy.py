@@ -0,0 +1,81 @@
+"""
+このファイルは、処理（ステップ）とジャンルに応じて使うモデルの階層を決めるポリシーが記述されたファイルです。
+
+    - routing: AgentがToolを選択する処理
+    - answer: 専門家AIが回答を生成する処理
+
+各処理はまず constants.py の MODEL_TIER_POLICY（ジャンルごとの上書きは GENRE_MODEL_TIER_POLICY）の階層で実行し、
+回答生成の確信度（出力トークンの確率の幾何平均）が低い場合にだけ、上位の階層（MODEL_ESCALATION_TIER）で生成し直します。
+階層ごとの所要時間・トークン数・コストは、metrics の集計結果（model_tiers）で確認できます。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import math
+from langchain_openai import ChatOpenAI
+import constants as ct
+import rate_limiter
+
+
+############################################################
+# 関数定義
+############################################################
+
+def tier_for(step, mode_2=""):
+    """
+    処理とジャンルに対応するモデルの階層を取得
+
+    Args:
+        step: 処理の種類（「routing」「answer」）
+        mode_2: ジャンル
+
+    Returns:
+        階層名（constants.py の MODEL_TIERS のキー）
+    """
+    override = ct.GENRE_MODEL_TIER_POLICY.get(mode_2, {})
+    return override.get(step, ct.MODEL_TIER_POLICY[step])
+
+
+def can_escalate(tier):
+    """
+    階層が、確信度が低い場合の昇格の対象かどうか
+    """
+    return ct.MODEL_ESCALATION_TIER is not None and tier != ct.MODEL_ESCALATION_TIER
+
+
+def chat_model(tier, **kwargs):
+    """
+    階層に対応するチャットモデルを作成
+
+    計測用のコールバックで階層ごとに集計できるよう、階層名をメタデータに付与する
+
+    Args:
+        tier: 階層名
+        kwargs: ChatOpenAIに渡す追加の引数
+
+    Returns:
+        ChatOpenAI
+    """
+    return ChatOpenAI(
+        model_name=ct.MODEL_TIERS[tier]["model"],
+        metadata={ct.MODEL_TIER_METADATA_KEY: tier},
+        http_client=rate_limiter.get_http_client(),
+        **kwargs
+    )
+
+
+def confidence(message):
+    """
+    LLMの応答の確信度（出力トークンの確率の幾何平均）を算出
+
+    Args:
+        message: logprobsを有効にして取得したAIMessage
+
+    Returns:
+        0〜1の確信度（logprobsが含まれない場合はNone）
+    """
+    logprobs = ((getattr(message, "response_metadata", None) or {}).get("logprobs") or {}).get("content")
+    if not logprobs:
+        return None
+    return math.exp(sum(token["logprob"] for token in logprobs) / len(logprobs))
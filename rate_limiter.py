@@ -0,0 +1,578 @@
+"""
+このファイルは、API呼び出しの頻度を制限するレートリミッターが記述されたファイルです。
+
+OpenAI APIへの呼び出し（Whisper・AgentのLLM・専門家AIのChain・埋め込み）はすべて、
+ここで作成するHTTPクライアントを経由させることで、プロセス全体で次の制御を行います。
+
+    - モデルごとの1分あたりのリクエスト数（RPM）・トークン数（TPM）の制限
+    - セッション間で公平になるよう、待機中のリクエストをセッション単位のラウンドロビンで処理
+    - レスポンスのレート制限ヘッダー（x-ratelimit-*・retry-after）に基づく待機
+    - 429（Too Many Requests）の発生状況に応じた同時実行数の自動調整（AIMD方式）
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import json
+import time
+import logging
+import asyncio
+import threading
+from collections import OrderedDict, deque
+import httpx
+import constants as ct
+import app_logging
+import cancellation
+import metrics
+
+
+############################################################
+# 変数定義
+############################################################
+# モデルごとのリミッター（プロセス内で共有）
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# プロセス内で共有するHTTPクライアント
+_http_client = None
+_http_async_client = None
+_client_lock = threading.Lock()
+
+# 最後に接続の事前準備を行った時刻
+_last_connection_warm_up = 0.0
+
+
+############################################################
+# クラス定義
+############################################################
+
+class TokenBucket:
+    """
+    トークンバケット方式のレートリミッター（スレッドセーフ）
+
+    1分あたりの上限値（rate_per_minute）の速度でトークンが補充され、
+    取得時にトークンが足りない場合は補充されるまで待機する
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    def wait_time(self, amount=1):
+        """
+        指定量のトークンが貯まるまでの待ち時間（秒）を取得（トークンは消費しない）
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                return 0.0
+            return (amount - self._tokens) / self.rate_per_second
+
+    def consume(self, amount=1):
+        """
+        トークンを待機せずに消費（残量がマイナスになることも許容する）
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= min(amount, self.capacity)
+
+    def limit_available(self, remaining):
+        """
+        API側から通知された残量に合わせて、手元の残量を引き下げる
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, remaining)
+
+    def acquire(self, amount=1):
+        """
+        トークンを取得（足りない場合は補充されるまで待機）
+
+        Args:
+            amount: 取得するトークン数（容量を超える場合は容量分として扱う）
+        """
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                wait = (amount - self._tokens) / self.rate_per_second
+            time.sleep(wait)
+
+
+class ModelLimiter:
+    """
+    1つのモデルに対するリクエスト数・トークン数・同時実行数の制御
+    """
+    def __init__(self, model, rpm, tpm):
+        self.model = model
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.concurrency_limit = float(ct.RATE_LIMIT_INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.throttled = 0
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+        # セッションごとの待ち行列（ラウンドロビンの順番を保持する）
+        self._queues = OrderedDict()
+
+    def acquire(self, session_id, tokens, cancel_token=None):
+        """
+        リクエストの送信許可を取得（許可されるまで待機）
+
+        Args:
+            session_id: 呼び出し元のセッションID
+            tokens: リクエストで消費する見込みのトークン数
+            cancel_token: 待機中に取り消された場合に待機をやめるためのキャンセルトークン
+
+        Returns:
+            待機した時間（秒）
+        """
+        ticket = object()
+        start = time.monotonic()
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            while True:
+                if cancel_token is not None and cancel_token.cancelled:
+                    # 待ち行列から外し、後ろのリクエストが先に進めるようにする
+                    queue = self._queues[session_id]
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[session_id]
+                    self._cond.notify_all()
+                    cancel_token.raise_if_cancelled()
+                wait = self._wait_time(ticket, tokens)
+                if wait <= 0:
+                    break
+                self._cond.wait(timeout=min(wait, 1.0))
+
+            # 許可したセッションは待ち行列の末尾に回し、次は別のセッションを優先する
+            queue = self._queues[session_id]
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+
+            if self.requests:
+                self.requests.consume(1)
+            if self.tokens:
+                self.tokens.consume(tokens)
+            self.in_flight += 1
+            self._cond.notify_all()
+        return time.monotonic() - start
+
+    def _wait_time(self, ticket, tokens):
+        """
+        送信可能になるまでの待ち時間（0以下なら送信可能）
+        """
+        # ラウンドロビンで先頭のセッションの、先頭のリクエストだけが送信できる
+        head = next(iter(self._queues.values()))
+        if head[0] is not ticket:
+            return 1.0
+        if self.in_flight >= int(self.concurrency_limit):
+            return 1.0
+        wait = self._blocked_until - time.monotonic()
+        if self.requests:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def release(self, status_code, headers):
+        """
+        レスポンス受信後に、同時実行数の枠を返却し、レート制限の状況を反映
+
+        Args:
+            status_code: HTTPステータスコード（通信エラーの場合はNone）
+            headers: レスポンスヘッダー
+        """
+        headers = headers or {}
+        now = time.monotonic()
+        with self._cond:
+            self.in_flight -= 1
+
+            if status_code == 429:
+                # 制限に達した場合は同時実行数を半減し、指定された時間だけ送信を止める
+                self.throttled += 1
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+                retry_after = _parse_duration(headers.get("retry-after-ms"), unit=0.001) \
+                    or _parse_duration(headers.get("retry-after")) \
+                    or _parse_duration(headers.get("x-ratelimit-reset-requests")) \
+                    or ct.RATE_LIMIT_DEFAULT_BACKOFF
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            elif status_code is not None and status_code < 500:
+                # 成功時は同時実行数を少しずつ増やす（1周あたり+1）
+                self.concurrency_limit = min(float(ct.RATE_LIMIT_MAX_CONCURRENCY), self.concurrency_limit + 1.0 / self.concurrency_limit)
+
+            # API側の残量に合わせて手元の残量を補正し、使い切っている場合はリセットまで送信を止める
+            remaining_requests = _parse_int(headers.get("x-ratelimit-remaining-requests"))
+            remaining_tokens = _parse_int(headers.get("x-ratelimit-remaining-tokens"))
+            if remaining_requests is not None:
+                if self.requests:
+                    self.requests.limit_available(remaining_requests)
+                if remaining_requests == 0:
+                    reset = _parse_duration(headers.get("x-ratelimit-reset-requests")) or ct.RATE_LIMIT_DEFAULT_BACKOFF
+                    self._blocked_until = max(self._blocked_until, now + reset)
+            if remaining_tokens is not None:
+                if self.tokens:
+                    self.tokens.limit_available(remaining_tokens)
+                if remaining_tokens == 0:
+                    reset = _parse_duration(headers.get("x-ratelimit-reset-tokens")) or ct.RATE_LIMIT_DEFAULT_BACKOFF
+                    self._blocked_until = max(self._blocked_until, now + reset)
+
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """
+        現在の状態を取得（メトリクス出力用）
+        """
+        with self._cond:
+            return {
+                "model": self.model,
+                "in_flight": self.in_flight,
+                "concurrency_limit": round(self.concurrency_limit, 2),
+                "waiting": sum(len(queue) for queue in self._queues.values()),
+                "waiting_sessions": len(self._queues),
+                "throttled": self.throttled,
+                "blocked_for_s": round(max(0.0, self._blocked_until - time.monotonic()), 2),
+            }
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """
+    レスポンス本文を読み終えた（閉じた）時点で、リミッターの枠を返却するストリーム
+    """
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if self._on_close is not None:
+                on_close, self._on_close = self._on_close, None
+                on_close()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    """
+    _ReleasingStreamの非同期版
+    """
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close is not None:
+                on_close, self._on_close = self._on_close, None
+                on_close()
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """
+    OpenAI APIへのリクエストを、モデルごとのリミッターを通して送信するHTTPトランスポート
+    """
+    def __init__(self, transport=None):
+        self._transport = transport or httpx.HTTPTransport(limits=_connection_limits())
+
+    def handle_request(self, request):
+        model, tokens = inspect_request(request)
+        limiter = get_limiter(model)
+        session_id = app_logging.get_session_id()
+        # 取り消された処理のリクエストは、送信せずに打ち切る
+        cancel_token = cancellation.current_token()
+
+        for attempt in range(ct.RATE_LIMIT_MAX_RETRIES + 1):
+            _record_wait(model, limiter.acquire(session_id, tokens, cancel_token))
+            try:
+                response = self._transport.handle_request(request)
+            except BaseException:
+                # 送信中の中断（KeyboardInterruptなど）でも、同時実行数の枠を必ず返却する
+                limiter.release(None, None)
+                raise
+
+            if response.status_code == 429 and attempt < ct.RATE_LIMIT_MAX_RETRIES:
+                # 制限に達した場合は、待機してから同じリクエストを再送する
+                limiter.release(429, response.headers)
+                response.close()
+                continue
+
+            status_code, headers = response.status_code, response.headers
+            response.stream = _ReleasingStream(response.stream, lambda: limiter.release(status_code, headers))
+            return response
+
+    def close(self):
+        self._transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    RateLimitedTransportの非同期版（待機はスレッドで行い、イベントループをブロックしない）
+    """
+    def __init__(self, transport=None):
+        self._transport = transport or httpx.AsyncHTTPTransport(limits=_connection_limits())
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        model, tokens = inspect_request(request)
+        limiter = get_limiter(model)
+        session_id = app_logging.get_session_id()
+        cancel_token = cancellation.current_token()
+
+        for attempt in range(ct.RATE_LIMIT_MAX_RETRIES + 1):
+            _record_wait(model, await _acquire_async(limiter, session_id, tokens, cancel_token))
+            try:
+                response = await self._transport.handle_async_request(request)
+            except BaseException:
+                # タスクの取り消し（asyncio.CancelledError）でも、同時実行数の枠を必ず返却する
+                limiter.release(None, None)
+                raise
+
+            if response.status_code == 429 and attempt < ct.RATE_LIMIT_MAX_RETRIES:
+                limiter.release(429, response.headers)
+                await response.aclose()
+                continue
+
+            status_code, headers = response.status_code, response.headers
+            response.stream = _AsyncReleasingStream(response.stream, lambda: limiter.release(status_code, headers))
+            return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _parse_int(value):
+    """
+    ヘッダーの値を整数に変換（変換できない場合はNone）
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_duration(value, unit=1.0):
+    """
+    「1s」「6m0s」「20ms」形式や数値のみの時間表記を秒に変換（変換できない場合はNone）
+
+    Args:
+        value: ヘッダーの値
+        unit: 単位がない場合の1あたりの秒数
+    """
+    if not value:
+        return None
+    try:
+        return float(value) * unit
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(number) * scale[suffix] for number, suffix in parts)
+
+
+def inspect_request(request):
+    """
+    リクエストから、対象のモデル名と消費する見込みのトークン数を推定
+
+    Args:
+        request: httpxのリクエスト
+
+    Returns:
+        (モデル名, トークン数)
+    """
+    path = request.url.path
+    # 音声認識はmultipart形式のため本文を解析せず、トークン数の制限対象外とする
+    if path.endswith("/audio/transcriptions"):
+        return "whisper-1", 0
+
+    try:
+        body = json.loads(request.content or b"{}")
+    except (ValueError, httpx.RequestNotRead):
+        return "default", 0
+
+    model = body.get("model") or "default"
+    if path.endswith("/embeddings"):
+        inputs = body.get("input") or []
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        tokens = sum(len(item) if isinstance(item, list) else metrics.count_tokens(item) for item in inputs)
+        return model, tokens
+
+    # Chat Completionsの場合は、入力のトークン数に出力の上限（未指定の場合は既定値）を加算
+    prompt = "".join(
+        content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+        for content in (m.get("content") or "" for m in body.get("messages", []))
+    )
+    completion = body.get("max_completion_tokens") or body.get("max_tokens") or ct.RATE_LIMIT_DEFAULT_COMPLETION_TOKENS
+    return model, metrics.count_tokens(prompt) + completion
+
+
+async def _acquire_async(limiter, session_id, tokens, cancel_token=None):
+    """
+    リミッターの送信許可を、イベントループをブロックせずにスレッドで待って取得
+
+    待機中にタスクが取り消された場合は、スレッドでの待機もやめさせ、
+    取り消しと入れ違いで許可を取得していた場合はその枠を返却する（枠が返却されずに残らないようにする）
+
+    Args:
+        limiter: リミッター
+        session_id: 呼び出し元のセッションID
+        tokens: リクエストで消費する見込みのトークン数
+        cancel_token: 呼び出し元のキャンセルトークン
+
+    Returns:
+        待機した時間（秒）
+    """
+    wait_token = cancellation.CancellationToken()
+    if cancel_token is not None:
+        cancel_token.on_cancel(lambda: wait_token.cancel(cancel_token.reason))
+    future = asyncio.ensure_future(asyncio.to_thread(limiter.acquire, session_id, tokens, wait_token))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        wait_token.cancel("cancelled")
+
+        def release_if_acquired(done):
+            if not done.cancelled() and done.exception() is None:
+                limiter.release(None, None)
+
+        future.add_done_callback(release_if_acquired)
+        raise
+
+
+def _record_wait(model, waited_seconds):
+    """
+    リミッターで待機した時間をスパンとして記録（待機がなかった場合は記録しない）
+    """
+    if waited_seconds >= 0.001:
+        metrics.record_span("rate_limit_wait", waited_seconds * 1000, model=model)
+
+
+def get_limiter(model):
+    """
+    モデルごとのリミッターを取得（初回呼び出し時に作成）
+
+    Args:
+        model: モデル名
+
+    Returns:
+        リミッター
+    """
+    with _limiters_lock:
+        if model not in _limiters:
+            quota = ct.RATE_LIMITS.get(model)
+            if quota is None:
+                # トークン数の上限がないまま呼び出されないよう、設定漏れを知らせる（モデルごとに1回だけ）
+                if model != "default":
+                    logging.getLogger(ct.LOGGER_NAME).warning(
+                        f"{model}のレート制限が設定されていないため、defaultの上限を使います（constants.pyのRATE_LIMITS）"
+                    )
+                quota = ct.RATE_LIMITS["default"]
+            _limiters[model] = ModelLimiter(model, quota.get("rpm"), quota.get("tpm"))
+        return _limiters[model]
+
+
+def snapshot():
+    """
+    全モデルのリミッターの状態を取得（メトリクス出力用）
+
+    Returns:
+        リミッターの状態のリスト
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return [limiter.snapshot() for limiter in limiters]
+
+
+def _connection_limits():
+    """
+    接続プールの設定（事前に確立した接続を使い回せるよう、待機中の接続を保持する時間を延ばす）
+    """
+    return httpx.Limits(keepalive_expiry=ct.OPENAI_HTTP_KEEPALIVE_EXPIRY)
+
+
+def warm_up_connection():
+    """
+    OpenAI APIへの接続（TCP・TLS）を事前に確立し、接続プールに保持しておく
+
+    直前に確立済みで、接続がまだ保持されている見込みの場合は何もしない
+    """
+    global _last_connection_warm_up
+
+    now = time.monotonic()
+    if now - _last_connection_warm_up < ct.OPENAI_HTTP_KEEPALIVE_EXPIRY / 2:
+        return
+    _last_connection_warm_up = now
+
+    base_url = os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+    # 最も軽いエンドポイント（モデル一覧）を呼び出して接続だけを確立する（トークンは消費しない）
+    get_http_client().get(
+        f"{base_url.rstrip('/')}/models",
+        headers={"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY', '')}"},
+    ).close()
+
+
+def get_http_client():
+    """
+    OpenAI APIの呼び出しに使うHTTPクライアントを取得（プロセス内で共有）
+
+    Returns:
+        httpx.Client
+    """
+    global _http_client
+
+    if _http_client is None:
+        with _client_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(transport=RateLimitedTransport(), timeout=ct.OPENAI_HTTP_TIMEOUT)
+    return _http_client
+
+
+def get_http_async_client():
+    """
+    OpenAI APIの非同期呼び出しに使うHTTPクライアントを取得（プロセス内で共有）
+
+    Returns:
+        httpx.AsyncClient
+    """
+    global _http_async_client
+
+    if _http_async_client is None:
+        with _client_lock:
+            if _http_async_client is None:
+                _http_async_client = httpx.AsyncClient(transport=AsyncRateLimitedTransport(), timeout=ct.OPENAI_HTTP_TIMEOUT)
+    return _http_async_client
+
+
+# メトリクスの出力にリミッターの状態を含める
+metrics.register_snapshot_provider("rate_limits", snapshot)
@@ -0,0 +1,500 @@
+"""
+このファイルは、RAG用のベクトルストアの作成・読み込みと検索処理が記述されたファイルです。
+
+資料（コーパス）ごとに1つのベクトルストア（シャード）を作成し、プロセス内で共有します。
+ジャンルごとに検索するコーパスは constants.py の GENRE_CORPORA で対応付けます。
+シャードは初めて検索されたときに読み込まれるため、コーパスを追加しても、それを使わないジャンルの処理には影響しません。
+
+constants.py の RETRIEVAL_SERVICE_URL が設定されている場合は、シャードをプロセス内に読み込まず、
+検索サービス（retrieval_server.py）に検索を依頼します（複数のアプリのプロセスで、1つのシャード・検索結果のキャッシュを共有するため）。
+
+圧縮インデックス（compact_index.py）に移行済みのシャードは、次元削減したベクトルで候補を絞り込み、
+元の次元のベクトルで再スコアリングする2段階で検索します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import time
+import logging
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from langchain_core.documents import Document
+from langchain_openai import OpenAIEmbeddings
+from langchain_community.vectorstores import FAISS
+import constants as ct
+import cancellation
+import compact_index
+import ingestion
+import metrics
+import rate_limiter
+import singleflight
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するシャード（コーパスID → ベクトルストア。読み込み・作成に成功したものだけを保持）
+_shards = {}
+# 読み込み・作成に失敗したシャード（コーパスID → 失敗した時刻）。SHARD_RETRY_SECONDS を過ぎたら再試行する
+_shard_failures = {}
+# コーパスごとの読み込み用ロック（あるシャードの読み込み中も、他のシャードは検索できるようにする）
+_shard_locks = {}
+_shard_locks_lock = threading.Lock()
+
+# 検索クエリの埋め込みに使うモデル（全シャードで共通）
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+# 複数のシャードを並列に検索するためのスレッドプール
+_search_executor = ThreadPoolExecutor(max_workers=ct.RETRIEVAL_MAX_WORKERS, thread_name_prefix="retrieval")
+
+# 複合的な質問をサブクエリに分割する区切り
+# （文末・読点・接続語、または漢字・カタカナに挟まれた「と」「や」）
+QUERY_SPLIT_PATTERN = r"[。？?！!\n]|、|及び|および|並びに|ならびに|または|又は|それと|(?<=[一-龥ァ-ヶー])[とや](?=[一-龥ァ-ヶー])"
+# サブクエリの先頭から取り除く接続語
+LEADING_CONNECTOR_PATTERN = r"^(?:また|さらに|それから|あと)"
+
+# 同じクエリの検索を、実行中の1回の検索にまとめる
+_retrieval_flight = singleflight.SingleFlight("retrieval")
+
+# 検索サービスとの接続を使い回すためのセッション（検索サービスを使う場合のみ作成）
+_service_session = None
+_service_session_lock = threading.Lock()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _get_embeddings():
+    """
+    検索クエリの埋め込みに使うモデルを取得（プロセス内で1回だけ作成）
+    """
+    global _embeddings
+
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                _embeddings = OpenAIEmbeddings(http_client=rate_limiter.get_http_client())
+    return _embeddings
+
+
+def _get_shard_lock(corpus_id):
+    with _shard_locks_lock:
+        return _shard_locks.setdefault(corpus_id, threading.Lock())
+
+
+def get_shard(corpus_id):
+    """
+    コーパスのシャードを取得（初回呼び出し時に読み込みまたは作成）
+
+    Args:
+        corpus_id: コーパスID（constants.py の CORPORA のキー）
+
+    Returns:
+        ベクトルストア（資料がない・初期化に失敗した場合はNone。SHARD_RETRY_SECONDS を過ぎた後の呼び出しで再試行する）
+    """
+    shard = _shards.get(corpus_id)
+    if shard is not None or _recently_failed(corpus_id):
+        return shard
+
+    with _get_shard_lock(corpus_id):
+        if corpus_id not in _shards and not _recently_failed(corpus_id):
+            shard = _load_or_build_shard(corpus_id)
+            if shard is None:
+                _shard_failures[corpus_id] = time.monotonic()
+            else:
+                _shards[corpus_id] = shard
+                _shard_failures.pop(corpus_id, None)
+    return _shards.get(corpus_id)
+
+
+def _recently_failed(corpus_id):
+    """
+    シャードの読み込み・作成に失敗してから、再試行までの時間が経っていないかどうか
+    """
+    failed_at = _shard_failures.get(corpus_id)
+    return failed_at is not None and time.monotonic() - failed_at < ct.SHARD_RETRY_SECONDS
+
+
+def get_vector_store():
+    """
+    会社法のベクトルストアを取得（初回呼び出し時に読み込みまたは作成）
+
+    Returns:
+        ベクトルストア（初期化に失敗した場合はNone）
+    """
+    return get_shard(ct.COMPANY_LAW_CORPUS_ID)
+
+
+def reset_vector_store():
+    """
+    共有しているシャードを破棄（次回の取得時に読み込み直す）
+    """
+    global _embeddings
+
+    with _shard_locks_lock:
+        _shards.clear()
+        _shard_failures.clear()
+    with _embeddings_lock:
+        _embeddings = None
+
+
+def warm_up(corpus_ids):
+    """
+    コーパスのシャードを事前に読み込む（検索サービスを使う場合は、サービス側で読み込むため何もしない）
+
+    Args:
+        corpus_ids: コーパスIDのリスト
+    """
+    if ct.RETRIEVAL_SERVICE_URL:
+        return
+    for corpus_id in corpus_ids:
+        get_shard(corpus_id)
+
+
+def _load_or_build_shard(corpus_id):
+    """
+    コーパスの資料（PDF）を読み込み、ベクトル化して保存または読み込み
+
+    Args:
+        corpus_id: コーパスID
+
+    Returns:
+        ベクトルストア（資料がない・失敗した場合はNone）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    corpus = ct.CORPORA[corpus_id]
+
+    try:
+        # すでに保存済みのベクトルストアがあれば読み込み
+        if os.path.exists(corpus["store_path"]):
+            logger.info(f"既存のベクトルストアを読み込みます（{corpus['name']}）")
+            vector_store = FAISS.load_local(
+                corpus["store_path"],
+                _get_embeddings(),
+                allow_dangerous_deserialization=True
+            )
+            # 圧縮インデックスに移行済みであれば、次元削減したベクトルでの粗い検索と再スコアリングの2段階で検索する
+            if compact_index.attach(vector_store, corpus["store_path"]):
+                logger.info(f"圧縮インデックスで検索します（{corpus['name']}）")
+            logger.info(f"ベクトルストアの読み込みが完了しました（{corpus['name']}）")
+            return vector_store
+
+        # PDFが存在しない場合はダウンロード（URLが登録されていない資料は、PDFを配置するまで使用しない）
+        if not os.path.exists(corpus["pdf_path"]):
+            if not corpus.get("url"):
+                logger.warning(f"{corpus['name']}の資料が見つからないため、検索対象から除外します: {corpus['pdf_path']}")
+                return None
+            logger.info(f"{corpus['name']}のPDFをダウンロードします")
+            os.makedirs(os.path.dirname(corpus["pdf_path"]), exist_ok=True)
+            urllib.request.urlretrieve(corpus["url"], corpus["pdf_path"])
+            logger.info(f"{corpus['name']}のPDFのダウンロードが完了しました")
+
+        # PDFをページ単位で並列に解析しながら、チャンク分割・埋め込みまでをストリーミングで処理
+        logger.info(f"{corpus['name']}のPDFを取り込みます")
+        vector_store = ingestion.build_vector_store(corpus["pdf_path"], _get_embeddings(), metadata={"corpus": corpus_id})
+        if vector_store is None:
+            logger.warning(f"{corpus['name']}のPDFからテキストを取り出せませんでした")
+            return None
+
+        # ベクトルストアを保存
+        os.makedirs(corpus["store_path"], exist_ok=True)
+        vector_store.save_local(corpus["store_path"])
+        if ct.COMPACT_INDEX_ENABLED:
+            compact_index.migrate(corpus["store_path"])
+            compact_index.attach(vector_store, corpus["store_path"])
+        logger.info(f"ベクトルストアの作成と保存が完了しました（{corpus['name']}）")
+        return vector_store
+
+    except Exception as e:
+        logger.error(f"ベクトルストアの初期化に失敗しました（{corpus['name']}）: {str(e)}")
+        return None
+
+
+def split_query(query):
+    """
+    複合的な質問を、論点ごとのサブクエリに分割（LLMを使わずにローカルで行う）
+
+    文の区切り・列挙の読点・「及び」「並びに」などの接続語と、
+    漢字・カタカナの語句に挟まれた「と」「や」で分割する（例:「取締役会と監査役の違い」）
+
+    Args:
+        query: 検索クエリ
+
+    Returns:
+        サブクエリのリスト（先頭は元の質問全体）
+    """
+    pieces = re.split(QUERY_SPLIT_PATTERN, query)
+    sub_queries = [query.strip()]
+    for piece in pieces:
+        piece = re.sub(LEADING_CONNECTOR_PATTERN, "", piece.strip(" 　、。,.?？!！"))
+        if len(piece) >= ct.SUB_QUERY_MIN_LENGTH and piece not in sub_queries:
+            sub_queries.append(piece)
+    return sub_queries[:ct.MAX_SUB_QUERIES]
+
+
+def genre_corpora(mode_2):
+    """
+    ジャンルで検索するコーパスIDの一覧を取得
+
+    Args:
+        mode_2: ジャンル
+
+    Returns:
+        コーパスIDのリスト（RAGを使わないジャンルの場合は空のリスト）
+    """
+    return list(ct.GENRE_CORPORA.get(mode_2, []))
+
+
+def search_genre(query, mode_2, k=None):
+    """
+    ジャンルに対応するコーパスから、質問に関連するチャンクを検索
+
+    Args:
+        query: 検索クエリ
+        mode_2: ジャンル
+        k: 取得するチャンク数
+
+    Returns:
+        関連するDocumentのリスト（検索できるシャードがない場合はNone）
+    """
+    return search_corpora(query, genre_corpora(mode_2), k)
+
+
+def search_company_law(query, k=None):
+    """
+    会社法のベクトルストアから、質問に関連するチャンクを検索
+
+    Args:
+        query: 検索クエリ
+        k: 取得するチャンク数
+
+    Returns:
+        関連するDocumentのリスト（ベクトルストアが使えない場合はNone）
+    """
+    return search_corpora(query, [ct.COMPANY_LAW_CORPUS_ID], k)
+
+
+def search_corpora(query, corpus_ids, k=None):
+    """
+    複数のコーパスのシャードから、質問に関連するチャンクを検索
+
+    複合的な質問はサブクエリに分割し、1回の埋め込みリクエストでまとめて埋め込んだうえで、
+    各シャードを並列に（シャードごとに1回のFAISS呼び出しで）検索し、
+    各サブクエリの上位から順に重複を除いて統合する
+
+    Args:
+        query: 検索クエリ
+        corpus_ids: 検索するコーパスIDのリスト
+        k: 取得するチャンク数（未指定の場合、サブクエリが1つならSEARCH_TOP_K、複数ならMULTI_QUERY_TOP_K）
+
+    Returns:
+        関連するDocumentのリスト（検索できるシャードがない場合はNone）
+    """
+    if not corpus_ids:
+        return None
+
+    if ct.RETRIEVAL_SERVICE_URL:
+        key = (singleflight.normalize(query), tuple(corpus_ids), k)
+        return _retrieval_flight.do(key, lambda: _search_remote(query, corpus_ids, k))
+
+    # シャードの読み込みも並列に行う（読み込み済みのシャードはすぐに返る）
+    shards = [
+        (corpus_id, shard)
+        for corpus_id, shard in zip(corpus_ids, _search_executor.map(get_shard, corpus_ids))
+        if shard is not None
+    ]
+    if not shards:
+        return None
+
+    # 同じ検索が実行中であれば、新たに埋め込みを作成せずにその結果を共有する
+    key = (singleflight.normalize(query), tuple(corpus_id for corpus_id, _ in shards), k)
+    return _retrieval_flight.do(key, lambda: _search(shards, query, k))
+
+
+def search_corpora_batch(queries):
+    """
+    複数の検索クエリを、プロセス内のシャードからまとめて検索（検索サービスが使う）
+
+    検索するコーパスが同じクエリごとに、1回の埋め込みリクエストと、シャードごとに1回のFAISS呼び出しで検索する
+
+    Args:
+        queries: (検索クエリ, コーパスIDのリスト, 取得するチャンク数) のリスト
+
+    Returns:
+        検索クエリごとのDocumentのリスト（検索できるシャードがない場合はNone）
+    """
+    results = [None] * len(queries)
+    groups = {}
+    for position, (query, corpus_ids, k) in enumerate(queries):
+        groups.setdefault(tuple(corpus_ids), []).append((position, query, k))
+
+    for corpus_ids, group in groups.items():
+        shards = [
+            (corpus_id, shard)
+            for corpus_id, shard in zip(corpus_ids, _search_executor.map(get_shard, corpus_ids))
+            if shard is not None
+        ]
+        if not shards:
+            continue
+        batch_docs = _search_batch(shards, [(query, k) for _, query, k in group])
+        for (position, _, _), docs in zip(group, batch_docs):
+            results[position] = docs
+    return results
+
+
+def _get_service_session():
+    """
+    検索サービスとの接続に使うセッションを取得（プロセス内で1回だけ作成）
+    """
+    global _service_session
+
+    if _service_session is None:
+        with _service_session_lock:
+            if _service_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=ct.RETRIEVAL_MAX_WORKERS * 4)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _service_session = session
+    return _service_session
+
+
+def _search_remote(query, corpus_ids, k):
+    """
+    検索サービス（POST /search）に検索を依頼
+
+    Returns:
+        関連するDocumentのリスト（検索できるシャードがない・検索サービスに接続できない場合はNone）
+    """
+    # 取り消された処理では、検索サービスに依頼しない
+    cancellation.raise_if_cancelled()
+    with metrics.span("retrieval_remote", k=k, shards=len(corpus_ids)) as span:
+        try:
+            response = _get_service_session().post(
+                f"{ct.RETRIEVAL_SERVICE_URL.rstrip('/')}/search",
+                json={"queries": [{"query": query, "corpus_ids": list(corpus_ids), "k": k}]},
+                timeout=ct.RETRIEVAL_SERVICE_TIMEOUT,
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.getLogger(ct.LOGGER_NAME).error(f"検索サービスでの検索に失敗しました: {e}")
+            return None
+
+        result = response.json()["results"][0]
+        span["cached"] = bool(result and result.get("cached"))
+        if result is None or result.get("docs") is None:
+            return None
+        return [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in result["docs"]]
+
+
+def _search_shard(vector_store, vectors, k):
+    """
+    1つのシャードを、全サブクエリのベクトルでまとめて検索
+
+    Returns:
+        (距離の配列, インデックスの配列)
+    """
+    if vector_store._normalize_L2:
+        vectors = vectors.copy()
+        faiss.normalize_L2(vectors)
+    return vector_store.index.search(vectors, k)
+
+
+def _search(shards, query, k):
+    """
+    サブクエリをまとめて各シャードから検索し、計測用のスパンを記録
+    """
+    return _search_batch(shards, [(query, k)])[0]
+
+
+def _search_batch(shards, items):
+    """
+    複数の検索クエリを、1回の埋め込みリクエストと、シャードごとに1回のFAISS呼び出しでまとめて検索
+
+    Args:
+        shards: (コーパスID, ベクトルストア) のリスト
+        items: (検索クエリ, 取得するチャンク数) のリスト
+
+    Returns:
+        検索クエリごとのDocumentのリスト
+    """
+    # 検索クエリごとのサブクエリと取得件数（同じサブクエリは1回だけ埋め込む）
+    plans = []
+    rows = {}
+    for query, k in items:
+        sub_queries = split_query(query)
+        if k is None:
+            k = ct.SEARCH_TOP_K if len(sub_queries) == 1 else ct.MULTI_QUERY_TOP_K
+        for sub_query in sub_queries:
+            rows.setdefault(sub_query, len(rows))
+        plans.append((sub_queries, k))
+    max_k = max(k for _, k in plans)
+
+    with metrics.span("retrieval", k=max_k, queries=len(items), sub_queries=len(rows), shards=len(shards)) as span:
+        # 全サブクエリを1回のリクエストで埋め込み、各シャードを並列に検索
+        vectors = np.asarray(_get_embeddings().embed_documents(list(rows)), dtype=np.float32)
+        results = list(_search_executor.map(lambda shard: _search_shard(shard[1], vectors, max_k), shards))
+
+        batch_docs = [
+            _merge_results(shards, results, [rows[sub_query] for sub_query in sub_queries], k)
+            for sub_queries, k in plans
+        ]
+
+        span["prompt_tokens"] = sum(metrics.count_tokens(sub_query) for sub_query in rows)
+        span["completion_tokens"] = sum(metrics.count_tokens(doc.page_content) for docs in batch_docs for doc in docs)
+    return batch_docs
+
+
+def _higher_is_better(vector_store):
+    """
+    ベクトルストアのインデックスが、値が大きいほど関連度が高い尺度（内積）で検索結果を返すかどうか
+    """
+    return vector_store.index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+
+def _merge_results(shards, results, rows, k):
+    """
+    1つの検索クエリのサブクエリ（検索結果の行）ごとの上位から、重複を除いてk件のチャンクを取り出す
+
+    Args:
+        shards: (コーパスID, ベクトルストア) のリスト
+        results: シャードごとの (距離の配列, インデックスの配列)
+        rows: 検索クエリのサブクエリに対応する行番号のリスト
+        k: 取得するチャンク数
+
+    Returns:
+        Documentのリスト
+    """
+    # 各サブクエリの1位、2位…の順に（同じ順位の中では関連度の高い順に）、重複を除いてk件まで取り出す
+    candidates = []
+    for shard_no, (distances, indices) in enumerate(results):
+        # L2距離は小さいほど、内積は大きいほど関連度が高いため、小さいほど関連度が高い値にそろえる
+        sign = -1.0 if _higher_is_better(shards[shard_no][1]) else 1.0
+        for row in rows:
+            for rank in range(min(k, indices.shape[1])):
+                index = int(indices[row][rank])
+                if index != -1:
+                    candidates.append((rank, sign * float(distances[row][rank]), shard_no, index))
+    candidates.sort()
+
+    docs = []
+    seen = set()
+    for _, _, shard_no, index in candidates:
+        if (shard_no, index) in seen:
+            continue
+        seen.add((shard_no, index))
+        vector_store = shards[shard_no][1]
+        docs.append(vector_store.docstore.search(vector_store.index_to_docstore_id[index]))
+        if len(docs) >= k:
+            break
+    return docs
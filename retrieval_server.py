@@ -0,0 +1,270 @@
+"""
+このファイルは、RAGの検索処理（クエリの埋め込み・ベクトル検索・チャンクの取得）を、複数のアプリのプロセスで共有する検索サービスとして提供するHTTPサーバーです。
+
+アプリ（Streamlit）を複数のプロセスで動かす場合も、シャードの読み込みと検索結果のキャッシュはこのサービスの1か所にまとまります。
+アプリ側は constants.py の RETRIEVAL_SERVICE_URL（環境変数）を設定すると、プロセス内での検索からこのサービスでの検索に切り替わります。
+
+    - 同時に届いた検索（別のプロセスからのものを含む）は、RETRIEVAL_SERVICE_BATCH_WINDOW_MS だけ待ってまとめ、
+      1回の埋め込みリクエストと、シャードごとに1回のFAISS呼び出しで検索する
+    - 検索結果は「正規化した検索クエリ・コーパス・取得件数」ごとに、RETRIEVAL_SERVICE_CACHE_SIZE 件までキャッシュする
+
+エンドポイント:
+    - POST /search: 検索クエリ（複数可）に関連するチャンクを返す
+    - GET /metrics: 処理時間の集計結果と、キャッシュ・まとめて検索した件数
+    - GET /health: 稼働確認
+
+リクエストボディ（/search）:
+    {"queries": [{"query": 検索クエリ, "corpus_ids": コーパスIDのリスト, "k": 取得するチャンク数（省略可）}]}
+
+レスポンス（/search）:
+    {"results": [{"docs": [{"page_content": チャンク, "metadata": メタデータ}] または null, "cached": キャッシュを使ったかどうか}]}
+
+使い方:
+    python retrieval_server.py [--host 127.0.0.1] [--port 8504]
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import json
+import asyncio
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from aiohttp import web
+import constants as ct
+import app_logging
+import metrics
+import retrieval
+import singleflight
+
+
+############################################################
+# 設定関連
+############################################################
+# 「.env」ファイルで定義した環境変数の読み込み
+load_dotenv()
+
+
+############################################################
+# 変数定義
+############################################################
+# 検索結果のキャッシュ（キー → 検索結果のチャンクのリスト。最近使われた順に末尾へ移動）
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# 検索の件数（リクエスト・クエリ・キャッシュの使用・まとめて行った検索）
+_stats = {"requests": 0, "queries": 0, "cache_hits": 0, "batches": 0, "batched_queries": 0}
+
+
+############################################################
+# クラス定義
+############################################################
+
+class _Batcher:
+    """
+    同時に届いた検索クエリを集めて、まとめて検索するクラス（イベントループ上で使う）
+    """
+    def __init__(self):
+        self._pending = []
+        self._timer = None
+
+    async def search(self, query, corpus_ids, k):
+        """
+        検索クエリを次のまとまりに加え、検索結果を待つ
+
+        Returns:
+            チャンクの辞書のリスト（検索できるシャードがない場合はNone）
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((query, corpus_ids, k), future))
+        if len(self._pending) >= ct.RETRIEVAL_SERVICE_MAX_BATCH:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(ct.RETRIEVAL_SERVICE_BATCH_WINDOW_MS / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.get_running_loop().create_task(self._run(batch))
+
+    async def _run(self, batch):
+        _stats["batches"] += 1
+        _stats["batched_queries"] += len(batch)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                None, retrieval.search_corpora_batch, [item for item, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), docs in zip(batch, results):
+            if not future.done():
+                future.set_result(None if docs is None else [_serialize(doc) for doc in docs])
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _serialize(doc):
+    return {"page_content": doc.page_content, "metadata": doc.metadata}
+
+
+def _cache_key(query, corpus_ids, k):
+    return (singleflight.normalize(query), tuple(corpus_ids), k)
+
+
+def _cache_get(key):
+    with _cache_lock:
+        docs = _cache.get(key)
+        if docs is not None:
+            _cache.move_to_end(key)
+        return docs
+
+
+def _cache_put(key, docs):
+    with _cache_lock:
+        _cache[key] = docs
+        _cache.move_to_end(key)
+        while len(_cache) > ct.RETRIEVAL_SERVICE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _parse_queries(body):
+    """
+    リクエストボディの検索クエリを、(検索クエリ, コーパスIDのリスト, 取得するチャンク数) のリストに変換
+    """
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="リクエストボディはJSONのオブジェクトで指定してください。")
+    queries = body.get("queries")
+    if not isinstance(queries, list) or not queries:
+        raise web.HTTPBadRequest(text="「queries」を指定してください。")
+
+    parsed = []
+    for item in queries:
+        query = item.get("query") if isinstance(item, dict) else None
+        if not isinstance(query, str) or not query.strip():
+            raise web.HTTPBadRequest(text="各検索の「query」を指定してください。")
+        corpus_ids = item.get("corpus_ids") or [ct.COMPANY_LAW_CORPUS_ID]
+        unknown = [corpus_id for corpus_id in corpus_ids if corpus_id not in ct.CORPORA]
+        if unknown:
+            raise web.HTTPBadRequest(text=f"登録されていないコーパスIDです: {', '.join(unknown)}")
+        k = item.get("k")
+        if k is not None and (not isinstance(k, int) or k <= 0):
+            raise web.HTTPBadRequest(text="「k」は正の整数で指定してください。")
+        parsed.append((query, list(corpus_ids), k))
+    return parsed
+
+
+async def _search_one(batcher, query, corpus_ids, k):
+    """
+    キャッシュにあればそれを返し、なければまとめて検索してキャッシュに登録
+    """
+    key = _cache_key(query, corpus_ids, k)
+    docs = _cache_get(key)
+    if docs is not None:
+        _stats["cache_hits"] += 1
+        return {"docs": docs, "cached": True}
+
+    docs = await batcher.search(query, corpus_ids, k)
+    if docs is not None:
+        _cache_put(key, docs)
+    return {"docs": docs, "cached": False}
+
+
+async def handle_search(request):
+    """
+    POST /search: 検索クエリ（複数可）に関連するチャンクを返す
+    """
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="リクエストボディがJSONではありません。")
+    queries = _parse_queries(body)
+
+    _stats["requests"] += 1
+    _stats["queries"] += len(queries)
+    batcher = request.app["batcher"]
+    try:
+        results = await asyncio.gather(*[_search_one(batcher, *query) for query in queries])
+    except Exception as e:
+        logging.getLogger(ct.LOGGER_NAME).error(f"検索に失敗しました: {e}")
+        raise web.HTTPInternalServerError(text="検索に失敗しました。")
+    return web.json_response({"results": results}, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+
+async def handle_metrics(request):
+    """
+    GET /metrics: 処理時間の集計結果と、キャッシュ・まとめて検索した件数を返す
+    """
+    return web.json_response(metrics.snapshot(), dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+
+async def handle_health(request):
+    """
+    GET /health: 稼働確認
+    """
+    return web.json_response({"status": "ok"})
+
+
+def snapshot():
+    """
+    検索サービスの件数を取得
+
+    Returns:
+        リクエスト・クエリ・キャッシュの使用・まとめて行った検索の件数と、キャッシュの保持件数
+    """
+    with _cache_lock:
+        cached = len(_cache)
+    return {**_stats, "cache_size": cached}
+
+
+async def _warm_up(app):
+    """
+    起動時に全コーパスのシャードを読み込む（最初の検索の待ち時間を減らすため）
+    """
+    app["batcher"] = _Batcher()
+    loop = asyncio.get_running_loop()
+    for corpus_id in ct.CORPORA:
+        await loop.run_in_executor(None, retrieval.get_shard, corpus_id)
+
+
+def create_app():
+    """
+    検索サービスのアプリケーションを作成
+
+    Returns:
+        aiohttpのアプリケーション
+    """
+    app_logging.setup_logger()
+    app_logging.setup_span_logger()
+    metrics.register_snapshot_provider("retrieval_service", snapshot)
+
+    app = web.Application()
+    app.router.add_post("/search", handle_search)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/health", handle_health)
+    app.on_startup.append(_warm_up)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAGの検索処理を、複数のアプリのプロセスで共有する検索サービスを起動します。")
+    parser.add_argument("--host", default=ct.RETRIEVAL_SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=ct.RETRIEVAL_SERVICE_PORT)
+    args = parser.parse_args()
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+このファイルは、同じ内容の処理が同時に複数要求された場合に、実行中の処理を1つにまとめる（シングルフライト）仕組みが記述されたファイルです。
+
+最初の呼び出し元（リーダー）だけが処理を実行し、処理中に届いた同じキーの呼び出し元は、
+新たにモデルを呼び出さずにリーダーの結果（ストリーミングの場合は同じイベント列）を受け取ります。
+処理が終わった時点でキーは解放されるため、結果をキャッシュするものではありません。
+
+呼び出し元がキャンセルトークンを設定している場合（cancellation.use_token）、1つの呼び出し元が取り消しても、
+同じ結果を待っている他の呼び出し元がいる間は処理を続け、全員が取り消した時点で実行中の処理を取り消します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import asyncio
+import threading
+import unicodedata
+import constants as ct
+import metrics
+from cancellation import CancellationToken, current_token, use_token
+
+
+############################################################
+# 変数定義
+############################################################
+# 作成済みのインスタンス（メトリクス出力用）
+_instances = []
+
+
+############################################################
+# クラス定義
+############################################################
+
+class _Call:
+    """
+    実行中の処理1件分の結果
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # 実行中の処理に渡すキャンセルトークン（結果を待っている呼び出し元が全員取り消した場合に取り消す）
+        self.token = CancellationToken()
+        self.waiters = 0
+        self.cancelled_waiters = 0
+        # キャンセルトークンを持たない（取り消さない）呼び出し元がいるかどうか
+        self.pinned = False
+
+
+class SingleFlight:
+    """
+    同じキーの同時呼び出しを1回の実行にまとめるクラス（スレッド用）
+    """
+    def __init__(self, name):
+        self.name = name
+        self.leaders = 0
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+        _instances.append(self)
+
+    def do(self, key, fn):
+        """
+        キーに対応する処理を実行（同じキーの処理が実行中の場合は、その結果を待って返す）
+
+        fnは、呼び出し元のトークンではなく、この処理用のキャンセルトークンをコンテキストに設定して実行する
+
+        Args:
+            key: 処理内容を識別するキー（ハッシュ可能な値）
+            fn: 処理を行う関数（引数なし）
+
+        Returns:
+            処理結果
+        """
+        token = current_token()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+            else:
+                self.shared += 1
+            call.waiters += 1
+            if token is None:
+                call.pinned = True
+        if token is not None:
+            token.on_cancel(lambda: self._detach(key, call, token.reason))
+
+        if not leader:
+            if token is None:
+                call.done.wait()
+            else:
+                # 自分のトークンが取り消された場合は、結果を待たずに終了する
+                while not call.done.wait(ct.CANCELLATION_POLL_SECONDS):
+                    token.raise_if_cancelled()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            with use_token(call.token):
+                call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+        # 他の呼び出し元のために処理を続けた場合も、自分のトークンが取り消されていれば結果は返さない
+        if token is not None:
+            token.raise_if_cancelled()
+        return call.result
+
+    def _detach(self, key, call, reason):
+        """
+        呼び出し元のトークンが取り消された時点で呼び出され、全員が取り消した場合は実行中の処理を取り消す
+        """
+        with self._lock:
+            call.cancelled_waiters += 1
+            abandoned = not call.pinned and call.cancelled_waiters >= call.waiters
+            # 取り消した処理の結果を、後から届いた同じキーの呼び出し元に共有しないよう、キーを解放する
+            if abandoned and self._calls.get(key) is call:
+                del self._calls[key]
+        if abandoned:
+            call.token.cancel(reason)
+
+    def snapshot(self):
+        """
+        リーダーとして実行した回数と、実行中の結果を共有した回数を取得
+        """
+        with self._lock:
+            return {"leaders": self.leaders, "shared": self.shared, "in_flight": len(self._calls)}
+
+
+class _SharedStream:
+    """
+    実行中のストリーミング処理1件分のイベント列
+    """
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.changed = asyncio.Condition()
+
+
+class StreamFlight:
+    """
+    同じキーの同時ストリーミングを1回の実行にまとめるクラス（asyncio用）
+
+    処理はバックグラウンドのタスクで実行し、イベントを先頭から順にすべての購読者へ配信する
+    （途中から参加した購読者にも、それまでのイベントを先頭から配信する）
+    """
+    def __init__(self, name):
+        self.name = name
+        self.leaders = 0
+        self.shared = 0
+        self._flights = {}
+        _instances.append(self)
+
+    async def stream(self, key, factory):
+        """
+        キーに対応するストリーミング処理のイベントを順に返す
+
+        Args:
+            key: 処理内容を識別するキー（ハッシュ可能な値）
+            factory: イベントを返す非同期ジェネレーターを作成する関数（引数なし）
+
+        Yields:
+            イベント
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _SharedStream()
+            self._flights[key] = flight
+            # 呼び出し元のコンテキスト（計測中のリクエストなど）を引き継いでタスクを作成
+            flight.task = asyncio.create_task(self._drive(key, flight, factory()))
+            self.leaders += 1
+        else:
+            self.shared += 1
+
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(flight.events):
+                    yield flight.events[index]
+                    index += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: len(flight.events) > index or flight.done)
+        finally:
+            flight.subscribers -= 1
+            # 購読者が全員いなくなった場合は、処理を中断する
+            if flight.subscribers == 0 and not flight.done:
+                flight.task.cancel()
+
+    async def _drive(self, key, flight, events):
+        """
+        ストリーミング処理を実行し、イベントを購読者に配信
+        """
+        try:
+            async for event in events:
+                flight.events.append(event)
+                async with flight.changed:
+                    flight.changed.notify_all()
+        except asyncio.CancelledError as e:
+            flight.error = e
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            async with flight.changed:
+                flight.changed.notify_all()
+
+    def snapshot(self):
+        """
+        リーダーとして実行した回数と、実行中のイベント列を共有した回数を取得
+        """
+        return {"leaders": self.leaders, "shared": self.shared, "in_flight": len(self._flights)}
+
+
+############################################################
+# 関数定義
+############################################################
+
+def normalize(text):
+    """
+    キーの作成用に、表記の揺れ（全角・半角、大文字・小文字、空白）をそろえる
+
+    Args:
+        text: 文字列
+
+    Returns:
+        正規化した文字列
+    """
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def snapshot():
+    """
+    全インスタンスの状態を取得（メトリクス出力用）
+
+    Returns:
+        インスタンス名ごとの状態の辞書
+    """
+    return {instance.name: instance.snapshot() for instance in _instances}
+
+
+# メトリクスの出力にシングルフライトの状態を含める
+metrics.register_snapshot_provider("singleflight", snapshot)
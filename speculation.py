@@ -0,0 +1,198 @@
+"""
+このファイルは、ユーザーが送信する前に回答の生成を始めておく「先行生成」と、ジャンル選択時の事前準備が記述されたファイルです。
+
+    - 先行生成: 音声入力の文字起こし結果が出た時点で、そのテキストでの回答生成をバックグラウンドで開始する。
+      ユーザーが同じテキストのまま送信した場合は、生成中または生成済みの回答をそのまま使い、
+      テキストを編集した場合やキャンセルした場合は、生成を取り消す。
+    - 事前準備: ジャンルが選択された時点で、そのジャンルで検索するシャードの読み込み、Agent Executorの作成、
+      OpenAI APIへの接続をバックグラウンドで済ませておく。
+
+先行生成はセッションごとに1件だけ保持し、「お悩み種別・ジャンル・テキスト（完全一致）」で照合します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import constants as ct
+import engine
+import metrics
+import rate_limiter
+import retrieval
+from cancellation import CancellationToken
+
+
+############################################################
+# 変数定義
+############################################################
+# 先行生成を実行するスレッドプール
+_executor = ThreadPoolExecutor(max_workers=ct.SPECULATION_MAX_WORKERS, thread_name_prefix="speculation")
+# ジャンル選択時の事前準備を実行するスレッドプール（先行生成の実行枠を使わないよう分ける）
+_warm_up_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="genre-warm-up")
+
+# セッションIDごとの先行生成
+_speculations = {}
+_lock = threading.Lock()
+
+# 先行生成の件数（開始・使用・取り消し）
+_stats = {"started": 0, "used": 0, "cancelled": 0}
+
+
+############################################################
+# クラス定義
+############################################################
+
+class _Speculation:
+    """
+    1件分の先行生成
+    """
+    def __init__(self, key, future, token):
+        self.key = key
+        self.future = future
+        self.token = token
+        self.created_at = time.monotonic()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _key(chat_message, mode, mode_2):
+    # テキストは正規化せず、完全に一致する場合だけ先行生成の結果を使う
+    return (mode or "", mode_2 or "", chat_message)
+
+
+def _cancel(speculation, reason):
+    """
+    先行生成を取り消す（呼び出し元で_lockを取得していること）
+    """
+    speculation.token.cancel(reason)
+    if not speculation.future.done():
+        _stats["cancelled"] += 1
+
+
+def _purge_expired():
+    """
+    保持期間を過ぎた先行生成を破棄（呼び出し元で_lockを取得していること）
+    """
+    now = time.monotonic()
+    for session_id, speculation in list(_speculations.items()):
+        if now - speculation.created_at > ct.SPECULATION_TTL_SECONDS:
+            _cancel(speculation, "expired")
+            del _speculations[session_id]
+
+
+def start(session_id, chat_message, mode, mode_2, messages):
+    """
+    回答の先行生成を開始（同じ内容の先行生成がすでにある場合は何もしない）
+
+    Args:
+        session_id: セッションID
+        chat_message: 送信される見込みのテキスト
+        mode: お悩み種別
+        mode_2: ジャンル
+        messages: 表示用の会話ログ
+    """
+    if not ct.SPECULATION_ENABLED or not chat_message or not chat_message.strip():
+        return
+
+    key = _key(chat_message, mode, mode_2)
+    with _lock:
+        _purge_expired()
+        current = _speculations.get(session_id)
+        if current is not None:
+            if current.key == key:
+                return
+            _cancel(current, "superseded")
+
+        token = CancellationToken()
+        # ログ・レート制限でセッションを識別できるよう、呼び出し元のコンテキストを引き継いで実行する
+        context = contextvars.copy_context()
+        future = _executor.submit(
+            context.run, engine.ask, chat_message,
+            mode=mode, mode_2=mode_2, messages=list(messages or []), cancel_token=token
+        )
+        _speculations[session_id] = _Speculation(key, future, token)
+        _stats["started"] += 1
+
+
+def take(session_id, chat_message, mode, mode_2, cancel_token=None):
+    """
+    送信されたテキストに一致する先行生成を取り出す（一致しない先行生成は取り消す）
+
+    Args:
+        session_id: セッションID
+        chat_message: 送信されたテキスト
+        mode: お悩み種別
+        mode_2: ジャンル
+        cancel_token: 送信された回答生成のキャンセルトークン（取り消された場合は、取り出した先行生成も取り消す）
+
+    Returns:
+        回答のFuture（一致する先行生成がない場合はNone）
+    """
+    with _lock:
+        current = _speculations.pop(session_id, None)
+        if current is None:
+            return None
+        if current.key != _key(chat_message, mode, mode_2):
+            _cancel(current, "edited")
+            return None
+        _stats["used"] += 1
+    if cancel_token is not None:
+        cancel_token.on_cancel(lambda: current.token.cancel(cancel_token.reason))
+    return current.future
+
+
+def cancel(session_id, reason="cancelled"):
+    """
+    セッションの先行生成を取り消す
+
+    Args:
+        session_id: セッションID
+        reason: 取り消しの理由
+    """
+    with _lock:
+        current = _speculations.pop(session_id, None)
+        if current is not None:
+            _cancel(current, reason)
+
+
+def warm_up_genre(mode_2):
+    """
+    ジャンルの処理に必要なリソースの準備を、バックグラウンドで開始
+
+    Args:
+        mode_2: ジャンル
+    """
+    _warm_up_executor.submit(_warm_up_genre, mode_2)
+
+
+def _warm_up_genre(mode_2):
+    """
+    ジャンルで検索するシャードの読み込み、Agent Executorの作成、OpenAI APIへの接続を行う
+    """
+    try:
+        with metrics.span("genre_warm_up", mode_2=mode_2):
+            retrieval.warm_up(retrieval.genre_corpora(mode_2))
+            engine.get_agent_executor(mode_2)
+            rate_limiter.warm_up_connection()
+    except Exception as e:
+        logging.getLogger(ct.LOGGER_NAME).warning(f"{mode_2}の事前準備に失敗しました: {e}")
+
+
+def snapshot():
+    """
+    先行生成の件数を取得
+
+    Returns:
+        開始・使用・取り消しの件数と、保持中の件数
+    """
+    with _lock:
+        return {**_stats, "pending": len(_speculations)}
+
+
+metrics.register_snapshot_provider("speculation", snapshot)
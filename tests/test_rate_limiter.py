@@ -0,0 +1,92 @@
+"""
+このファイルは、rate_limiter.py の非同期トランスポートで、タスクが取り消された場合に同時実行数の枠が返却されることを確認するテストです。
+
+使い方:
+    python -m unittest tests.test_rate_limiter
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import unittest
+from unittest import mock
+import httpx
+import rate_limiter
+
+
+############################################################
+# 変数定義
+############################################################
+# 本文を解析しない（トークン数の推定が不要な）音声認識のエンドポイント
+TRANSCRIPTIONS_URL = "https://api.openai.com/v1/audio/transcriptions"
+MODEL = "whisper-1"
+
+
+############################################################
+# クラス定義
+############################################################
+
+class _SlowTransport(httpx.AsyncBaseTransport):
+    """
+    送信を開始したことを通知し、応答を返さずに待ち続けるトランスポート
+    """
+    def __init__(self):
+        self.started = asyncio.Event()
+
+    async def handle_async_request(self, request):
+        self.started.set()
+        await asyncio.sleep(60)
+        return httpx.Response(200)
+
+
+class AsyncRateLimitedTransportCancelTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # 他のテスト・処理のリミッターと状態を共有しないよう、リミッターを作り直す
+        patcher = mock.patch.dict(rate_limiter._limiters, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def _wait_until(self, condition, timeout=3.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition():
+            if asyncio.get_running_loop().time() > deadline:
+                self.fail("条件を満たさないままタイムアウトしました")
+            await asyncio.sleep(0.05)
+
+    async def test_release_when_cancelled_while_sending(self):
+        inner = _SlowTransport()
+        transport = rate_limiter.AsyncRateLimitedTransport(inner)
+        task = asyncio.create_task(transport.handle_async_request(httpx.Request("POST", TRANSCRIPTIONS_URL)))
+        await asyncio.wait_for(inner.started.wait(), timeout=3.0)
+        limiter = rate_limiter.get_limiter(MODEL)
+        self.assertEqual(limiter.in_flight, 1)
+
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_release_when_cancelled_while_waiting_for_slot(self):
+        limiter = rate_limiter.get_limiter(MODEL)
+        # 同時実行数の枠を使い切った状態にして、送信許可の待機中に取り消す
+        limiter.in_flight = int(limiter.concurrency_limit)
+        transport = rate_limiter.AsyncRateLimitedTransport(_SlowTransport())
+        task = asyncio.create_task(transport.handle_async_request(httpx.Request("POST", TRANSCRIPTIONS_URL)))
+        await self._wait_until(lambda: limiter.snapshot()["waiting"] == 1)
+
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        # 使い切っていた枠を返却しても、取り消したリクエストが枠を取得したまま残らないこと
+        with limiter._cond:
+            limiter.in_flight = 0
+            limiter._cond.notify_all()
+        await self._wait_until(lambda: limiter.snapshot()["waiting"] == 0)
+        await asyncio.sleep(0.1)
+        self.assertEqual(limiter.in_flight, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,268 @@
+"""
+このファイルは、Agent Executorに渡すTool（専門家AI・Web検索・Wikipedia検索）の処理が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import logging
+import requests
+from urllib.parse import quote
+from langchain.prompts import ChatPromptTemplate
+from langchain import SerpAPIWrapper
+from langchain.tools import Tool
+import constants as ct
+import cancellation
+import metrics
+import model_policy
+import retrieval
+import singleflight
+
+
+############################################################
+# 変数定義
+############################################################
+# 同じ専門家AIへの同じ質問を、実行中の1回の生成にまとめる
+_expert_flight = singleflight.SingleFlight("expert")
+
+
+############################################################
+# 関数定義
+############################################################
+
+def result_chain(param, system_template, human_template="{input}", **variables):
+    # 同じジャンル・同じ専門家AI（テンプレート）・同じ質問・同じ参考情報の生成が実行中であれば、その結果を共有する
+    trace = metrics.current_trace()
+    genre = trace.mode_2 if trace is not None else ""
+    key = (genre, system_template, human_template, singleflight.normalize(param), tuple(sorted(variables.items())))
+    return _expert_flight.do(key, lambda: _run_result_chain(param, system_template, human_template, variables, genre))
+
+def _run_result_chain(param, system_template, human_template, variables, genre=""):
+    # 固定のシステムメッセージを先頭に置き、質問ごとに変わる内容はユーザーメッセージにまとめる
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", system_template),
+        ("human", human_template)
+    ])
+    tier = model_policy.tier_for("answer", genre)
+    if not model_policy.can_escalate(tier):
+        return (prompt | model_policy.chat_model(tier, temperature=ct.TEMPERATURE)).invoke({"input": param, **variables}).content
+
+    # 昇格できる階層では、出力トークンの確率も受け取り、確信度が低い場合だけ上位の階層で生成し直す
+    message = (prompt | model_policy.chat_model(tier, temperature=ct.TEMPERATURE, logprobs=True)).invoke({"input": param, **variables})
+    score = model_policy.confidence(message)
+    if score is None or score >= ct.MODEL_ESCALATION_CONFIDENCE:
+        return message.content
+
+    with metrics.span("model_escalation", tier=ct.MODEL_ESCALATION_TIER, from_tier=tier, confidence=round(score, 4)):
+        llm = model_policy.chat_model(ct.MODEL_ESCALATION_TIER, temperature=ct.TEMPERATURE)
+        return (prompt | llm).invoke({"input": param, **variables}).content
+
+def rag_result_chain(param, system_template, mode_2):
+    """
+    ジャンルに対応するコーパスを検索し、検索結果を参考情報として回答を生成
+    （検索できるコーパスがない場合や検索に失敗した場合は、参考情報なしで回答を生成）
+    """
+    try:
+        docs = retrieval.search_genre(param, mode_2)
+    except cancellation.OperationCancelled:
+        raise
+    except Exception as e:
+        logging.getLogger(ct.LOGGER_NAME).warning(f"{mode_2}の資料の検索に失敗しました: {e}")
+        docs = None
+    if not docs:
+        return result_chain(param, system_template)
+
+    context = "\n\n".join([doc.page_content for doc in docs])
+    return result_chain(param, system_template + ct.RAG_SYSTEM_INSTRUCTION, ct.RAG_HUMAN_TEMPLATE, context=context)
+
+def get_marketing_strategy_advice(param):
+    system_template = ct.MARKEIING_STORATEGY_TEMPLATE
+    result = result_chain(param, system_template)
+    return result
+
+def get_sales_strategy_advice(param):
+    system_template = ct.SALES_STRATEGY_TEMPLATE
+    result = result_chain(param, system_template)
+    return result
+
+def get_recruitment_strategy_advice(param):
+    system_template = ct.RECRUITMENT_STRATEGY_TEMPLATE
+    result = rag_result_chain(param, system_template, ct.ANSWER_MODE_5)
+    return result
+
+def get_organizational_storategy_advice(param):
+    system_template = ct.ORGANIZATIONAL_STRATEGY_TEMPLATE
+    result = rag_result_chain(param, system_template, ct.ANSWER_MODE_6)
+    return result
+
+def get_buisiness_improvement_advice(param):
+    system_template = ct.BUSINESS_IMPROVEMENT_TEMPLATE
+    result = result_chain(param, system_template)
+    return result
+
+def get_physical_health_advice(param):
+    system_template = ct.PHYSICAL_HEALTH_TEMPLATE
+    result = rag_result_chain(param, system_template, ct.ANSWER_MODE_8)
+    return result
+
+def get_mental_health_advice(param):
+    system_template = ct.MENTAL_HEALTH_TEMPLATE
+    result = rag_result_chain(param, system_template, ct.ANSWER_MODE_9)
+    return result
+
+def get_company_law_advice(param):
+    """
+    会社法に関する質問に対して、RAGを使って回答を生成
+    """
+    try:
+        # 関連する文書を検索
+        docs = retrieval.search_company_law(param)
+
+        # ベクトルストアが初期化されていない場合はエラーメッセージ
+        if docs is None:
+            return "会社法の資料が読み込まれていません。アプリを再起動してください。"
+
+        # 検索結果を文脈として結合
+        context = "\n\n".join([doc.page_content for doc in docs])
+
+        # 文脈はユーザーメッセージに埋め込み、システムメッセージは固定のまま使う
+        result = result_chain(param, ct.COMPANY_LAW_TEMPLATE, ct.RAG_HUMAN_TEMPLATE, context=context)
+        return result
+    except cancellation.OperationCancelled:
+        raise
+    except Exception as e:
+        return f"会社法の検索中にエラーが発生しました: {str(e)}"
+
+
+def run_wikipedia_search(query: str) -> str:
+    """Wikipediaで検索し、最上位の概要を返す簡易ツール。
+
+    - まず検索APIで最上位ヒットのタイトルを取得
+    - REST Summary APIで概要を取得
+    - 失敗時はエラーメッセージを返す
+    """
+    try:
+        # ひとまず日本語版を優先（必要ならct側で設定化可能）
+        lang = "ja"
+        session = requests.Session()
+
+        # 検索API
+        search_params = {
+            "action": "query",
+            "list": "search",
+            "srsearch": query,
+            "format": "json",
+        }
+        search_url = f"https://{lang}.wikipedia.org/w/api.php"
+        # 取り消された処理では、HTTPリクエストを送信しない
+        cancellation.raise_if_cancelled()
+        resp = session.get(search_url, params=search_params, timeout=10)
+        resp.raise_for_status()
+        data = resp.json()
+        hits = data.get("query", {}).get("search", [])
+        if not hits:
+            return f"Wikipediaで該当記事が見つかりませんでした: {query}"
+
+        title = hits[0].get("title")
+        if not title:
+            return f"Wikipedia検索結果の取得に失敗しました: {query}"
+
+        # Summary API
+        summary_url = f"https://{lang}.wikipedia.org/api/rest_v1/page/summary/{quote(title)}"
+        cancellation.raise_if_cancelled()
+        sresp = session.get(summary_url, timeout=10)
+        sresp.raise_for_status()
+        sdata = sresp.json()
+        extract = sdata.get("extract") or "概要が取得できませんでした。"
+        page_url = sdata.get("content_urls", {}).get("desktop", {}).get("page")
+        page_url = page_url or f"https://{lang}.wikipedia.org/wiki/{quote(title)}"
+
+        return f"【Wikipedia】{title}\n{extract}\n\nURL: {page_url}"
+
+    except cancellation.OperationCancelled:
+        raise
+    except Exception as e:
+        return f"Wikipedia検索中にエラーが発生しました: {e}"
+
+
+def build_tools():
+    """
+    Agent Executorに渡すTool一覧を作成
+
+    Returns:
+        Toolのリスト
+    """
+    # Web検索用のToolを設定するためのオブジェクトを用意
+    search = SerpAPIWrapper()
+    # Agent Executorに渡すTool一覧を用意
+    return [
+        # マーケティング戦略に関するアドバイス用のTool
+        Tool.from_function(
+            func=get_marketing_strategy_advice,
+            name=ct.MARKETING_STRATEGY_NAME,
+            description=ct.MARKETING_STRATEGY_DESCRIPTION,
+        ),
+
+        # 営業戦略に関するアドバイス用のTool
+        Tool.from_function(
+            func=get_sales_strategy_advice,
+            name=ct.SALES_STRATEGY_TEMPLATE_NAME,
+            description=ct.SALES_STRATEGY_TEMPLATE_DESCRIPTION,
+        ),
+
+        # 採用戦略に関するアドバイス用のTool
+        Tool.from_function(
+            func=get_recruitment_strategy_advice,
+            name=ct.RECRUITMENT_STRATEGY_TEMPLATE_NAME,
+            description=ct.RECRUITMENT_STRATEGY_TEMPLATE_DESCRIPTION,
+        ),
+
+        # 組織戦略に関するアドバイス用のTool
+        Tool.from_function(
+            func=get_organizational_storategy_advice,
+            name=ct.ORGANIZATIONAL_STRATEGY_TEMPLATE_NAME,
+            description=ct.ORGANIZATIONAL_STRATEGY_TEMPLATE_DESCRIPTION,
+        ),
+
+        # 業務改善に関するアドバイス用のTool
+        Tool.from_function(
+            func=get_buisiness_improvement_advice,
+            name=ct.BUSINESS_IMPROVEMENT_NAME,
+            description=ct.BUSINESS_IMPROVEMENT_DESCRIPTION,
+        ),
+
+        # 健康管理に関するアドバイス用のTool
+        Tool.from_function(
+            func=get_physical_health_advice,
+            name=ct.PHYSICAL_HEALTH_TEMPLATE_NAME,
+            description=ct.PHYSICAL_HEALTH_TEMPLATE_DESCRIPTION,
+        ),
+
+        # メンタルヘルスに関するアドバイス用のTool
+        Tool.from_function(
+            func=get_mental_health_advice,
+            name=ct.MENTAL_HEALTH_TEMPLATE_NAME,
+            description=ct.MENTAL_HEALTH_TEMPLATE_DESCRIPTION,
+        ),
+
+        # 会社法に関するアドバイス用のTool
+        Tool.from_function(
+            func=get_company_law_advice,
+            name=ct.COMPANY_LAW_NAME,
+            description=ct.COMPANY_LAW_DESCRIPTION,
+        ),
+
+        # Web検索用のTool
+        Tool(
+            name = ct.SEARCH_WEB_INFO_TOOL_NAME,
+            func=search.run,
+            description=ct.SEARCH_WEB_INFO_TOOL_DESCRIPTION
+        ),
+
+        # Wikipedia検索用のTool
+        Tool(
+            name = ct.SEARCH_WIKIPEDIA_INFO_TOOL_NAME,
+            func=run_wikipedia_search,
+            description=ct.SEARCH_WIKIPEDIA_INFO_TOOL_DESCRIPTION
+        ),
+    ]
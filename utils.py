@@ -5,13 +5,16 @@
 ############################################################
 # ライブラリの読み込み
 ############################################################
-import os
+import json
+import logging
 from dotenv import load_dotenv
 import streamlit as st
-from langchain_openai import ChatOpenAI
-import constants as ct
 import requests
-from urllib.parse import quote
+import constants as ct
+import cancellation
+import engine
+import jobs
+import speculation
 
 
 ############################################################
@@ -67,100 +70,232 @@ def _build_conversational_input(chat_message: str, max_turns: int = 4) -> str:
     Returns:
         文脈付きの入力テキスト
     """
-    mode = getattr(st.session_state, "mode", "")
-    mode_2 = getattr(st.session_state, "mode_2", "")
-    
-    # ヘッダー作成：お悩み種別とジャンルの両方を含める
-    header_parts = []
-    if mode:
-        header_parts.append(f"[お悩み種別: {mode}]")
-    if mode_2:
-        header_parts.append(f"[選択ジャンル: {mode_2}]")
-    header = "\n".join(header_parts) if header_parts else ""
-
-    # 表示用ログ（`messages`）から直近の会話を抽出（ユーザー/AIのテキストのみ使用）
-    history = []
-    if "messages" in st.session_state and isinstance(st.session_state.messages, list):
-        # ユーザー/AIの発話本文があれば取り出す
-        for m in st.session_state.messages:
-            role = m.get("role") if isinstance(m, dict) else None
-            content = m.get("content") if isinstance(m, dict) else None
-            if role in ("user", "assistant") and isinstance(content, str):
-                history.append((role, content))
-
-    # 直近max_turnsペア分に圧縮
-    history_text = []
-    for role, content in history[-max_turns * 2:]:
-        prefix = "ユーザー:" if role == "user" else "アシスタント:"
-        history_text.append(f"{prefix} {content}")
-
-    history_block = "\n".join(history_text) if history_text else ""
-
-    # 最終的な入力テキスト
-    parts = [p for p in [header, history_block, f"ユーザー: {chat_message}"] if p]
-    return "\n\n".join(parts)
+    return engine.build_conversational_input(
+        chat_message,
+        mode=getattr(st.session_state, "mode", ""),
+        mode_2=getattr(st.session_state, "mode_2", ""),
+        messages=st.session_state.history.recent(),
+        max_turns=max_turns,
+    )
 
 
 def get_llm_response(chat_message: str):
     """
     Agent Executorを使用して、直近の会話文脈を含めた入力で回答を取得する。
+    相談エンジンAPIのURLが設定されている場合はAPI経由で、未設定の場合は同じプロセス内で回答を生成する。
+
+    回答生成のジョブを受け付け（同じメッセージのジョブがあれば引き継ぎ）、完了するまで待って結果を返す
+    （画面では待たずに、submit_llm_job・get_llm_job でジョブの状態を確認する）
+
+    Args:
+        chat_message: ユーザー入力値
+
+    Returns:
+        文字列の回答
+    """
+    job = get_llm_job(chat_message) or submit_llm_job(chat_message)
+    # 待っている間も状態を確認し、放置されたジョブとして取り消されないようにする
+    while not job.wait(ct.JOB_POLL_SECONDS):
+        jobs.get(job.id)
+    return take_llm_job_result(job)
+
+
+def _job_key(chat_message):
+    """
+    回答生成のジョブの内容を識別するキーを作成
+    """
+    return (chat_message, st.session_state.get("mode") or "", st.session_state.get("mode_2") or "")
+
+
+def submit_llm_job(chat_message: str):
+    """
+    回答生成のジョブを受け付け、ジョブIDをセッションに保持（同じセッションで実行中のジョブは取り消す）
+
+    Args:
+        chat_message: ユーザー入力値
+
+    Returns:
+        ジョブ
+    """
+    mode = st.session_state.get("mode") or ""
+    mode_2 = st.session_state.get("mode_2") or ""
+    # 文脈に使うのは直近の会話だけのため、メモリに保持している範囲だけを渡す
+    messages = st.session_state.history.recent()
+    session_id = st.session_state.get("session_id")
+
+    def generate(cancel_token, on_event):
+        return _generate(chat_message, mode, mode_2, messages, session_id, cancel_token, on_event)
+
+    job = jobs.submit(session_id, generate, key=_job_key(chat_message))
+    st.session_state.llm_job_id = job.id
+    return job
+
+
+def get_llm_job(chat_message: str):
+    """
+    セッションで受け付け済みの、同じメッセージの回答生成のジョブを取得（画面の再実行をまたいで引き継ぐ）
+
+    Args:
+        chat_message: ユーザー入力値
+
+    Returns:
+        ジョブ（ない場合・取り消された場合はNone）
+    """
+    job_id = st.session_state.get("llm_job_id")
+    job = jobs.get(job_id) if job_id else None
+    if job is None or job.key != _job_key(chat_message) or job.status == jobs.STATUS_CANCELLED:
+        return None
+    return job
+
+
+def take_llm_job_result(job):
+    """
+    終了したジョブの結果を受け取り、ジョブを破棄
+
+    Args:
+        job: 終了したジョブ
+
+    Returns:
+        文字列の回答（生成に失敗した・取り消された場合は、そのエラーを送出）
+    """
+    jobs.discard(job.id)
+    if st.session_state.get("llm_job_id") == job.id:
+        st.session_state.llm_job_id = None
+    if job.error is not None:
+        raise job.error
+    return job.result
+
+
+def _generate(chat_message, mode, mode_2, messages, session_id, cancel_token, on_event):
+    """
+    ジョブを実行するスレッドで、回答を生成
+
+    Returns:
+        文字列の回答
+    """
+    if ct.ENGINE_API_URL:
+        return _request_engine_api(chat_message, mode, mode_2, messages, session_id, cancel_token, on_event)
+
+    # 送信前に同じテキストで先行生成していれば、その回答（生成中の場合は完了を待って）を使う
+    future = speculation.take(session_id, chat_message, mode, mode_2, cancel_token=cancel_token)
+    if future is not None:
+        try:
+            return future.result()
+        except cancellation.OperationCancelled:
+            raise
+        except Exception as e:
+            logging.getLogger(ct.LOGGER_NAME).warning(f"先行生成の回答を取得できなかったため、生成し直します: {e}")
+
+    return engine.ask(chat_message, mode=mode, mode_2=mode_2, messages=messages, cancel_token=cancel_token, on_event=on_event)
+
+
+def start_speculation(chat_message: str):
+    """
+    送信される見込みのテキスト（音声入力の文字起こし結果）で、回答の先行生成を開始
+
+    Args:
+        chat_message: 送信される見込みのテキスト
+    """
+    # 相談エンジンAPI経由の場合は、送信時にAPI側で生成する
+    if ct.ENGINE_API_URL:
+        return
+    speculation.start(
+        st.session_state.get("session_id"),
+        chat_message,
+        st.session_state.get("mode") or "",
+        st.session_state.get("mode_2") or "",
+        st.session_state.history.recent(),
+    )
+
+
+def cancel_generation(reason="cancelled"):
+    """
+    セッションで実行中の回答生成と、回答の先行生成を取り消す
+
+    Args:
+        reason: 取り消しの理由
+    """
+    job_id = st.session_state.get("llm_job_id")
+    if job_id:
+        jobs.cancel(job_id, reason)
+        jobs.discard(job_id)
+        st.session_state.llm_job_id = None
+    cancellation.cancel_session(st.session_state.get("session_id"), reason)
+    cancel_speculation(reason)
+
+
+def cancel_speculation(reason="cancelled"):
+    """
+    回答の先行生成を取り消す
+
+    Args:
+        reason: 取り消しの理由
+    """
+    if ct.ENGINE_API_URL:
+        return
+    speculation.cancel(st.session_state.get("session_id"), reason)
+
+
+def warm_up_genre():
+    """
+    選択中のジャンルの処理に必要なリソースを、バックグラウンドで準備（ジャンルが変わったときだけ行う）
+    """
+    mode_2 = st.session_state.get("mode_2")
+    if ct.ENGINE_API_URL or not mode_2 or st.session_state.get("warmed_up_genre") == mode_2:
+        return
+    st.session_state.warmed_up_genre = mode_2
+    speculation.warm_up_genre(mode_2)
+
+
+def _request_engine_api(chat_message, mode, mode_2, messages, session_id, token, on_event=None):
+    """
+    相談エンジンAPI（POST /ask/stream）から回答を取得
+
+    取り消された場合は接続を閉じ、API側での生成も打ち切らせる
 
     Args:
         chat_message: ユーザー入力値
+        mode: お悩み種別
+        mode_2: ジャンル
+        messages: 表示用の会話ログ
+        session_id: セッションID
+        token: 回答生成のキャンセルトークン
+        on_event: 途中経過のイベント（「tool」「token」）を受け取る関数
 
     Returns:
         文字列の回答
     """
-    agent_executor = st.session_state.agent_executor
-
-    contextual_input = _build_conversational_input(chat_message)
-
-    result = agent_executor.invoke({"input": contextual_input})
-    # AgentExecutorは標準で{"output": "..."}形式を返す
-    return result.get("output", result)
-
-
-def run_wikipedia_search(query: str) -> str:
-    """Wikipediaで検索し、最上位の概要を返す簡易ツール。
-
-    - まず検索APIで最上位ヒットのタイトルを取得
-    - REST Summary APIで概要を取得
-    - 失敗時はエラーメッセージを返す
-    """
-    try:
-        # ひとまず日本語版を優先（必要ならct側で設定化可能）
-        lang = "ja"
-        session = requests.Session()
-
-        # 検索API
-        search_params = {
-            "action": "query",
-            "list": "search",
-            "srsearch": query,
-            "format": "json",
-        }
-        search_url = f"https://{lang}.wikipedia.org/w/api.php"
-        resp = session.get(search_url, params=search_params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        hits = data.get("query", {}).get("search", [])
-        if not hits:
-            return f"Wikipediaで該当記事が見つかりませんでした: {query}"
-
-        title = hits[0].get("title")
-        if not title:
-            return f"Wikipedia検索結果の取得に失敗しました: {query}"
-
-        # Summary API
-        summary_url = f"https://{lang}.wikipedia.org/api/rest_v1/page/summary/{quote(title)}"
-        sresp = session.get(summary_url, timeout=10)
-        sresp.raise_for_status()
-        sdata = sresp.json()
-        extract = sdata.get("extract") or "概要が取得できませんでした。"
-        page_url = sdata.get("content_urls", {}).get("desktop", {}).get("page")
-        page_url = page_url or f"https://{lang}.wikipedia.org/wiki/{quote(title)}"
-
-        return f"【Wikipedia】{title}\n{extract}\n\nURL: {page_url}"
-
-    except Exception as e:
-        return f"Wikipedia検索中にエラーが発生しました: {e}"
\ No newline at end of file
+    with requests.post(
+        f"{ct.ENGINE_API_URL.rstrip('/')}/ask/stream",
+        json={
+            "mode": mode,
+            "mode_2": mode_2,
+            "history": messages,
+            "message": chat_message,
+            "session_id": session_id,
+        },
+        timeout=ct.ENGINE_API_TIMEOUT,
+        stream=True,
+    ) as response:
+        # Agent・Toolの実行中はAPIから何も届かないため、取り消された時点で接続を閉じて待機を打ち切る
+        # （API側は接続が切れたことで生成を取り消す）
+        token.on_cancel(response.close)
+        response.raise_for_status()
+        try:
+            for line in response.iter_lines():
+                token.raise_if_cancelled()
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event["event"] == "final":
+                    return event["answer"]
+                if event["event"] == "error":
+                    raise RuntimeError(event["message"])
+                if on_event is not None:
+                    on_event(event)
+        except Exception:
+            # 接続を閉じたことによる読み込みエラーは、取り消しとして扱う
+            token.raise_if_cancelled()
+            raise
+    token.raise_if_cancelled()
+    raise RuntimeError("相談エンジンAPIから最終回答を受け取れませんでした。")